@@ -4,6 +4,7 @@ import sys
 import argparse
 import textwrap
 import fnmatch
+import itertools
 import logging
 from pathlib import Path
 import cdtb
@@ -14,9 +15,22 @@ from cdtb.storage import (
     parse_storage_component,
     storage_conf_from_path,
 )
+from cdtb.patcher import PatcherStorage, PatcherPatchElement
 from cdtb.wad import Wad
 from cdtb.export import CdragonRawPatchExporter
-from cdtb.binfile import BinFile
+from cdtb.binfile import (
+    BinObjectWithFields,
+    BinPtchEntry,
+    BinTypeName,
+    LazyBinFile,
+    dump_linked_files,
+    dump_value,
+    parse_binhash,
+    value_to_serializable,
+)
+from cdtb.binindex import BinIndex, StaleBinIndexError
+from cdtb.bindiff import diff_bin_files, diff_bin_dirs
+from cdtb.columnar import entries_to_columns, write_columns
 from cdtb.sknfile import SknFile
 from cdtb.hashes import (
     HashFile,
@@ -26,7 +40,7 @@ from cdtb.hashes import (
     default_hash_dir,
     update_default_hashfile,
 )
-from cdtb.tools import json_dump
+from cdtb.tools import json_dump, json_dumps, write_file_or_remove
 
 
 def parse_component_arg(parser, storage: Storage, component: str):
@@ -71,8 +85,33 @@ def parse_storage_args(parser, args) -> Storage:
 
 
 def command_download(parser, args):
+    if args.stream and not isinstance(args.storage, PatcherStorage):
+        parser.error("--stream is only supported by patcher storages")
+    delta_elements = {}
+    if args.delta_from is not None:
+        for elem in parse_component_arg(parser, args.storage, args.delta_from):
+            if not isinstance(elem, PatcherPatchElement):
+                parser.error("--delta-from is only supported by patcher storages")
+            delta_elements[elem.name] = elem
+
+    kwargs = {'stream': True} if args.stream else {}
     for component in parse_component_args(parser, args.storage, args.component):
-        component.download(langs=args.langs)
+        if component.name in delta_elements:
+            component.download(langs=args.langs, delta_from=delta_elements[component.name], **kwargs)
+        else:
+            component.download(langs=args.langs, **kwargs)
+
+
+def command_storage_gc(parser, args):
+    if not isinstance(args.storage, PatcherStorage):
+        parser.error("storage-gc is only supported by patcher storages")
+    if args.keep < 1:
+        parser.error("at least one release must be kept")
+    try:
+        count, size = args.storage.collect_garbage(args.keep, grace_period=args.grace_period * 3600, dry_run=args.dry_run)
+    except RuntimeError as e:
+        parser.error(str(e))
+    print(f"{'would remove' if args.dry_run else 'removed'} {count} files ({size / 1024**2:.1f} MB)")
 
 
 def command_files(parser, args):
@@ -272,7 +311,8 @@ def command_export(parser, args):
             parser.error("patch version required with --previous or --full")
         if args.first:
             parser.error("--from is required when no patch is provided")
-        exporters = CdragonRawPatchExporter.from_directory(storage, args.output, PatchVersion(args.first), symlinks=symlinks)
+        exporters = CdragonRawPatchExporter.from_directory(storage, args.output, PatchVersion(args.first), symlinks=symlinks,
+                                                           processes=args.processes, skn_glb=args.skn_glb, columnar=args.columnar)
         for exporter in exporters:
             exporter.process(overwrite=overwrite)
     else:
@@ -298,7 +338,8 @@ def command_export(parser, args):
             else:
                 parser.error("cannot guess previous patch")
 
-        exporter = CdragonRawPatchExporter(os.path.join(args.output, str(patch.version)), patch, previous_patch, symlinks=symlinks)
+        exporter = CdragonRawPatchExporter(os.path.join(args.output, str(patch.version)), patch, previous_patch, symlinks=symlinks,
+                                           processes=args.processes, skn_glb=args.skn_glb, columnar=args.columnar)
         exporter.process(overwrite=overwrite)
 
 
@@ -307,13 +348,20 @@ def command_skn_extract(parser, args):
         parser.error(f"SKN file not found: {args.skn}")
 
     sknfile = SknFile(args.skn)
+    if args.format == 'glb':
+        if args.output is None:
+            args.output = os.path.splitext(args.skn)[0] + '.glb'
+        with write_file_or_remove(args.output) as f:
+            sknfile.write_glb(f)
+        return
+
     if args.output is None:
         args.output = os.path.splitext(args.skn)[0]
     os.makedirs(args.output, exist_ok=True)
     for entry in sknfile.entries:
         name = os.path.join(args.output, entry["name"] + ".obj")
         with open(name, "w") as f:
-            f.write(sknfile.to_obj(entry))
+            sknfile.write_obj(entry, f)
 
 
 def command_bin_dump(parser, args):
@@ -321,13 +369,146 @@ def command_bin_dump(parser, args):
         parser.error(f"BIN file not found: {args.bin}")
 
     parsed_version = PatchVersion(args.patch_version if args.patch_version else "main").as_int()
+    types = {parse_binhash(s) for s in args.type} if args.type else None
+    paths = {parse_binhash(s) for s in args.path} if args.path else None
+    field = [parse_binhash(s) for s in args.field.split('.')] if args.field else None
+
+    # dump entries as they are decoded, skip entries filtered out
+    with LazyBinFile(args.bin, btype_version=parsed_version) as binfile:
+        linked_files = binfile.linked_files
+        entries = (binfile.read_entry(header) for header in binfile.entry_headers
+                   if (types is None or header.type.h in types) and (paths is None or header.path.h in paths))
+        patch_entries = None if types is not None else binfile.read_patch_entries()
+        if patch_entries is not None and paths is not None:
+            patch_entries = [entry for entry in patch_entries if entry.path.h in paths]
+
+        if field is not None:
+            # dump only the field of each entry, skip entries without it
+            def iter_fields(entries):
+                for entry in entries:
+                    v = entry.value if isinstance(entry, BinPtchEntry) else entry
+                    for key in field[:-1]:
+                        v = v.getv(key)
+                        if not isinstance(v, BinObjectWithFields):
+                            break
+                    else:
+                        if field[-1] in v:
+                            yield entry.path, v[field[-1]]
+            items = iter_fields(itertools.chain(entries, patch_entries or []))
+            if args.json:
+                _json_dump_items(((k, v.to_serializable()[1]) for k, v in items), sys.stdout)
+            else:
+                for path, v in items:
+                    sys.stdout.write(f"{path!r} ")
+                    dump_value(v, sys.stdout)
+        elif args.json:
+            items = ((entry.path, entry.to_serializable()) for entry in entries)
+            if types is None and paths is None and linked_files is not None:
+                items = itertools.chain(items, [("__linked", linked_files)])
+            if patch_entries is not None:
+                patches = {entry.path.to_serializable(): entry.to_serializable() for entry in patch_entries}
+                items = itertools.chain(items, [("__patches", patches)])
+            _json_dump_items(items, sys.stdout)
+        else:
+            if types is None and paths is None and linked_files is not None:
+                dump_linked_files(linked_files, sys.stdout)
+            for entry in itertools.chain(entries, patch_entries or []):
+                dump_value(entry, sys.stdout)
+
+def _json_dump_items(items, f):
+    """Dump `(key, value)` pairs as a JSON object, item by item"""
+    f.write('{')
+    for i, (key, value) in enumerate(items):
+        if i:
+            f.write(',')
+        f.write(json_dumps(str(key)))
+        f.write(':')
+        json_dump(value, f)
+    f.write('}')
+
+
+def command_bin_index(parser, args):
+    if not os.path.isdir(args.root):
+        parser.error(f"directory not found: {args.root}")
+    index_path = args.index or BinIndex.default_path(args.root)
+    btype_version = PatchVersion(args.patch_version if args.patch_version else "main").as_int()
+
+    index = None
+    if not args.full and os.path.isfile(index_path):
+        try:
+            index = BinIndex.load(index_path, args.root)
+        except ValueError as e:
+            cdtb.logger.warning(f"rebuild invalid bin index {index_path}: {e}")
+        if index is not None and index.btype_version != btype_version:
+            index = None  # parsed with different types, rebuild it
+    if index is None:
+        index = BinIndex(args.root, btype_version)
+    index.update()
+    index.save(index_path)
+
+
+def command_bin_query(parser, args):
+    index_path = args.index or BinIndex.default_path(args.root)
+    if not os.path.isfile(index_path):
+        parser.error(f"bin index not found, create it with 'bin-index': {index_path}")
+    try:
+        index = BinIndex.load(index_path, args.root)
+    except ValueError as e:
+        parser.error(f"invalid bin index, rebuild it with 'bin-index': {e}")
+
+    types = [parse_binhash(s) for s in args.type] if args.type else None
+    paths = [parse_binhash(s) for s in args.path] if args.path else None
+    field = [parse_binhash(s) for s in args.field.split('.')] if args.field else None
 
-    with open(args.bin, 'rb') as f:
-        binfile = BinFile(f, btype_version=parsed_version)
-    if args.json:
-        json_dump(binfile.to_serializable(), sys.stdout)
+    try:
+        for ientry, entry in index.read_entries(index.find(types=types, paths=paths)):
+            if field is None:
+                value = entry.to_serializable()
+            else:
+                value = entry.get_path(*field)
+                if value is None:
+                    continue
+                value = value_to_serializable(value)
+            result = {
+                "file": ientry.file,
+                "path": entry.path.to_serializable(),
+                "type": entry.type.to_serializable(),
+                "value": value,
+            }
+            print(json_dumps(result))
+    except StaleBinIndexError as e:
+        parser.error(f"outdated bin index, update it with 'bin-index': {e}")
+
+
+def command_bin_diff(parser, args):
+    def btype_version(patch_version):
+        return PatchVersion(patch_version or args.patch_version or "main").as_int()
+    old_btype_version = btype_version(args.old_patch_version)
+    new_btype_version = btype_version(args.new_patch_version)
+    if os.path.isdir(args.old) and os.path.isdir(args.new):
+        changes = diff_bin_dirs(args.old, args.new, old_btype_version, new_btype_version)
+    elif os.path.isfile(args.old) and os.path.isfile(args.new):
+        changes = diff_bin_files(args.old, args.new, old_btype_version, new_btype_version)
     else:
-        binfile.dump(sys.stdout)
+        parser.error("arguments must be two BIN files or two directories")
+
+    for change in changes:
+        print(json_dumps(change.to_serializable()))
+
+
+def command_bin_columns(parser, args):
+    if not os.path.isfile(args.bin):
+        parser.error(f"BIN file not found: {args.bin}")
+    btype_version = PatchVersion(args.patch_version if args.patch_version else "main").as_int()
+
+    os.makedirs(args.output, exist_ok=True)
+    with LazyBinFile(args.bin, btype_version=btype_version) as binfile:
+        for s in args.type:
+            htype = parse_binhash(s)
+            entries = (binfile.read_entry(h) for h in binfile.entry_headers if h.type.h == htype)
+            name = str(BinTypeName(htype)).strip('{}')
+            path = write_columns(entries_to_columns(entries), os.path.join(args.output, name), args.format)
+            print(path)
 
 
 def create_parser():
@@ -354,6 +535,8 @@ def create_parser():
               CDTB_STORAGE     default `--storage` value
               CDTB_EXPORT      default 'export --output` value
               CDTB_HASHES_DIR  path to directory with hash files
+              CDTB_BIN_CACHE   path to a cache directory for parsed BIN files
+              CDTB_BIN_CACHE_SIZE  maximum size of BIN cache in MB (default: 4096)
               CDRAGON_DATA               path to `Data` repository, for hash files
 
         """),
@@ -383,9 +566,22 @@ def create_parser():
 
     subparser = subparsers.add_parser('download', parents=[component_parser],
                                       help="download components to the storage")
+    subparser.add_argument('--delta-from', metavar='COMPONENT',
+                           help="previous component from which to reuse unchanged files (patcher storage only)")
+    subparser.add_argument('--stream', action='store_true',
+                           help="extract files on the fly, don't store bundles (patcher storage only)")
     subparser.add_argument('component', nargs='+',
                            help="components to download")
 
+    subparser = subparsers.add_parser('storage-gc', parents=[storage_parser],
+                                      help="remove old releases and unused files from a patcher storage")
+    subparser.add_argument('-k', '--keep', type=int, required=True,
+                           help="number of releases to keep, for each patchline")
+    subparser.add_argument('--grace-period', type=float, default=24,
+                           help="don't remove files modified less than given hours ago (default: %(default)s)")
+    subparser.add_argument('-n', '--dry-run', action='store_true',
+                           help="only print files that would be removed")
+
     subparser = subparsers.add_parser('files', parents=[component_parser],
                                       help="list files of a component")
     subparser.add_argument('-r', '--relative', action='store_true',
@@ -459,6 +655,13 @@ def create_parser():
                            help="if a patch is not provided, update all exported patches starting from this one")
     subparser.add_argument('--lazy', action='store_true',
                            help="don't overwrite files, assume they are already correctly extracted")
+    subparser.add_argument('-j', '--processes', type=int, default=1,
+                           help="number of processes used to convert files (default: %(default)s);"
+                           " each process loads its own copy of hash files")
+    subparser.add_argument('--skn-glb', action='store_true',
+                           help="also convert SKN meshes to binary glTF (.glb)")
+    subparser.add_argument('--columnar', action='store_true',
+                           help="also export columnar data files of BIN entries")
     subparser.add_argument('patch', nargs='?',
                            help="patch version to export or 'latest', can be omitted to update all exported patches")
 
@@ -471,15 +674,73 @@ def create_parser():
                            help="extract to JSON")
     subparser.add_argument('-V', '--patch-version', default=None,
                            help="patch version this BIN file belongs to in the format XX.YY (default: latest patch)")
+    subparser.add_argument('-t', '--type', action='append',
+                           help="dump only entries of given type, name or `{hash}` (can be repeated)")
+    subparser.add_argument('-p', '--path', action='append',
+                           help="dump only entries with given path, name or `{hash}` (can be repeated)")
+    subparser.add_argument('-f', '--field',
+                           help="dump only given field, as dot-separated field names (e.g. `a.b.c`)")
     subparser.add_argument('bin',
                            help="BIN file to extract")
 
+    subparser = subparsers.add_parser('bin-index',
+                                      help="index entries of all BIN files in a directory")
+    subparser.add_argument('-i', '--index',
+                           help="index file (default: `cdragon/bins.index` in the directory)")
+    subparser.add_argument('-V', '--patch-version', default=None,
+                           help="patch version of BIN files in the format XX.YY (default: latest patch)")
+    subparser.add_argument('--full', action='store_true',
+                           help="rescan all files, don't update an existing index")
+    subparser.add_argument('root',
+                           help="directory with BIN files (export or extracted files)")
+
+    subparser = subparsers.add_parser('bin-query',
+                                      help="output indexed BIN entries as JSON, one entry per line")
+    subparser.add_argument('-i', '--index',
+                           help="index file (default: `cdragon/bins.index` in the directory)")
+    subparser.add_argument('-t', '--type', action='append',
+                           help="select entries of given type, name or `{hash}` (can be repeated)")
+    subparser.add_argument('-p', '--path', action='append',
+                           help="select entries with given path, name or `{hash}` (can be repeated)")
+    subparser.add_argument('-f', '--field',
+                           help="output only given field, as dot-separated field names (e.g. `a.b.c`)")
+    subparser.add_argument('root',
+                           help="indexed directory")
+
+    subparser = subparsers.add_parser('bin-diff',
+                                      help="output changed BIN entries as JSON, one entry per line")
+    subparser.add_argument('-V', '--patch-version', default=None,
+                           help="patch version of BIN files in the format XX.YY (default: latest patch)")
+    subparser.add_argument('--old-patch-version', default=None,
+                           help="patch version of old BIN files (default: --patch-version)")
+    subparser.add_argument('--new-patch-version', default=None,
+                           help="patch version of new BIN files (default: --patch-version)")
+    subparser.add_argument('old',
+                           help="old BIN file or directory")
+    subparser.add_argument('new',
+                           help="new BIN file or directory")
+
+    subparser = subparsers.add_parser('bin-columns',
+                                      help="write BIN entries of given types to columnar files (Parquet, Arrow or NumPy)")
+    subparser.add_argument('-o', '--output', default='.',
+                           help="output directory, one file is written per type (default: current directory)")
+    subparser.add_argument('-t', '--type', action='append', required=True,
+                           help="type of entries to write, name or `{hash}` (can be repeated)")
+    subparser.add_argument('-f', '--format', choices=('parquet', 'arrow', 'npz'),
+                           help="output format (default: Parquet or Arrow if pyarrow is available, NumPy otherwise)")
+    subparser.add_argument('-V', '--patch-version', default=None,
+                           help="patch version this BIN file belongs to in the format XX.YY (default: latest patch)")
+    subparser.add_argument('bin',
+                           help="BIN file to read")
+
     # skn files commands
 
     subparser = subparsers.add_parser('skn-extract',
                                       help="extract an SKN file to a directory")
     subparser.add_argument('-o', '--output',
-                           help="output directory")
+                           help="output directory for OBJ files, output file for glTF")
+    subparser.add_argument('-f', '--format', choices=('obj', 'glb'), default='obj',
+                           help="output format: one OBJ file per mesh, or a single binary glTF file (default: %(default)s)")
     subparser.add_argument('skn',
                            help="SKN file to extract")
 
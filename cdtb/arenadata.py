@@ -1,8 +1,8 @@
 import os
 import copy
 from .storage import PatchVersion
-from .binfile import BinFile
-from .rstfile import RstFile
+from .bincache import load_binfile
+from .tftdata import load_translations, template_translations
 from .tools import convert_cdragon_path, json_dump, stringtable_paths
 
 
@@ -15,7 +15,7 @@ class ArenaTransformer:
         """Parse bin data into template data"""
         map30_file = os.path.join(self.input_dir, "data", "maps", "shipping", "map30", "map30.bin")
 
-        map30 = BinFile(map30_file)
+        map30 = load_binfile(map30_file)
 
         augments = self.parse_augments(map30)
 
@@ -23,11 +23,14 @@ class ArenaTransformer:
             "augments": augments,
         }
 
-    def export(self, output, langs=None):
+    def export(self, output, langs=None, rst_store=None):
         """Export Arena data for given languages
 
         By default (`langs` is `None`), export all available languages.
         Otherwise, export for given `xx_yy` language codes.
+
+        If set, `rst_store` is a `RstStore` of LoL stringtables used for
+        translations.
         """
 
         stringtables = stringtable_paths(self.input_dir, "lol")
@@ -37,9 +40,12 @@ class ArenaTransformer:
         os.makedirs(output, exist_ok=True)
 
         template = self.build_template()
+        translations = template_translations(template, langs, rst_store)
         for lang in langs:
             instance = copy.deepcopy(template)
-            replacements = RstFile(stringtables[lang], self.game_version)
+            replacements = translations.get(lang)
+            if replacements is None:
+                replacements = load_translations(stringtables[lang], self.game_version)
 
             def replace_in_data(entry):
                 for key in ("name", "desc", "tooltip"):
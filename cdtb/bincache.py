@@ -0,0 +1,298 @@
+import os
+import sys
+import marshal
+import logging
+from io import BytesIO
+from typing import Optional, Union
+from xxhash import xxh3_128_hexdigest
+
+from .binfile import (
+    BinFile,
+    BinReader,
+    BinType,
+    BinEntry,
+    BinEntryPath,
+    BinTypeName,
+    BinPtchEntry,
+    BinStruct,
+    BinEmbedded,
+    BinNested,
+    BinHashValue,
+    BinPathValue,
+    BinBasicField,
+    BinContainerField,
+    BinStructField,
+    BinEmbeddedField,
+    BinOptionField,
+    BinMapField,
+    BinNestedField,
+)
+from .tools import write_file_or_remove
+
+logger = logging.getLogger(__name__)
+
+
+class BinFileCache:
+    """Persistent cache of parsed bin files
+
+    Parsed files are identified by a hash of the bin data and the
+    `btype_version` used to parse them. They are stored as trees of builtin
+    values serialized with `marshal`, whose format depends on the Python
+    version. Fields of each entry are serialized
+    separately and only decoded when accessed: loading a cached file only
+    creates its entries, which is much faster than parsing bin data.
+
+    Least recently used files are removed when the total size of the cache
+    exceeds `max_size` (in bytes). Cache files can be shared between
+    processes. Failing to read or write cache files is not an error.
+    """
+
+    # to update when the serialization format changes
+    FORMAT_VERSION = 1
+    DEFAULT_MAX_SIZE = 4 * 1024**3
+    # marshal data is only compatible with the same Python version
+    MARSHAL_VERSION = f"{marshal.version}.{sys.version_info[0]}.{sys.version_info[1]}"
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._total_size = None  # computed on first write
+
+    def cache_path(self, data: bytes, btype_version) -> str:
+        """Return the path of the cache file for given bin data"""
+        key = f"{xxh3_128_hexdigest(data)}-{btype_version}-{self.FORMAT_VERSION}-{self.MARSHAL_VERSION}"
+        return os.path.join(self.path, key[:2], f"{key}.bincache")
+
+    def load(self, data: bytes, btype_version=None) -> BinFile:
+        """Return a parsed bin file, from the cache if available"""
+
+        # use the actual version in the key, as the parser does
+        btype_version = btype_version or BinReader.DEFAULT_BTYPE_VERSION
+        path = self.cache_path(data, btype_version)
+        try:
+            with open(path, 'rb') as f:
+                binfile = _decode_binfile(marshal.load(f))
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"cannot read bin cache file {path}: {e}")
+        except (EOFError, ValueError, TypeError, KeyError):
+            logger.warning(f"remove invalid bin cache file: {path}")
+            self._remove(path)
+        else:
+            try:
+                os.utime(path)  # update LRU information
+            except OSError:
+                pass  # removed by another process
+            return binfile
+
+        binfile = BinFile(BytesIO(data), btype_version=btype_version)
+        try:
+            self._store(path, marshal.dumps(_encode_binfile(binfile)))
+        except OSError as e:
+            logger.warning(f"cannot write bin cache file {path}: {e}")
+        return binfile
+
+    def _store(self, path, data):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with write_file_or_remove(tmp_path) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        if self._total_size is None:
+            self._total_size = sum(size for _, _, size in self._iter_cache_files())
+        else:
+            self._total_size += len(data)
+        if self._total_size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Remove least recently used files to reduce size below `max_size`"""
+
+        # remove more than needed, to not evict on each new file
+        target_size = self.max_size * 0.9
+        files = sorted(self._iter_cache_files())
+        total_size = sum(size for _, _, size in files)
+        logger.debug(f"evict files from bin cache (size: {total_size})")
+        for _, path, size in files:
+            if total_size <= target_size:
+                break
+            self._remove(path)
+            total_size -= size
+        self._total_size = total_size
+
+    def _iter_cache_files(self):
+        """Generate `(mtime, path, size)` for all cache files"""
+        if not os.path.isdir(self.path):
+            return
+        with os.scandir(self.path) as it_subdirs:
+            for subdir in it_subdirs:
+                if not subdir.is_dir():
+                    continue
+                with os.scandir(subdir.path) as it_files:
+                    for entry in it_files:
+                        if not entry.name.endswith('.bincache'):
+                            continue
+                        try:
+                            st = entry.stat()
+                        except FileNotFoundError:
+                            continue  # removed by another process
+                        yield st.st_mtime, entry.path, st.st_size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # removed by another process, or not removable
+
+
+def default_bin_cache() -> Optional[BinFileCache]:
+    """Return the cache configured from the environment, None if not set
+
+    The cache is enabled by setting `CDTB_BIN_CACHE` to the cache directory.
+    Its maximum size can be set in megabytes with `CDTB_BIN_CACHE_SIZE`.
+    """
+    global _default_bin_cache
+    if _default_bin_cache is None:
+        path = os.environ.get('CDTB_BIN_CACHE')
+        if not path:
+            return None
+        size = os.environ.get('CDTB_BIN_CACHE_SIZE')
+        max_size = int(size) * 1024**2 if size else BinFileCache.DEFAULT_MAX_SIZE
+        _default_bin_cache = BinFileCache(path, max_size)
+    return _default_bin_cache
+
+_default_bin_cache = None
+
+
+def load_binfile(path_or_data: Union[str, bytes], btype_version=None, use_numpy=False) -> BinFile:
+    """Parse a bin file from a path or its data, use the default cache if enabled
+
+    Files parsed with `use_numpy` are not cached.
+    """
+
+    cache = None if use_numpy else default_bin_cache()
+    if cache is None:
+        if isinstance(path_or_data, bytes):
+            return BinFile(BytesIO(path_or_data), btype_version=btype_version, use_numpy=use_numpy)
+        with open(path_or_data, 'rb') as f:
+            return BinFile(f, btype_version=btype_version, use_numpy=use_numpy)
+
+    if not isinstance(path_or_data, bytes):
+        with open(path_or_data, 'rb') as f:
+            path_or_data = f.read()
+    return cache.load(path_or_data, btype_version)
+
+
+# Serialization of parsed bin files to builtin types
+#
+# Field are serialized to tuples, starting with their name hash and type.
+# Values of fields are serialized according to their type.
+# Fields of each entry are marshaled separately, to be decoded lazily.
+
+_NESTED_FIELD = -1  # pseudo field type of `BinNestedField`
+_BIN_TYPES = {int(t): t for t in BinType}
+
+class _CachedBinEntry(BinEntry):
+    """Bin entry whose fields are decoded on first access"""
+
+    __slots__ = ('_fields_data',)
+
+    def __init__(self, hpath, htype, fields_data):
+        self.path = BinEntryPath(hpath)
+        self.type = BinTypeName(htype)
+        self._fields_data = fields_data
+
+    def __getattr__(self, name):
+        # only called when the attribute is not set
+        if name == 'fields':
+            self.fields = _decode_fields(marshal.loads(self._fields_data))
+            self._fields_data = None
+            return self.fields
+        raise AttributeError(name)
+
+def _encode_binfile(binfile):
+    entries = [(entry.type.h, entry.path.h, marshal.dumps(_encode_fields(entry.fields))) for entry in binfile.entries]
+    if binfile.patch_entries is None:
+        patch_entries = None
+    else:
+        patch_entries = [(entry.path.h, _encode_fields(entry.value.fields)) for entry in binfile.patch_entries]
+    return (binfile.is_patch, binfile.version, binfile.linked_files, entries, patch_entries)
+
+def _decode_binfile(tree):
+    is_patch, version, linked_files, entries, patch_entries = tree
+    entries = [_CachedBinEntry(hpath, htype, fields_data) for htype, hpath, fields_data in entries]
+    if patch_entries is not None:
+        patch_entries = [BinPtchEntry(hpath, BinNested(_decode_fields(fields))) for hpath, fields in patch_entries]
+    return BinFile._create(is_patch, version, linked_files, entries, patch_entries)
+
+def _encode_fields(fields):
+    return [_encode_field(field) for field in fields]
+
+def _decode_fields(fields):
+    return [_decode_field(field) for field in fields]
+
+def _encode_field(field):
+    hname = field.name.h
+    if isinstance(field, BinBasicField):
+        return (hname, int(field.type), _encode_value(field.type, field.value))
+    elif isinstance(field, BinContainerField):
+        return (hname, int(BinType.CONTAINER), int(field.type), [_encode_value(field.type, v) for v in field.value])
+    elif isinstance(field, BinStructField):
+        return (hname, int(BinType.STRUCT), _encode_value(BinType.STRUCT, field.value))
+    elif isinstance(field, BinEmbeddedField):
+        return (hname, int(BinType.EMBEDDED), _encode_value(BinType.EMBEDDED, field.value))
+    elif isinstance(field, BinOptionField):
+        value = None if field.value is None else _encode_value(field.vtype, field.value)
+        return (hname, int(BinType.OPTION), int(field.vtype), value)
+    elif isinstance(field, BinMapField):
+        values = [(_encode_value(field.ktype, k), _encode_value(field.vtype, v)) for k, v in field.value.items()]
+        return (hname, int(BinType.MAP), int(field.ktype), int(field.vtype), values)
+    elif isinstance(field, BinNestedField):
+        return (hname, _NESTED_FIELD, _encode_fields(field.value.fields))
+    raise TypeError(f"unexpected bin field type: {type(field)}")
+
+def _decode_field(field):
+    hname, ftype, *args = field
+    if ftype == _NESTED_FIELD:
+        return BinNestedField(hname, BinNested(_decode_fields(args[0])))
+    ftype = _BIN_TYPES[ftype]
+    if ftype == BinType.CONTAINER:
+        vtype, values = args
+        vtype = _BIN_TYPES[vtype]
+        return BinContainerField(hname, vtype, [_decode_value(vtype, v) for v in values])
+    elif ftype == BinType.STRUCT:
+        return BinStructField(hname, _decode_value(ftype, args[0]))
+    elif ftype == BinType.EMBEDDED:
+        return BinEmbeddedField(hname, _decode_value(ftype, args[0]))
+    elif ftype == BinType.OPTION:
+        vtype, value = args
+        vtype = _BIN_TYPES[vtype]
+        return BinOptionField(hname, vtype, None if value is None else _decode_value(vtype, value))
+    elif ftype == BinType.MAP:
+        ktype, vtype, values = args
+        ktype, vtype = _BIN_TYPES[ktype], _BIN_TYPES[vtype]
+        return BinMapField(hname, ktype, vtype, {_decode_value(ktype, k): _decode_value(vtype, v) for k, v in values})
+    else:
+        return BinBasicField(hname, ftype, _decode_value(ftype, args[0]))
+
+def _encode_value(vtype, value):
+    if vtype in (BinType.HASH, BinType.LINK, BinType.PATH):
+        return value.h
+    elif vtype in (BinType.STRUCT, BinType.EMBEDDED):
+        return (value.type.h, _encode_fields(value.fields))
+    return value
+
+def _decode_value(vtype, value):
+    if vtype == BinType.HASH:
+        return BinHashValue(value)
+    elif vtype == BinType.LINK:
+        return BinEntryPath(value)
+    elif vtype == BinType.PATH:
+        return BinPathValue(value)
+    elif vtype == BinType.STRUCT:
+        return BinStruct(value[0], _decode_fields(value[1]))
+    elif vtype == BinType.EMBEDDED:
+        return BinEmbedded(value[0], _decode_fields(value[1]))
+    return value
@@ -0,0 +1,164 @@
+import os
+import struct
+import logging
+from typing import Generator, Optional
+from xxhash import xxh3_64_intdigest
+
+from .binfile import BinEntry, LazyBinFile
+from .binindex import BinIndex
+
+logger = logging.getLogger(__name__)
+
+
+class BinEntryChange:
+    """Change of a bin entry between two versions of a bin file
+
+    `old` and `new` are the decoded entries, `None` for added and removed entries.
+    """
+
+    ADDED = 'added'
+    REMOVED = 'removed'
+    CHANGED = 'changed'
+
+    def __init__(self, file, old: Optional[BinEntry], new: Optional[BinEntry]):
+        self.file = file  # relative path of the bin file, None when diffing files
+        self.old = old
+        self.new = new
+        if old is None:
+            self.status = self.ADDED
+        elif new is None:
+            self.status = self.REMOVED
+        else:
+            self.status = self.CHANGED
+
+    @property
+    def entry(self) -> BinEntry:
+        """Return the most recent entry"""
+        return self.old if self.new is None else self.new
+
+    def __repr__(self):
+        return f"<BinEntryChange {self.status} {self.entry.path!r}>"
+
+    def field_changes(self):
+        """Return a list of `(field_path, old, new)` of changed fields
+
+        Values are serializable values. `field_path` is a tuple of field names.
+        Missing values are set to `MISSING`.
+        """
+        if self.status != self.CHANGED:
+            return []
+        return list(_diff_values(self.old.to_serializable(), self.new.to_serializable()))
+
+    def to_serializable(self):
+        entry = self.entry
+        serialized = {
+            "status": self.status,
+            "path": entry.path.to_serializable(),
+            "type": entry.type.to_serializable(),
+        }
+        if self.file is not None:
+            serialized["file"] = self.file
+        if self.status == self.ADDED:
+            serialized["value"] = entry.to_serializable()
+        elif self.status == self.CHANGED:
+            changes = []
+            for path, old, new in self.field_changes():
+                change = {"field": '.'.join(path)}
+                if old is not MISSING:
+                    change["old"] = old
+                if new is not MISSING:
+                    change["new"] = new
+                changes.append(change)
+            serialized["changes"] = changes
+        return serialized
+
+
+class _Missing:
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = _Missing()
+
+def _diff_values(old, new, path=()):
+    """Generate `(field_path, old, new)` for differences between serializable values
+
+    Dicts (structs, maps) are compared recursively, other values as a whole.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, vold in old.items():
+            yield from _diff_values(vold, new.get(key, MISSING), path + (str(key),))
+        for key, vnew in new.items():
+            if key not in old:
+                yield path + (str(key),), MISSING, vnew
+    elif old != new:
+        yield path, old, new
+
+
+def _entry_digests(binfile: LazyBinFile):
+    """Return a map of entry digests, indexed by entry path hash"""
+    return {h.path.h: (h, xxh3_64_intdigest(binfile.read_entry_data(h))) for h in binfile.entry_headers}
+
+def diff_bin_files(old_path, new_path, old_btype_version=None, new_btype_version=None, file=None) -> Generator[BinEntryChange, None, None]:
+    """Compare entries of two bin files
+
+    Each file is parsed using its own `btype_version` (see `BinReader`).
+    Raw data of entries is compared first. Only entries whose data differ are
+    decoded, or all entries if files are parsed with different versions.
+    Patch entries are ignored.
+    `file` is set on changes, to identify compared files.
+    """
+
+    with LazyBinFile(old_path, btype_version=old_btype_version) as old_binfile, \
+         LazyBinFile(new_path, btype_version=new_btype_version) as new_binfile:
+        # same data may be decoded differently
+        same_format = old_binfile.reader.btype_version == new_binfile.reader.btype_version
+        old_digests = _entry_digests(old_binfile)
+        new_digests = _entry_digests(new_binfile)
+        for hpath, (old_header, old_digest) in old_digests.items():
+            if hpath not in new_digests:
+                yield BinEntryChange(file, old_binfile.read_entry(old_header), None)
+                continue
+            new_header, new_digest = new_digests[hpath]
+            if old_digest != new_digest or not same_format:
+                change = BinEntryChange(file, old_binfile.read_entry(old_header), new_binfile.read_entry(new_header))
+                # entries may only differ by their encoding
+                if change.old.type != change.new.type or change.field_changes():
+                    yield change
+        for hpath, (new_header, _) in new_digests.items():
+            if hpath not in old_digests:
+                yield BinEntryChange(file, None, new_binfile.read_entry(new_header))
+
+
+def _all_entries_changes(path, file, btype_version, added):
+    with LazyBinFile(path, btype_version=btype_version) as binfile:
+        for header in binfile.entry_headers:
+            entry = binfile.read_entry(header)
+            yield BinEntryChange(file, None, entry) if added else BinEntryChange(file, entry, None)
+
+def diff_bin_dirs(old_root, new_root, old_btype_version=None, new_btype_version=None) -> Generator[BinEntryChange, None, None]:
+    """Compare entries of all bin files under two directories
+
+    Files are matched by their path, relative to the directories.
+    Entries of added and removed files are reported as added or removed.
+    """
+
+    old_files = set(BinIndex(old_root).walk_bin_files())
+    new_files = set(BinIndex(new_root).walk_bin_files())
+    for file in sorted(old_files | new_files):
+        old_path = os.path.join(old_root, file)
+        new_path = os.path.join(new_root, file)
+        if file not in new_files:
+            changes = _all_entries_changes(old_path, file, old_btype_version, False)
+        elif file not in old_files:
+            changes = _all_entries_changes(new_path, file, new_btype_version, True)
+        elif os.path.samefile(old_path, new_path) and old_btype_version == new_btype_version:
+            continue  # exports symlink files unchanged from previous patch
+        else:
+            logger.debug(f"compare bin file {file}")
+            changes = diff_bin_files(old_path, new_path, old_btype_version, new_btype_version, file=file)
+        try:
+            changes = list(changes)
+        except (ValueError, AssertionError, struct.error) as e:
+            logger.warning(f"cannot compare bin file '{file}': {e}")
+            continue
+        yield from changes
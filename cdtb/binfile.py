@@ -1,16 +1,36 @@
 from enum import IntEnum
 import struct
+import numpy as np
 from xxhash import xxh64_intdigest
 from .hashes import HashFile, default_hash_dir, hashfile_game
 
 
-def _repr_indent(v):
-    return repr(v).replace('\n', '\n  ')
+# Representation of bin values is written by chunks, using a `write()` method.
+# This allows to output large values without building huge strings.
+# `indent` is the indentation of the current line.
 
-def _repr_indent_list(values):
-    if not values:
-        return '[]'
-    return "[\n%s]" % ''.join(f"  {_repr_indent(v)}\n" for v in values)
+def _write_repr(write, v, indent):
+    if isinstance(v, (BinObjectWithFields, BinField, BinPtchEntry)):
+        v._write_repr(write, indent)
+    else:
+        write(repr(v).replace('\n', '\n' + indent))
+
+def _write_repr_list(write, values, indent):
+    if len(values) == 0:
+        write('[]')
+        return
+    write('[\n')
+    subindent = indent + '  '
+    for v in values:
+        write(subindent)
+        _write_repr(write, v, subindent)
+        write('\n')
+    write(indent + ']')
+
+def _repr_with_writer(self):
+    chunks = []
+    self._write_repr(chunks.append, '')
+    return ''.join(chunks)
 
 
 hashfile_binentries = HashFile(default_hash_dir / "hashes.binentries.txt", hash_size=8)
@@ -32,6 +52,7 @@ def compute_binhash(s):
 class BinHashBase:
     """Base class for hashed value"""
 
+    __slots__ = ('h', 's')
     hashfile = None  # to be defined in subclasses
 
     def __init__(self, h):
@@ -67,9 +88,36 @@ class BinHashBase:
     def hex(self):
         return f"{self.h:08x}"
 
+class _InternedBinHash(BinHashBase):
+    """Base class for hashed values whose instances are shared
+
+    Field and type names are repeated in a lot of bin values. Sharing them
+    greatly reduces the number of objects, and memory use.
+    """
+
+    __slots__ = ()
+    _instances = None  # {hash: instance}, to be defined in subclasses
+
+    def __new__(cls, h):
+        try:
+            return cls._instances[h]
+        except KeyError:
+            self = super().__new__(cls)
+            BinHashBase.__init__(self, h)
+            cls._instances[h] = self
+            return self
+
+    def __init__(self, h):
+        pass  # initialized by __new__
+
+    def __reduce__(self):
+        # unpickled and copied values are interned too
+        return (self.__class__, (self.h,))
+
 class BinHashValue(BinHashBase):
     """Hashed name in bin files (hash type)"""
 
+    __slots__ = ()
     hashfile = hashfile_binhashes
 
     def __repr__(self):
@@ -80,6 +128,7 @@ class BinHashValue(BinHashBase):
 class BinEntryPath(BinHashBase):
     """Path of a bin entry (top level element)"""
 
+    __slots__ = ()
     hashfile = hashfile_binentries
 
     def __repr__(self):
@@ -87,19 +136,24 @@ class BinEntryPath(BinHashBase):
             return repr(self.s)
         return f"{{{self.hex()}}}"
 
-class BinFieldName(BinHashBase):
+class BinFieldName(_InternedBinHash):
     """Name of a struct field"""
 
+    __slots__ = ()
     hashfile = hashfile_binfields
+    _instances = {}
 
-class BinTypeName(BinHashBase):
+class BinTypeName(_InternedBinHash):
     """Name of a type"""
 
+    __slots__ = ()
     hashfile = hashfile_bintypes
+    _instances = {}
 
 class BinPathValue(BinHashBase):
     """Hashed WAD path in bin files"""
 
+    __slots__ = ()
     hashfile = hashfile_binpaths
 
     def hex(self):
@@ -123,12 +177,29 @@ def key_to_hash(key):
     else:
         return key
 
+def parse_binhash(s):
+    """Parse a hash from a user string
+
+    Hexadecimal hashes are given as `{xxxxxxxx}` or `0xXXXXXXXX`, other strings
+    are hashed.
+    """
+    if s.startswith('{') and s.endswith('}'):
+        return int(s[1:-1], 16)
+    elif s.startswith('0x'):
+        return int(s[2:], 16)
+    else:
+        return compute_binhash(s)
+
 class BinObjectWithFields:
     """Base class for bin object with fields"""
 
+    __slots__ = ('fields',)
+
     def __init__(self, fields):
         self.fields = fields
 
+    __repr__ = _repr_with_writer
+
     def __getitem__(self, key):
         h = key_to_hash(key)
         for v in self.fields:
@@ -180,6 +251,8 @@ class BinObjectWithFields:
 class BinObjectWithFieldsAndType(BinObjectWithFields):
     """Base class for bin objects with fields and type"""
 
+    __slots__ = ('type',)
+
     def __init__(self, htype, fields):
         super().__init__(fields)
         self.type = BinTypeName(htype)
@@ -224,157 +297,220 @@ class BinType(IntEnum):
 class BinStruct(BinObjectWithFieldsAndType):
     """Structured binary value"""
 
-    def __repr__(self):
-        sfields = _repr_indent_list(self.fields)
-        return f"<STRUCT {self.type!r} {sfields}>"
+    __slots__ = ()
+
+    def _write_repr(self, write, indent):
+        write(f"<STRUCT {self.type!r} ")
+        _write_repr_list(write, self.fields, indent)
+        write('>')
 
 class BinEmbedded(BinObjectWithFieldsAndType):
     """Embedded binary value"""
 
-    def __repr__(self):
-        sfields = _repr_indent_list(self.fields)
-        return f"<EMBEDDED {self.type!r} {sfields}>"
+    __slots__ = ()
+
+    def _write_repr(self, write, indent):
+        write(f"<EMBEDDED {self.type!r} ")
+        _write_repr_list(write, self.fields, indent)
+        write('>')
 
 class BinNested(BinObjectWithFields):
     """Nested binary value"""
 
-    def __repr__(self):
-        sfields = _repr_indent_list(self.fields)
-        return f"<{sfields}>"
+    __slots__ = ()
+
+    def _write_repr(self, write, indent):
+        write('<')
+        _write_repr_list(write, self.fields, indent)
+        write('>')
 
 class BinField:
     """Base class for binary fields
 
     A field is a value (possibly nested) associated to a hash.
     """
+
+    __slots__ = ('name',)
+
     def __init__(self, hname):
         self.name = BinFieldName(hname)
 
+    __repr__ = _repr_with_writer
+
 class BinBasicField(BinField):
     """Binary field for fixed-width, non-nested values"""
 
+    __slots__ = ('type', 'value')
+
     def __init__(self, hname, btype, value):
         super().__init__(hname)
         self.type = btype
         self.value = value
 
-    def __repr__(self):
-        return f"<{self.name!r} {self.type.name} {self.value!r}>"
+    def _write_repr(self, write, indent):
+        write(f"<{self.name!r} {self.type.name} ")
+        _write_repr(write, self.value, indent)
+        write('>')
 
     def to_serializable(self):
         return (self.name.to_serializable(), _to_serializable(self.value))
 
 class BinContainerField(BinField):
+    __slots__ = ('type', 'value')
+
     def __init__(self, hname, btype, values):
         super().__init__(hname)
         self.type = btype
         self.value = values
 
-    def __repr__(self):
-        svalues = _repr_indent_list(self.value)
-        return f"<{self.name!r} CONTAINER({self.type.name}) {svalues}>"
+    def _write_repr(self, write, indent):
+        values = self.value
+        if isinstance(values, np.ndarray):
+            values = _array_to_values(values)
+        write(f"<{self.name!r} CONTAINER({self.type.name}) ")
+        _write_repr_list(write, values, indent)
+        write('>')
 
     def to_serializable(self):
+        if isinstance(self.value, np.ndarray):
+            return (self.name.to_serializable(), self.value.tolist())
         return (self.name.to_serializable(), [_to_serializable(v) for v in self.value])
 
 class BinStructField(BinField):
+    __slots__ = ('value',)
+
     def __init__(self, hname, value):
         super().__init__(hname)
         self.value = value
 
-    def __repr__(self):
-        sfields = _repr_indent_list(self.value.fields)
-        return f"<{self.name!r} STRUCT {self.value.type!r} {sfields}>"
+    def _write_repr(self, write, indent):
+        write(f"<{self.name!r} STRUCT {self.value.type!r} ")
+        _write_repr_list(write, self.value.fields, indent)
+        write('>')
 
     def to_serializable(self):
         return (self.name.to_serializable(), self.value.to_serializable())
 
 class BinEmbeddedField(BinField):
+    __slots__ = ('value',)
+
     def __init__(self, hname, value):
         super().__init__(hname)
         self.value = value
 
-    def __repr__(self):
-        sfields = _repr_indent_list(self.value.fields)
-        return f"<{self.name!r} EMBEDDED {self.value.type!r} {sfields}>"
+    def _write_repr(self, write, indent):
+        write(f"<{self.name!r} EMBEDDED {self.value.type!r} ")
+        _write_repr_list(write, self.value.fields, indent)
+        write('>')
 
     def to_serializable(self):
         return (self.name.to_serializable(), self.value.to_serializable())
 
 class BinOptionField(BinField):
+    __slots__ = ('vtype', 'value')
+
     def __init__(self, hname, vtype, value):
         super().__init__(hname)
         self.vtype = vtype
         self.value = value
 
-    def __repr__(self):
-        svalue = '-' if self.value is None else f'(\n  {_repr_indent(self.value)}\n)'
-        return f"<{self.name!r} OPTION({self.vtype.name}) {svalue}>"
+    def _write_repr(self, write, indent):
+        write(f"<{self.name!r} OPTION({self.vtype.name}) ")
+        if self.value is None:
+            write('-')
+        else:
+            write(f"(\n{indent}  ")
+            _write_repr(write, self.value, indent + '  ')
+            write(f"\n{indent})")
+        write('>')
 
     def to_serializable(self):
         return (self.name.to_serializable(), None if self.value is None else _to_serializable(self.value))
 
 class BinMapField(BinField):
+    __slots__ = ('ktype', 'vtype', 'value')
+
     def __init__(self, hname, ktype, vtype, values):
         super().__init__(hname)
         self.ktype = ktype
         self.vtype = vtype
         self.value = values
 
-    def __repr__(self):
-        svalues = ''.join(f"  {k} => {_repr_indent(v)}\n" for k, v in self.value.items())
-        return f"<{self.name!r} MAP({self.ktype.name},{self.vtype.name}) {{\n{svalues}}}>"
+    def _write_repr(self, write, indent):
+        write(f"<{self.name!r} MAP({self.ktype.name},{self.vtype.name}) {{\n")
+        subindent = indent + '  '
+        for k, v in self.value.items():
+            write(f"{subindent}{k} => ")
+            _write_repr(write, v, subindent)
+            write('\n')
+        write(indent + '}>')
 
     def to_serializable(self):
         return (self.name.to_serializable(), {_to_serializable(k): _to_serializable(v) for k,v in self.value.items()})
 
 class BinNestedField(BinField):
+    __slots__ = ('value',)
+
     def __init__(self, hname, value):
         super().__init__(hname)
         self.value = value
 
-    def __repr__(self):
-        sfields = _repr_indent_list(self.value.fields)
-        return f"<{self.name!r} {sfields}>"
+    def _write_repr(self, write, indent):
+        write(f"<{self.name!r} ")
+        _write_repr_list(write, self.value.fields, indent)
+        write('>')
 
     def to_serializable(self):
         return (self.name.to_serializable(), self.value.to_serializable())
 
 
 class BinPtchEntry:
+    __slots__ = ('path', 'value')
+
     def __init__(self, hpath, value):
         self.path = BinEntryPath(hpath)
         self.value = value
 
-    def __repr__(self):
-        sfields = _repr_indent_list(self.value.fields)
-        return f"<BinPtchEntry {self.path!r} {sfields}>"
+    def _write_repr(self, write, indent):
+        write(f"<BinPtchEntry {self.path!r} ")
+        _write_repr_list(write, self.value.fields, indent)
+        write('>')
+
+    __repr__ = _repr_with_writer
 
     def to_serializable(self):
         return self.value.to_serializable()
 
 class BinEntry(BinObjectWithFieldsAndType):
+    __slots__ = ('path',)
+
     def __init__(self, hpath, htype, fields):
         self.path = BinEntryPath(hpath)
         super().__init__(htype, fields)
 
-    def __repr__(self):
-        sfields = _repr_indent_list(self.fields)
-        return f"<BinEntry {self.path!r} {self.type!r} {sfields}>"
+    def _write_repr(self, write, indent):
+        write(f"<BinEntry {self.path!r} {self.type!r} ")
+        _write_repr_list(write, self.fields, indent)
+        write('>')
+
+def _read_binfile_magic(f):
+    """Read bin file magic code(s), return True for patch files"""
+    magic = f.read(4)
+    is_patch = magic == b'PTCH'
+    if is_patch:
+        patch_header = struct.unpack('<2L', f.read(8))
+        assert patch_header == (1, 0)
+        magic = f.read(4)
+    if magic != b'PROP':
+        raise ValueError("missing magic code")
+    return is_patch
 
 class BinFile:
-    def __init__(self, f, btype_version=None):
+    def __init__(self, f, btype_version=None, use_numpy=False):
         if isinstance(f, str):
             f = open(f, 'rb')
-        magic = f.read(4)
-        self.is_patch = magic == b'PTCH'
-        if self.is_patch:
-            patch_header = struct.unpack('<2L', f.read(8))
-            assert patch_header == (1, 0)
-            magic = f.read(4)
-        if magic != b'PROP':
-            raise ValueError("missing magic code")
-        reader = BinReader(f, btype_version=btype_version)
+        self.is_patch = _read_binfile_magic(f)
+        reader = BinReader(f, btype_version=btype_version, use_numpy=use_numpy)
         self.version, self.linked_files, entry_types = reader.read_binfile_header()
         self.entries = [reader.read_binfile_entry(htype) for htype in entry_types]
         if self.is_patch and self.version >= 3:
@@ -382,6 +518,18 @@ class BinFile:
         else:
             self.patch_entries = None
 
+    @classmethod
+    def _create(cls, is_patch, version, linked_files, entries, patch_entries):
+        """Create a bin file from already parsed data"""
+
+        self = cls.__new__(cls)
+        self.is_patch = is_patch
+        self.version = version
+        self.linked_files = linked_files
+        self.entries = entries
+        self.patch_entries = patch_entries
+        return self
+
     def to_serializable(self):
         serialized = {entry.path.to_serializable(): entry.to_serializable() for entry in self.entries}
         if self.linked_files is not None:
@@ -392,24 +540,89 @@ class BinFile:
 
     def dump(self, f):
         if self.linked_files is not None:
-            print(f"<Linked: {_repr_indent_list(self.linked_files)}>", file=f)
+            dump_linked_files(self.linked_files, f)
         for entry in self.entries:
-            print(entry, file=f)
+            dump_value(entry, f)
         if self.patch_entries is not None:
             for entry in self.patch_entries:
-                print(entry, file=f)
+                dump_value(entry, f)
+
+
+class BinEntryHeader:
+    """Type, path and location of a bin file entry"""
+
+    def __init__(self, htype, hpath, offset, size):
+        self.type = BinTypeName(htype)
+        self.path = BinEntryPath(hpath)
+        self.offset = offset  # offset of the entry in the file
+        self.size = size  # size of the entry data, including its length field
+
+    def __repr__(self):
+        return f"<BinEntryHeader {self.path!r} {self.type!r} {self.offset}+{self.size}>"
+
+class LazyBinFile:
+    """Bin file whose entries are decoded on demand
+
+    Only headers are read when opening the file. Entries are decoded by
+    `read_entry()`, other entries are not parsed at all.
+    The file object must remain open while entries are read.
+    """
+
+    def __init__(self, f, btype_version=None, use_numpy=False):
+        if isinstance(f, str):
+            f = open(f, 'rb')
+        self.f = f
+        self.is_patch = _read_binfile_magic(f)
+        self.reader = BinReader(f, btype_version=btype_version, use_numpy=use_numpy)
+        self.version, self.linked_files, entry_types = self.reader.read_binfile_header()
+        self.entry_headers = [self.reader.read_binfile_entry_header(htype) for htype in entry_types]
+        self._entries_end = f.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def read_entry(self, header: BinEntryHeader) -> 'BinEntry':
+        """Read and decode a single entry"""
+        self.f.seek(header.offset)
+        return self.reader.read_binfile_entry(header.type.h)
+
+    def read_entry_data(self, header: BinEntryHeader) -> bytes:
+        """Read raw data of a single entry"""
+        self.f.seek(header.offset)
+        return self.f.read(header.size)
+
+    def read_patch_entries(self):
+        """Read and decode entries of the patch section, None if there is none"""
+        if not (self.is_patch and self.version >= 3):
+            return None
+        self.f.seek(self._entries_end)
+        return self.reader.read_patch_section()
 
 
 class BinReader:
-    def __init__(self, f, btype_version=None):
+    # version used when `btype_version` is not provided
+    DEFAULT_BTYPE_VERSION = 1008
+
+    def __init__(self, f, btype_version=None, use_numpy=False):
         """
         Initialize a reader for bin files and values
 
         `btype_version` is a workaround to parse bin types differently
         depending on patch version. Value is based on the patch version.
+
+        If `use_numpy` is set, containers of fixed-size numeric values are
+        decoded at once into (read-only) NumPy arrays, instead of lists.
+        Vectors and matrices add dimensions to the array.
         """
         self.f = f
-        self.btype_version = btype_version or 1008
+        self.btype_version = btype_version or self.DEFAULT_BTYPE_VERSION
+        self.use_numpy = use_numpy
 
     def read_fmt(self, fmt):
         length = struct.calcsize(fmt)
@@ -427,6 +640,14 @@ class BinReader:
         entry_types = list(self.read_fmt(f"<{entry_count}L"))
         return version, linked_files, entry_types
 
+    def read_binfile_entry_header(self, htype):
+        """Read the header of a single binfile entry, skip its data"""
+
+        offset = self.f.tell()
+        length, hpath = self.read_fmt('<LL')
+        self.f.seek(offset + 4 + length)
+        return BinEntryHeader(htype, hpath, offset, 4 + length)
+
     def read_binfile_entry(self, htype):
         """Read a single binfile entry"""
 
@@ -555,6 +776,9 @@ class BinReader:
     def read_field_container(self, hname, btype):
         vtype, _, count = self.read_fmt('<BLL')
         vtype = self.parse_bintype(vtype)
+        if self.use_numpy and vtype in self._vtype_to_dtype:
+            dtype = self._vtype_to_dtype[vtype]
+            return BinContainerField(hname, vtype, np.frombuffer(self.f.read(dtype.itemsize * count), dtype))
         return BinContainerField(hname, vtype, [self.read_bvalue(vtype) for _ in range(count)])
 
     def read_field_struct(self, hname, btype):
@@ -614,6 +838,26 @@ class BinReader:
         BinType.FLAG: read_flag,
     }
 
+    # NumPy types of fixed-size numeric values, used for containers
+    _vtype_to_dtype = {
+        BinType.BOOL: np.dtype('?'),
+        BinType.S8: np.dtype('i1'),
+        BinType.U8: np.dtype('u1'),
+        BinType.S16: np.dtype('<i2'),
+        BinType.U16: np.dtype('<u2'),
+        BinType.S32: np.dtype('<i4'),
+        BinType.U32: np.dtype('<u4'),
+        BinType.S64: np.dtype('<i8'),
+        BinType.U64: np.dtype('<u8'),
+        BinType.FLOAT: np.dtype('<f4'),
+        BinType.VEC2_FLOAT: np.dtype(('<f4', (2,))),
+        BinType.VEC3_FLOAT: np.dtype(('<f4', (3,))),
+        BinType.VEC4_FLOAT: np.dtype(('<f4', (4,))),
+        BinType.MATRIX4X4: np.dtype(('<f4', (4, 4))),
+        BinType.RGBA: np.dtype(('u1', (4,))),
+        BinType.FLAG: np.dtype('u1'),
+    }
+
     _vtype_to_field_reader = {
         BinType.EMPTY: read_field_basic,
         BinType.BOOL: read_field_basic,
@@ -645,5 +889,38 @@ class BinReader:
     }
 
 
+def dump_linked_files(linked_files, f):
+    """Write the text representation of a list of linked files"""
+    f.write("<Linked: ")
+    _write_repr_list(f.write, linked_files, '')
+    f.write(">\n")
+
+def dump_value(v, f):
+    """Write the text representation of a bin value, followed by a new line
+
+    Contrary to `repr()`, the representation is written progressively.
+    """
+    _write_repr(f.write, v, '')
+    f.write('\n')
+
 def _to_serializable(v):
     return v.to_serializable() if hasattr(v, 'to_serializable') else v
+
+def _array_to_values(a):
+    """Convert a NumPy array of bin values to a list, as if not decoded with NumPy"""
+    if a.ndim == 1:
+        return a.tolist()
+    elif a.ndim == 2:
+        return [tuple(v) for v in a.tolist()]
+    else:
+        return [tuple(tuple(row) for row in v) for v in a.tolist()]
+
+def value_to_serializable(v):
+    """Convert any bin value (including lists and maps of values) to a serializable value"""
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    elif isinstance(v, list):
+        return [value_to_serializable(x) for x in v]
+    elif isinstance(v, dict):
+        return {_to_serializable(k): value_to_serializable(x) for k, x in v.items()}
+    return _to_serializable(v)
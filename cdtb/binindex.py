@@ -0,0 +1,172 @@
+import os
+import struct
+import logging
+from typing import Dict, Generator, Iterable, Optional, Tuple
+
+from .binfile import BinEntry, BinReader, LazyBinFile
+from .tools import BinaryParser, write_file_or_remove
+
+logger = logging.getLogger(__name__)
+
+
+class StaleBinIndexError(ValueError):
+    """An indexed bin file has been modified or removed since it has been indexed"""
+
+
+class BinIndexEntry:
+    """Location of an indexed bin entry"""
+
+    def __init__(self, file, htype, hpath, offset, size):
+        self.file = file  # relative path of the bin file
+        self.htype = htype
+        self.hpath = hpath
+        self.offset = offset
+        self.size = size
+
+    def __repr__(self):
+        return f"<BinIndexEntry {self.file} {self.hpath:08x} {self.htype:08x}>"
+
+
+class BinIndex:
+    """Index of entries of all bin files under a directory
+
+    The index stores type, path and location of each entry, allowing to find
+    and decode entries without parsing whole bin files.
+    Files are identified by their path, relative to the root directory. File
+    size and modification time are stored to update the index incrementally.
+
+    The index can be used on an export directory or on extracted game files.
+    """
+
+    MAGIC = b'CBIX'
+    VERSION = 1
+
+    def __init__(self, root, btype_version=None):
+        self.root = os.path.normpath(root)
+        self.btype_version = btype_version or BinReader.DEFAULT_BTYPE_VERSION
+        # {relpath: (size, mtime_ns, [(htype, hpath, offset, size), ...])}
+        self.files: Dict[str, Tuple[int, int, list]] = {}
+
+    @staticmethod
+    def default_path(root):
+        """Return the default index path for a root directory"""
+        return os.path.join(root, "cdragon", "bins.index")
+
+    def walk_bin_files(self) -> Generator[str, None, None]:
+        """Generate relative paths of bin files under the root directory"""
+        # follow symlinks: exports symlink directories unchanged from previous patch
+        for dirpath, _, filenames in os.walk(self.root, followlinks=True):
+            reldir = os.path.relpath(dirpath, self.root).replace('\\', '/')
+            for name in filenames:
+                if name.endswith('.bin'):
+                    yield name if reldir == '.' else f"{reldir}/{name}"
+
+    def update(self):
+        """Scan bin files, reuse data of unmodified files
+
+        Return the number of (re)scanned files.
+        """
+
+        logger.info(f"update bin index of {self.root}")
+        files = {}
+        nscanned = 0
+        for path in self.walk_bin_files():
+            try:
+                st = os.stat(os.path.join(self.root, path))
+            except FileNotFoundError:
+                continue  # removed while walking
+            previous = self.files.get(path)
+            if previous is not None and previous[:2] == (st.st_size, st.st_mtime_ns):
+                files[path] = previous
+                continue
+            logger.debug(f"scan bin file {path}")
+            try:
+                with LazyBinFile(os.path.join(self.root, path), btype_version=self.btype_version) as binfile:
+                    headers = [(h.type.h, h.path.h, h.offset, h.size) for h in binfile.entry_headers]
+            except (ValueError, AssertionError, struct.error) as e:
+                logger.warning(f"cannot scan bin file '{path}': {e}")
+                continue
+            files[path] = (st.st_size, st.st_mtime_ns, headers)
+            nscanned += 1
+        self.files = files
+        return nscanned
+
+    def find(self, types: Optional[Iterable[int]] = None, paths: Optional[Iterable[int]] = None) -> Generator[BinIndexEntry, None, None]:
+        """Find entries of given type and path hashes (None to match all)"""
+        if types is not None:
+            types = set(types)
+        if paths is not None:
+            paths = set(paths)
+        for file, (_, _, headers) in self.files.items():
+            for htype, hpath, offset, size in headers:
+                if types is not None and htype not in types:
+                    continue
+                if paths is not None and hpath not in paths:
+                    continue
+                yield BinIndexEntry(file, htype, hpath, offset, size)
+
+    def read_entries(self, entries: Iterable[BinIndexEntry]) -> Generator[Tuple[BinIndexEntry, BinEntry], None, None]:
+        """Decode indexed entries, generate `(index_entry, bin_entry)` pairs
+
+        Entries of a same file should be grouped, to open each file only once.
+        Raise a `StaleBinIndexError` if a file has been modified or removed
+        since it has been indexed.
+        """
+        f = None
+        fpath = None
+        try:
+            for entry in entries:
+                if entry.file != fpath:
+                    if f is not None:
+                        f.close()
+                        f = None
+                    fpath = entry.file
+                    try:
+                        f = open(os.path.join(self.root, fpath), 'rb')
+                    except FileNotFoundError:
+                        raise StaleBinIndexError(f"bin file removed since indexed: {fpath}")
+                    st = os.fstat(f.fileno())
+                    if self.files[fpath][:2] != (st.st_size, st.st_mtime_ns):
+                        raise StaleBinIndexError(f"bin file modified since indexed: {fpath}")
+                    reader = BinReader(f, btype_version=self.btype_version)
+                f.seek(entry.offset)
+                yield entry, reader.read_binfile_entry(entry.htype)
+        finally:
+            if f is not None:
+                f.close()
+
+    def save(self, path):
+        with write_file_or_remove(path) as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack('<LLL', self.VERSION, self.btype_version, len(self.files)))
+            for file, (size, mtime_ns, headers) in self.files.items():
+                encoded = file.encode('utf-8')
+                f.write(struct.pack('<H', len(encoded)))
+                f.write(encoded)
+                f.write(struct.pack('<QQL', size, mtime_ns, len(headers)))
+                f.write(b''.join(struct.pack('<LLLL', *h) for h in headers))
+
+    @classmethod
+    def load(cls, path, root) -> 'BinIndex':
+        """Load an index from a file, for bin files under `root`
+
+        Raise a `ValueError` if the index is invalid.
+        """
+        with open(path, 'rb') as f:
+            parser = BinaryParser(f)
+            if parser.raw(4) != cls.MAGIC:
+                raise ValueError("invalid bin index magic code")
+            try:
+                version, btype_version, nfiles = parser.unpack('<LLL')
+                if version != cls.VERSION:
+                    raise ValueError(f"unsupported bin index version: {version}")
+                self = cls(root, btype_version)
+                for _ in range(nfiles):
+                    n, = parser.unpack('<H')
+                    file = parser.raw(n).decode('utf-8')
+                    size, mtime_ns, nheaders = parser.unpack('<QQL')
+                    headers = list(struct.iter_unpack('<LLLL', parser.raw(16 * nheaders)))
+                    self.files[file] = (size, mtime_ns, headers)
+            except struct.error:
+                raise ValueError("truncated bin index")
+        return self
@@ -0,0 +1,201 @@
+import os
+import json
+import logging
+from typing import Dict, Iterable, List
+import numpy as np
+
+from .binfile import BinEntry, key_to_hash
+from .bincache import load_binfile
+from .tools import write_file_or_remove
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+try:
+    import pyarrow.parquet
+except ImportError:
+    pass  # Parquet support is optional in pyarrow builds
+
+logger = logging.getLogger(__name__)
+
+
+# Entries exported by `export_columnar_data()`, as `(bin file, entry type, table name)`
+COLUMNAR_EXPORTS = [
+    ("data/maps/shipping/map22/map22.bin", "TftItemData", "tft/items"),
+    ("data/maps/shipping/map22/map22.bin", "TftTraitData", "tft/traits"),
+    ("data/maps/shipping/map22/map22.bin", "TftShopData", "tft/shop"),
+    ("data/maps/shipping/map30/map30.bin", 0x6DFAB860, "arena/augments"),
+]
+
+
+def default_columnar_format():
+    """Return the best available format: `parquet`, `arrow` or `npz`
+
+    Parquet and Arrow IPC files require pyarrow.
+    """
+    if pyarrow is None:
+        return 'npz'
+    elif hasattr(pyarrow, 'parquet'):
+        return 'parquet'
+    else:
+        return 'arrow'
+
+
+def entries_to_columns(entries: Iterable[BinEntry]) -> Dict[str, list]:
+    """Flatten bin entries into columns of serializable values
+
+    There is one column per field path. Structs and maps are flattened, their
+    field paths joined with `.` (e.g. `mSpell.mCastTime`).
+    The `__path` column contains entry paths. Values missing from an entry
+    are set to `None`.
+    """
+
+    columns = {"__path": []}
+    nrows = 0
+    for entry in entries:
+        row = {"__path": entry.path.to_serializable()}
+        _flatten_value(row, entry.to_serializable(), None)
+        for name, value in row.items():
+            column = columns.get(name)
+            if column is None:
+                column = columns[name] = [None] * nrows
+            column.append(value)
+        nrows += 1
+        for column in columns.values():
+            if len(column) < nrows:
+                column.append(None)
+    return columns
+
+def _flatten_value(row, value, name):
+    if isinstance(value, dict):
+        for k, v in value.items():
+            _flatten_value(row, v, k if name is None else f"{name}.{k}")
+    else:
+        row[name] = value
+
+
+# Column types, inferred from values
+_BOOL, _INT, _FLOAT, _STRING, _JSON = range(5)
+_INT64_MIN, _INT64_MAX = -2**63, 2**63 - 1
+
+def _column_type(values):
+    """Return the type of a column, lists and mixed types are stored as JSON"""
+    types = set()
+    for v in values:
+        if v is None:
+            continue
+        elif isinstance(v, bool):
+            types.add(_BOOL)
+        elif isinstance(v, int):
+            types.add(_INT if _INT64_MIN <= v <= _INT64_MAX else _JSON)
+        elif isinstance(v, float):
+            types.add(_FLOAT)
+        elif isinstance(v, str):
+            types.add(_STRING)
+        else:
+            types.add(_JSON)
+    if types == {_INT, _FLOAT}:
+        return _FLOAT
+    elif len(types) == 1:
+        return types.pop()
+    elif not types:
+        return _STRING  # no value
+    return _JSON
+
+def _json_values(values):
+    return [None if v is None else json.dumps(v) for v in values]
+
+
+def write_columns(columns: Dict[str, list], path_base, fmt=None) -> str:
+    """Write columns to a table file, return its path
+
+    `path_base` is the path of the output file, without extension.
+    `fmt` is `parquet`, `arrow` or `npz` (default: best available format).
+    """
+
+    if fmt is None:
+        fmt = default_columnar_format()
+    path = f"{path_base}.{fmt}"
+    if fmt == 'npz':
+        arrays = _columns_to_numpy(columns)
+        with write_file_or_remove(path) as f:
+            np.savez_compressed(f, **arrays)
+    elif fmt in ('parquet', 'arrow'):
+        if pyarrow is None:
+            raise ValueError(f"pyarrow is required to write '{fmt}' files")
+        table = _columns_to_arrow(columns)
+        with write_file_or_remove(path) as f:
+            if fmt == 'parquet':
+                pyarrow.parquet.write_table(table, f)
+            else:
+                with pyarrow.ipc.new_file(f, table.schema) as writer:
+                    writer.write_table(table)
+    else:
+        raise ValueError(f"unsupported columnar format: {fmt}")
+    return path
+
+def _columns_to_arrow(columns):
+    arrow_types = {
+        _BOOL: pyarrow.bool_(),
+        _INT: pyarrow.int64(),
+        _FLOAT: pyarrow.float64(),
+        _STRING: pyarrow.string(),
+        _JSON: pyarrow.string(),
+    }
+    arrays = {}
+    for name, values in columns.items():
+        ctype = _column_type(values)
+        if ctype == _JSON:
+            values = _json_values(values)
+        arrays[name] = pyarrow.array(values, type=arrow_types[ctype])
+    return pyarrow.table(arrays)
+
+def _columns_to_numpy(columns):
+    """Convert columns to NumPy arrays
+
+    Missing values are set to `False`, `0`, NaN or an empty string. Columns
+    with missing values get an additional `<name>:valid` boolean column.
+    """
+    numpy_types = {
+        _BOOL: (np.bool_, False),
+        _INT: (np.int64, 0),
+        _FLOAT: (np.float64, np.nan),
+        _STRING: (np.str_, ''),
+        _JSON: (np.str_, ''),
+    }
+    arrays = {}
+    for name, values in columns.items():
+        ctype = _column_type(values)
+        if ctype == _JSON:
+            values = _json_values(values)
+        dtype, default = numpy_types[ctype]
+        arrays[name] = np.array([default if v is None else v for v in values], dtype=dtype)
+        if any(v is None for v in values):
+            arrays[f"{name}:valid"] = np.array([v is not None for v in values], dtype=np.bool_)
+    return arrays
+
+
+def export_columnar_data(input_dir, output, btype_version=None, exports=COLUMNAR_EXPORTS, fmt=None) -> List[str]:
+    """Export bin entries from extracted game files to columnar files
+
+    `exports` is a list of `(bin file, entry type, table name)`; bin files are
+    relative to `input_dir`, tables are written to `output/<table name>`.
+    Missing bin files are skipped. Return the list of written files.
+    """
+
+    written = []
+    binfiles = {}
+    for bin_path, entry_type, name in exports:
+        if bin_path not in binfiles:
+            path = os.path.join(input_dir, bin_path)
+            binfiles[bin_path] = load_binfile(path, btype_version=btype_version) if os.path.isfile(path) else None
+        binfile = binfiles[bin_path]
+        if binfile is None:
+            continue
+        htype = key_to_hash(entry_type)
+        columns = entries_to_columns(entry for entry in binfile.entries if entry.type.h == htype)
+        logger.debug(f"write {len(columns['__path'])} entries of {bin_path} to columnar table {name}")
+        written.append(write_columns(columns, os.path.join(output, name), fmt))
+    return written
@@ -0,0 +1,213 @@
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional, Tuple
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrencyLimiter:
+    """Limit the number of concurrent downloads, adapt it to throughput
+
+    The limit is increased while it improves the overall throughput, and
+    halved on errors or when throughput drops.
+    Throughput is measured over windows of `window` seconds.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=16, window=2.0):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window = window
+        self.active = 0
+        self._cond = threading.Condition()
+        self._window_start = time.monotonic()
+        self._window_bytes = 0
+        self._throughput = None  # throughput of the last window
+
+    def __enter__(self):
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def record(self, nbytes):
+        """Record downloaded bytes"""
+        with self._cond:
+            self._window_bytes += nbytes
+            now = time.monotonic()
+            elapsed = now - self._window_start
+            if elapsed < self.window:
+                return
+            throughput = self._window_bytes / elapsed
+            self._window_start = now
+            self._window_bytes = 0
+            if self._throughput is None or throughput > self._throughput * 1.05:
+                # still improving (or first measure), try more connections
+                if self.active >= self.limit:
+                    self._set_limit(self.limit + 1)
+            elif throughput < self._throughput * 0.5:
+                self._set_limit(self.limit // 2)
+            self._throughput = throughput
+
+    def failure(self):
+        """Record a failed download"""
+        with self._cond:
+            self._set_limit(self.limit // 2)
+
+    def _set_limit(self, limit):
+        limit = max(self.minimum, min(self.maximum, limit))
+        if limit != self.limit:
+            logger.debug(f"set download concurrency to {limit}")
+            self.limit = limit
+            self._cond.notify_all()
+
+
+class Downloader:
+    """Download files to disk, possibly concurrently
+
+    Each worker thread uses its own HTTP session. Data is streamed to a
+    `.part` file, which is renamed once complete and verified.
+    Failed downloads are retried with an exponential backoff, partial files
+    are resumed using range requests.
+    The number of concurrent downloads is adjusted by a `ConcurrencyLimiter`.
+    """
+
+    DOWNLOAD_CHUNK_SIZE = 1024**2
+
+    def __init__(self, max_workers=16, retries=4, backoff=1.0, timeout=60):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.limiter = ConcurrencyLimiter(initial=min(4, max_workers), maximum=max_workers)
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        """HTTP session of the current thread"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
+
+    def download(self, url, path, size=None, verify: Optional[Callable[[str], None]] = None):
+        """Download a file
+
+        If `size` is set, the downloaded size is checked.
+        `verify` is called with the path of the downloaded data, before the
+        file is renamed. It must raise a `ValueError` if data is invalid.
+        """
+
+        part_path = f"{path}.part"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        for attempt in range(self.retries + 1):
+            try:
+                self._fetch(url, part_path, size)
+                if size is not None and os.path.getsize(part_path) != size:
+                    raise ValueError(f"unexpected size for {url}: {os.path.getsize(part_path)} instead of {size}")
+                if verify is not None:
+                    verify(part_path)
+                os.replace(part_path, path)
+                return
+            except ValueError as e:
+                # invalid data, don't resume
+                try:
+                    os.remove(part_path)
+                except OSError:
+                    pass
+                self._retry_or_raise(url, e, attempt)
+            except requests.RequestException as e:
+                self._retry_or_raise(url, e, attempt)
+
+    def download_range(self, url, start, end) -> Optional[bytes]:
+        """Download bytes from `start` to `end` (excluded) of a file
+
+        Return None, without downloading anything, if the server does not
+        support range requests.
+        """
+
+        headers = {"Range": f"bytes={start}-{end-1}"}
+        for attempt in range(self.retries + 1):
+            try:
+                logger.debug(f"download range {start}-{end} of {url}")
+                with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        return None
+                    data = r.content
+                if len(data) != end - start:
+                    raise ValueError(f"unexpected range size for {url}: {len(data)} instead of {end - start}")
+                self.limiter.record(len(data))
+                return data
+            except (ValueError, requests.RequestException) as e:
+                self._retry_or_raise(url, e, attempt)
+
+    def _retry_or_raise(self, url, error, attempt):
+        """Raise `error` if the download should not be retried, wait before retrying otherwise"""
+
+        response = getattr(error, 'response', None)
+        if response is not None and 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise error  # not worth retrying
+        if attempt == self.retries:
+            raise error
+        self.limiter.failure()
+        delay = self.backoff * 2 ** attempt
+        logger.warning(f"download of {url} failed, retry in {delay:.0f}s")
+        time.sleep(delay)
+
+    def _fetch(self, url, part_path, size):
+        """Download data to a partial file, resume it if it exists"""
+
+        pos = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if size is not None and pos >= size:
+            return  # already downloaded (or invalid, size will be checked)
+        headers = {"Range": f"bytes={pos}-"} if pos else {}
+
+        logger.debug(f"download {url}" + (f" (resume at {pos})" if pos else ""))
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code == 416:
+                raise ValueError(f"cannot resume download of {url}")
+            r.raise_for_status()
+            mode = "ab" if r.status_code == 206 else "wb"
+            with open(part_path, mode) as f:
+                for data in r.iter_content(self.DOWNLOAD_CHUNK_SIZE):
+                    f.write(data)
+                    self.limiter.record(len(data))
+
+    def download_many(self, files: Iterable[Tuple[str, str, Optional[int], Optional[Callable[[str], None]]]],
+                      callback: Optional[Callable[[str], None]] = None):
+        """Download files concurrently
+
+        `files` is a list of `(url, path, size, verify)`, see `download()`.
+        Downloads are started in the order of `files`.
+        If set, `callback` is called with the path of each downloaded file,
+        from the downloading thread.
+        Failed downloads don't stop other downloads; the first error is raised
+        at the end.
+        """
+
+        def download(args):
+            with self.limiter:
+                try:
+                    self.download(*args)
+                except Exception as e:
+                    logger.error(f"failed to download {args[0]}: {e}")
+                    return e
+            if callback is not None:
+                callback(args[1])
+            return None
+
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            errors = [e for e in executor.map(download, files) if e is not None]
+        if errors:
+            raise errors[0]
@@ -5,21 +5,24 @@ import shutil
 import struct
 import logging
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait as wait_futures
 from typing import Dict, List
 from PIL import Image
 
 from .storage import PatchVersion
 from .wad import Wad
-from .binfile import BinFile
+from .bincache import load_binfile
 from .sknfile import SknFile
-from .rstfile import RstFile, get_hashfile as get_rsthashfile, key_to_hash as key_to_rsthash
+from .rstfile import RstFile, get_hashfile as get_rsthashfile, load_truncated_hashes
+from .rststore import load_rst_store
 from .tools import (
     BinaryParser,
     convert_cdragon_path,
     json_dump,
     write_file_or_remove,
     write_dir_or_remove,
-    json_dumps
+    json_dumps,
+    stringtable_paths,
 )
 
 logger = logging.getLogger(__name__)
@@ -76,13 +79,27 @@ def reduce_common_paths(paths1, paths2, excludes):
 
 
 class Exporter:
-    """Export files and WADs to a directory"""
+    """Export files and WADs to a directory
 
-    def __init__(self, output: str):
+    Conversions flagged as `cpu_bound` are run in a pool of `processes`
+    worker processes. By default, or if `processes` is 0 or 1, all
+    conversions are run in the current process.
+    Each worker loads its own copy of hash files used by conversions (e.g.
+    for stringtables), so memory use grows with the number of processes.
+    """
+
+    # maximum number of pending conversions per worker process
+    # it bounds the amount of file data waiting to be converted
+    MAX_PENDING_PER_PROCESS = 8
+
+    def __init__(self, output: str, processes=1):
         self.output = os.path.normpath(output)
         self.wads: Dict[str, Wad] = {}  # {export_path: Wad}
         self.plain_files: Dict[str, str] = {}  # {export_path: path}
         self.converters: List[FileConverter] = []
+        self.processes = processes
+        self._pool = None
+        self._pending = {}  # {future: path}
 
 
     def _exported_paths(self):
@@ -210,12 +227,25 @@ class Exporter:
         If overwrite is False, don't extract files that already exist on disk.
         """
 
-        logger.info(f"export plain files ({len(self.plain_files)})")
-        for export_path, source_path in self.plain_files.items():
-            self._export_plain_file(export_path, source_path, overwrite)
-
-        for wad in self.wads.values():
-            self._export_wad(wad, overwrite)
+        if self.processes > 1 and any(converter.cpu_bound for converter in self.converters):
+            self._pool = ProcessPoolExecutor(self.processes)
+        try:
+            logger.info(f"export plain files ({len(self.plain_files)})")
+            for export_path, source_path in self.plain_files.items():
+                self._export_plain_file(export_path, source_path, overwrite)
+
+            for wad in self.wads.values():
+                self._export_wad(wad, overwrite)
+
+            self._wait_pending_conversions(0)
+        finally:
+            if self._pool is not None:
+                # pending conversions are left after an error
+                for future in self._pending:
+                    future.cancel()
+                self._pool.shutdown()
+                self._pool = None
+                self._pending = {}
 
     def clean_output_dir(self, kept_files, kept_symlinks):
         """Remove regular files (or directories) and symlinks from output, except given ones
@@ -272,6 +302,11 @@ class Exporter:
         if not overwrite and converter.converted_paths_exist(self.output, export_path):
             return
 
+        if converter.cpu_bound and self._pool is not None:
+            with open(source_path, 'rb') as fin:
+                self._submit_conversion(converter, fin.read(), export_path)
+            return
+
         try:
             with open(source_path, 'rb') as fin:
                 converter.convert(fin, self.output, export_path)
@@ -295,16 +330,47 @@ class Exporter:
                 if data is None:
                     continue
 
+                if converter.cpu_bound and self._pool is not None:
+                    self._submit_conversion(converter, data, wadfile.path)
+                    continue
+
                 try:
                     converter.convert(BytesIO(data), self.output, wadfile.path)
-                except FileConversionError as e:
-                    logger.warning(f"cannot convert file '{wadfile.path}': {e}")
-                except OSError as e:
-                    # Path components longer than 255 are not supported, ignore such files
-                    if e.errno in (errno.EINVAL, errno.ENAMETOOLONG):
-                        logger.warning(f"ignore file with invalid path: {wadfile.path}")
-                    else:
-                        raise
+                except (FileConversionError, OSError) as e:
+                    self._handle_conversion_error(wadfile.path, e)
+
+    def _submit_conversion(self, converter, data, path):
+        """Convert file data in the process pool"""
+        self._wait_pending_conversions(self.processes * self.MAX_PENDING_PER_PROCESS - 1)
+        future = self._pool.submit(_convert_data, converter, data, self.output, path)
+        self._pending[future] = path
+
+    def _wait_pending_conversions(self, max_pending):
+        """Wait for pool conversions until there are at most `max_pending` ones"""
+        while len(self._pending) > max_pending:
+            done, _ = wait_futures(self._pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = self._pending.pop(future)
+                try:
+                    future.result()
+                except (FileConversionError, OSError) as e:
+                    self._handle_conversion_error(path, e)
+
+    @staticmethod
+    def _handle_conversion_error(path, e):
+        """Log conversion errors that should not abort the export, raise other ones"""
+        if isinstance(e, FileConversionError):
+            logger.warning(f"cannot convert file '{path}': {e}")
+        elif e.errno in (errno.EINVAL, errno.ENAMETOOLONG):
+            # Path components longer than 255 are not supported, ignore such files
+            logger.warning(f"ignore file with invalid path: {path}")
+        else:
+            raise e
+
+
+def _convert_data(converter, data, output, path):
+    """Convert file data, used to run conversions in worker processes"""
+    converter.convert(BytesIO(data), output, path)
 
 
 class CdragonRawPatchExporter:
@@ -314,10 +380,13 @@ class CdragonRawPatchExporter:
     convert files, etc.
     """
 
-    def __init__(self, output, patch, prev_patch=None, symlinks=None):
+    def __init__(self, output, patch, prev_patch=None, symlinks=None, processes=1, skn_glb=False, columnar=False):
         self.output = os.path.normpath(output)
         self.patch = patch
         self.prev_patch = prev_patch
+        self.processes = processes
+        self.skn_glb = skn_glb  # also convert SKN meshes to binary glTF
+        self.columnar = columnar  # also export columnar data files
         if symlinks is None:
             self.create_symlinks = prev_patch is not None
         else:
@@ -383,6 +452,9 @@ class CdragonRawPatchExporter:
         self.export_tft_data()
         logger.info("export Arena data files")
         self.export_arena_data()
+        if self.columnar:
+            logger.info("export columnar data files")
+            self.export_columnar_data()
 
     def export_tft_data(self):
         if self.patch.version != 'main' and self.patch.version < PatchVersion('9.14'):
@@ -391,7 +463,8 @@ class CdragonRawPatchExporter:
         game_version = self.patch.version.as_int()
         from .tftdata import TftTransformer
         transformer = TftTransformer(os.path.join(self.output, "game"), game_version)
-        transformer.export(os.path.join(self.output, "cdragon/tft"), langs=None)
+        rst_store = self._build_rst_store("tft", game_version)
+        transformer.export(os.path.join(self.output, "cdragon/tft"), langs=None, rst_store=rst_store)
 
     def export_arena_data(self):
         if self.patch.version != 'main' and self.patch.version < PatchVersion('13.14'):
@@ -399,17 +472,38 @@ class CdragonRawPatchExporter:
         # don't import in module to be able to execute arenadata module
         from .arenadata import ArenaTransformer
         transformer = ArenaTransformer(os.path.join(self.output, "game"))
-        transformer.export(os.path.join(self.output, "cdragon/arena"), langs=None)
+        rst_store = self._build_rst_store("lol", transformer.game_version)
+        transformer.export(os.path.join(self.output, "cdragon/arena"), langs=None, rst_store=rst_store)
+
+    def _build_rst_store(self, game, game_version):
+        """Merge stringtables of a game for translations, return None on failure"""
+        try:
+            paths = stringtable_paths(os.path.join(self.output, "game"), game)
+        except RuntimeError:
+            return None
+        try:
+            return load_rst_store(paths, game_version)
+        except ValueError as e:
+            # e.g. legacy text stringtables, translations will be loaded per language
+            logger.debug(f"cannot merge {game} stringtables: {e}")
+            return None
+
+    def export_columnar_data(self):
+        if self.patch.version != 'main' and self.patch.version < PatchVersion('9.14'):
+            return  # no supported TFT data before 9.14
+        from .columnar import export_columnar_data
+        export_columnar_data(os.path.join(self.output, "game"), os.path.join(self.output, "cdragon/columnar"),
+                             btype_version=self.patch.version.as_int())
 
     def _create_exporter(self, patch):
         game_version = patch.version.as_int()
-        exporter = Exporter(self.output)
+        exporter = Exporter(self.output, processes=self.processes)
         exporter.converters = [
             ImageConverter(('.dds', '.tga')),
             TexConverter(),
             AtlasInfoConverter(re.compile(r'game/clientstates/.*\.cdtb$|game/assets/items/icons2d/autoatlas/.*/atlas_info\.bin$')),
             BinConverter(re.compile(r'game/.*\.bin$'), game_version),
-            SknConverter(),
+            SknConverter(glb=self.skn_glb),
             RstConverter(re.compile(r'game/(?:.*/)?data/menu/.*\.(txt|stringtable)$'), game_version),
         ]
         exporter.add_patch_files(patch)
@@ -498,7 +592,7 @@ class CdragonRawPatchExporter:
                     raise
 
     @classmethod
-    def from_directory(cls, storage, output: str, first: PatchVersion=None, symlinks=None):
+    def from_directory(cls, storage, output: str, first: PatchVersion=None, symlinks=None, processes=1, skn_glb=False, columnar=False):
         """Handle export of multiple patchs in the same directory
 
         Exporter for the most oldest patch is returned first.
@@ -538,7 +632,8 @@ class CdragonRawPatchExporter:
         exporters = []
         for patch, previous_patch in zip(patches, patches[1:] + [None]):
             patch_output = os.path.join(output, str(patch.version))
-            exporters.append(cls(patch_output, patch, previous_patch, symlinks=symlinks if previous_patch else False))
+            exporters.append(cls(patch_output, patch, previous_patch, symlinks=symlinks if previous_patch else False,
+                                 processes=processes, skn_glb=skn_glb, columnar=columnar))
         return exporters[::-1]
 
 
@@ -547,8 +642,14 @@ class FileConverter:
 
     Each single file can be converted to one or multiple files and/or
     directories (as yielded by `converted_paths()`).
+
+    Converters with `cpu_bound` set to True are run in worker processes by
+    the `Exporter`. They must be picklable and must not rely on state
+    modified by conversions.
     """
 
+    cpu_bound = False
+
     def is_handled(self, path):
         """Return whether the path is handled"""
         raise NotImplementedError()
@@ -690,6 +791,8 @@ class TexConverter(FileConverter):
         return dds_header + pixels
 
 class BinConverter(FileConverter):
+    cpu_bound = True
+
     def __init__(self, regex, btype_version=None):
         self.regex = regex
         self.btype_version = btype_version
@@ -703,18 +806,19 @@ class BinConverter(FileConverter):
 
     def convert(self, fin, output, path):
         output_path = os.path.join(output, path)
+        data = fin.read()
         with write_file_or_remove(output_path) as fout:
-            shutil.copyfileobj(fin, fout)
+            fout.write(data)
         with write_file_or_remove(output_path + '.json') as fout:
             try:
-                binfile = BinFile(output_path, btype_version=self.btype_version)
+                binfile = load_binfile(data, btype_version=self.btype_version)
             except ValueError as e:
                 raise FileConversionError(f"failed to parse bin file: {e}")
             fout.write(json_dumps(binfile.to_serializable()).encode('ascii'))
 
 class SknConverter(FileConverter):
-    def __init__(self):
-        pass
+    def __init__(self, glb=False):
+        self.glb = glb  # also convert to binary glTF
 
     def is_handled(self, path):
         return path.endswith('.skn')
@@ -722,6 +826,8 @@ class SknConverter(FileConverter):
     def converted_paths(self, path):
         yield path
         yield os.path.splitext(path)[0]
+        if self.glb:
+            yield os.path.splitext(path)[0] + '.glb'
 
     def convert(self, fin, output, path):
         output_path = os.path.join(output, path)
@@ -734,12 +840,16 @@ class SknConverter(FileConverter):
             for entry in sknfile.entries:
                 name = os.path.join(obj_output_path, entry["name"] + ".obj")
                 with open(name, "w") as f:
-                    f.write(sknfile.to_obj(entry))
+                    sknfile.write_obj(entry, f)
+        if self.glb:
+            with write_file_or_remove(obj_output_path + '.glb') as fout:
+                sknfile.write_glb(fout)
 
 class RstConverter(FileConverter):
+    cpu_bound = True
+
     def __init__(self, regex, game_version=1502):
         self.regex = regex
-        self.hashes = get_rsthashfile(game_version).load()
         self.game_version = game_version
 
     def is_handled(self, path):
@@ -755,7 +865,7 @@ class RstConverter(FileConverter):
             shutil.copyfileobj(fin, fout)
 
         rstfile = RstFile(output_path, self.game_version)
-        hashes = {key_to_rsthash(hash, bits=rstfile.hash_bits): value for hash, value in self.hashes.items()}
+        hashes = load_truncated_hashes(get_rsthashfile(self.game_version), rstfile.hash_bits)
         rst_json = {"entries": {}, "version": rstfile.version}
         for key, value in rstfile.entries.items():
             if key in hashes:
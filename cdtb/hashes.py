@@ -50,6 +50,25 @@ def _default_hash_dir():
 default_hash_dir = _default_hash_dir()
 
 
+def default_cache_dir() -> Path:
+    """
+    Return the directory of cache files computed from hashes
+
+    - `$CDTB_CACHE_DIR` if set
+    - `$XDG_CACHE_HOME/cdragon` if `$XDG_CACHE_HOME` is set
+    - `$LOCALAPPDATA/cdragon/cache` if `$LOCALAPPDATA` is set
+    - `~/.cache/cdragon` otherwise
+
+    """
+    if value := os.environ.get('CDTB_CACHE_DIR'):
+        return Path(value)
+    if value := os.environ.get('XDG_CACHE_HOME'):
+        return Path(value) / 'cdragon'
+    if value := os.environ.get('LOCALAPPDATA'):
+        return Path(value) / 'cdragon/cache'
+    return Path.home() / '.cache/cdragon'
+
+
 class HashFile:
     """Store hashes, support save/load and caching"""
 
@@ -1,30 +1,49 @@
 import os
 import re
-import io
 import json
+import mmap
+import struct
+import marshal
+import gc
 import time
+import shutil
 import hashlib
 import logging
-from typing import List, Optional, Generator
-from multiprocessing.pool import ThreadPool
+import bisect
+import heapq
+import queue
+import threading
+from struct import unpack_from
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait as wait_futures
+from itertools import islice
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Generator, Iterable, Tuple
+import numpy as np
+import requests
 
 from .storage import (
     Storage,
+    RequestStreamReader,
     PatchElement,
     PatchVersion,
     get_system_yaml_version,
     get_content_metadata_version,
 )
+from .downloader import Downloader
 from .tools import (
-    BinaryParser,
     write_file_or_remove,
     zstd_decompress,
 )
 
 logger = logging.getLogger(__name__)
 
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
 
 class PatcherChunk:
+    __slots__ = ('chunk_id', 'bundle', 'offset', 'size', 'target_size')
+
     def __init__(self, chunk_id, bundle, offset, size, target_size):
         self.chunk_id = chunk_id
         self.bundle = bundle
@@ -45,6 +64,24 @@ class PatcherBundle:
             offset = 0
         self.chunks.append(PatcherChunk(chunk_id, self, offset, size, target_size))
 
+    @property
+    def size(self):
+        """Size of the bundle file"""
+        if not self.chunks:
+            return 0
+        return self.chunks[-1].offset + self.chunks[-1].size
+
+    def verify_file(self, path):
+        """Check that a file matches the bundle, raise a ValueError if not"""
+        size = os.path.getsize(path)
+        if size != self.size:
+            raise ValueError(f"invalid size for bundle {self.bundle_id:016X}: {size} instead of {self.size}")
+        with open(path, "rb") as f:
+            for chunk in self.chunks:
+                f.seek(chunk.offset)
+                if f.read(4) != ZSTD_MAGIC:
+                    raise ValueError(f"invalid data for chunk {chunk.chunk_id:016X} of bundle {self.bundle_id:016X}")
+
 class PatcherFile:
     def __init__(self, name, size, link, flags, chunks):
         self.name = name
@@ -73,8 +110,29 @@ class PatcherFile:
             return lambda f: f.flags is not None and any(f.lower() == lang for f in f.flags)
 
 
+@contextmanager
+def _gc_disabled():
+    """Disable the garbage collector, to create many objects faster"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
 class PatcherManifest:
-    def __init__(self, path_or_f=None):
+    """Parsed RMAN manifest
+
+    When loaded from a path, parsed data is cached in a `.cache` file next to
+    the manifest, to be loaded faster next time.
+    """
+
+    CACHE_VERSION = 1
+
+    def __init__(self, path_or_f=None, use_cache=True):
+        self.manifest_id = None
         self.bundles = None
         self.chunks = None
         self.flags = None
@@ -82,55 +140,147 @@ class PatcherManifest:
 
         if path_or_f is not None:
             if isinstance(path_or_f, str):
-                with open(path_or_f, "rb") as f:
-                    self.parse_rman(f)
+                self.load(path_or_f, use_cache=use_cache)
             else:
-                self.parse_rman(f)
+                self.parse_rman(path_or_f)
 
     def filter_files(self, langs=True) -> List[PatcherFile]:
         """Filter files from the manifest with provided filters"""
         return filter(PatcherFile.langs_predicate(langs), self.files.values())
 
-    def parse_rman(self, f):
-        parser = BinaryParser(f)
+    def diff(self, other: 'PatcherManifest') -> 'PatcherManifestDiff':
+        """Compare files with the ones of another (newer) manifest
 
-        magic, version_major, version_minor = parser.unpack("<4sBB")
+        Files are compared using their chunk IDs.
+        """
+        added, changed, unchanged = [], [], []
+        for name, file in other.files.items():
+            old_file = self.files.get(name)
+            if old_file is None:
+                added.append(file)
+            elif old_file.link != file.link or [c.chunk_id for c in old_file.chunks] != [c.chunk_id for c in file.chunks]:
+                changed.append(file)
+            else:
+                unchanged.append(file)
+        removed = [file for name, file in self.files.items() if name not in other.files]
+        return PatcherManifestDiff(added, changed, removed, unchanged)
+
+    def load(self, path, use_cache=True):
+        """Load a manifest file, use (and update) the cache if requested"""
+
+        cache_path = f"{path}.cache"
+        with open(path, "rb") as f, _gc_disabled():
+            length = self._parse_rman_header(f)
+            if use_cache:
+                try:
+                    with open(cache_path, "rb") as fcache:
+                        version, manifest_id, cached = marshal.load(fcache)
+                    if (version, manifest_id) == (self.CACHE_VERSION, self.manifest_id):
+                        self._load_cached(cached)
+                        return
+                except FileNotFoundError:
+                    pass
+                except (EOFError, ValueError, TypeError):
+                    logger.warning(f"ignore invalid manifest cache: {cache_path}")
+            self.parse_body(zstd_decompress(f.read(length)))
+
+        if use_cache:
+            try:
+                tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+                with write_file_or_remove(tmp_path) as f:
+                    marshal.dump((self.CACHE_VERSION, self.manifest_id, self._to_cached()), f)
+                os.replace(tmp_path, cache_path)
+            except OSError as e:
+                logger.debug(f"cannot write manifest cache: {e}")
+
+    def _to_cached(self):
+        """Return manifest data to cache, integer lists are stored as packed arrays"""
+        chunks = [chunk for bundle in self.bundles for chunk in bundle.chunks]
+        bundles = (
+            np.array([bundle.bundle_id for bundle in self.bundles], dtype='<u8').tobytes(),
+            np.array([len(bundle.chunks) for bundle in self.bundles], dtype='<u4').tobytes(),
+            np.array([chunk.chunk_id for chunk in chunks], dtype='<u8').tobytes(),
+            np.array([chunk.size for chunk in chunks], dtype='<u4').tobytes(),
+            np.array([chunk.target_size for chunk in chunks], dtype='<u4').tobytes(),
+        )
+        files = list(self.files.values())
+        files = (
+            [f.name for f in files],
+            [f.size for f in files],
+            [f.link for f in files],
+            [f.flags for f in files],
+            np.array([len(f.chunks) for f in files], dtype='<u4').tobytes(),
+            np.array([chunk.chunk_id for f in files for chunk in f.chunks], dtype='<u8').tobytes(),
+        )
+        return (bundles, self.flags, files)
+
+    def _load_cached(self, cached):
+        bundles, self.flags, files = cached
+
+        bundle_ids, chunk_counts, chunk_ids, sizes, target_sizes = (
+            np.frombuffer(data, dtype=dtype) for data, dtype in zip(bundles, ('<u8', '<u4', '<u8', '<u4', '<u4')))
+        # offsets of chunks in their bundle
+        starts = np.concatenate(([0], np.cumsum(sizes, dtype=np.int64)))
+        # index of the first chunk of each bundle (bundles may be empty)
+        first_chunks = np.cumsum(chunk_counts, dtype=np.int64) - chunk_counts
+        offsets = starts[:-1] - np.repeat(starts[first_chunks], chunk_counts)
+
+        self.bundles = []
+        it_chunks = zip(chunk_ids.tolist(), offsets.tolist(), sizes.tolist(), target_sizes.tolist())
+        for bundle_id, count in zip(bundle_ids.tolist(), chunk_counts.tolist()):
+            bundle = PatcherBundle(bundle_id)
+            bundle.chunks = [PatcherChunk(chunk_id, bundle, offset, size, target_size)
+                             for chunk_id, offset, size, target_size in islice(it_chunks, count)]
+            self.bundles.append(bundle)
+        self.chunks = chunks = {chunk.chunk_id: chunk for bundle in self.bundles for chunk in bundle.chunks}
+
+        names, file_sizes, links, flags, file_chunk_counts, file_chunk_ids = files
+        it_chunks = map(chunks.__getitem__, np.frombuffer(file_chunk_ids, dtype='<u8').tolist())
+        self.files = {}
+        for name, size, link, file_flags, count in zip(names, file_sizes, links, flags, np.frombuffer(file_chunk_counts, dtype='<u4').tolist()):
+            self.files[name] = PatcherFile(name, size, link, file_flags, list(islice(it_chunks, count)))
+
+    def _parse_rman_header(self, f):
+        """Parse RMAN header, return the size of the compressed body"""
+
+        magic, version_major, version_minor = struct.unpack("<4sBB", f.read(6))
         if magic != b'RMAN':
             raise ValueError("invalid magic code")
         if (version_major, version_minor) != (2, 0):
             raise ValueError(f"unsupported RMAN version: {version_major}.{version_minor}")
 
-        flags, offset, length, _manifest_id, _body_length = parser.unpack("<HLLQL")
+        flags, offset, length, self.manifest_id, _body_length = struct.unpack("<HLLQL", f.read(22))
         assert flags & (1 << 9)  # other flags not handled
-        assert offset == parser.tell()
+        assert offset == 28
+        return length
 
-        f = io.BytesIO(zstd_decompress(parser.raw(length)))
-        return self.parse_body(f)
+    def parse_rman(self, f):
+        length = self._parse_rman_header(f)
+        return self.parse_body(zstd_decompress(f.read(length)))
 
-    def parse_body(self, f):
-        parser = BinaryParser(f)
+    def parse_body(self, data):
+        """Parse decompressed body data"""
+
+        if hasattr(data, 'read'):
+            data = data.read()
+        data = memoryview(data)
 
         # header (unknown values, skip it)
-        n, = parser.unpack('<l')
-        parser.skip(n)
+        n, = unpack_from('<l', data, 0)
 
         # offsets to tables (convert to absolute)
-        offsets_base = parser.tell()
-        offsets = list(offsets_base + 4*i + v for i, v in enumerate(parser.unpack('<6l')))
-
-        parser.seek(offsets[0])
-        self.bundles = list(self._parse_table(parser, self._parse_bundle))
+        offsets_base = 4 + n
+        offsets = list(offsets_base + 4*i + v for i, v in enumerate(unpack_from('<6l', data, offsets_base)))
 
-        parser.seek(offsets[1])
-        self.flags = dict(self._parse_table(parser, self._parse_flag))
+        self.bundles = [self._parse_bundle(data, pos) for pos in self._table_entries(data, offsets[0])]
+        self.flags = dict(self._parse_flag(data, pos) for pos in self._table_entries(data, offsets[1]))
 
         # build a list of chunks, indexed by ID
         self.chunks = {chunk.chunk_id: chunk for bundle in self.bundles for chunk in bundle.chunks}
 
-        parser.seek(offsets[2])
-        file_entries = list(self._parse_table(parser, self._parse_file_entry))
-        parser.seek(offsets[3])
-        directories = {did: (name, parent) for name, did, parent in self._parse_table(parser, self._parse_directory)}
+        file_entries = [self._parse_file_entry(data, pos) for pos in self._table_entries(data, offsets[2])]
+        directories = {did: (name, parent) for name, did, parent in
+                       (self._parse_directory(data, pos) for pos in self._table_entries(data, offsets[3]))}
 
         # merge files and directory data
         self.files = {}
@@ -147,122 +297,312 @@ class PatcherManifest:
 
         # note: last two tables are unresolved
 
+    @staticmethod
+    def _table_entries(data, pos):
+        """Return the positions of the entries of a table"""
+        count, = unpack_from('<l', data, pos)
+        return [p + v for p, v in zip(range(pos + 4, pos + 4 + 4*count, 4), unpack_from(f'<{count}l', data, pos + 4))]
 
     @staticmethod
-    def _parse_table(parser, entry_parser):
-        count, = parser.unpack('<l')
+    def _field_positions(data, pos, nfields):
+        """Return the positions of the fields of an entry, None for missing fields"""
+        vtable_pos = pos - unpack_from('<l', data, pos)[0]
+        vtable_size, = unpack_from('<H', data, vtable_pos)
+        n = min(nfields, (vtable_size - 4) // 2)
+        return [pos + offset if offset else None for offset in unpack_from(f'<{n}H', data, vtable_pos + 4)] + [None] * (nfields - n)
 
-        for _ in range(count):
-            pos = parser.tell()
-            offset, = parser.unpack('<l')
-            parser.seek(pos + offset)
-            yield entry_parser(parser)
-            parser.seek(pos + 4)
+    @staticmethod
+    def _read_string(data, pos):
+        """Read a string from its offset position"""
+        if pos is None:
+            return None
+        pos += unpack_from('<l', data, pos)[0]
+        n, = unpack_from('<L', data, pos)
+        return str(data[pos+4:pos+4+n], 'utf-8')
+
+    @staticmethod
+    def _read_value(data, fmt, pos):
+        return None if pos is None else unpack_from(fmt, data, pos)[0]
 
     @classmethod
-    def _parse_bundle(cls, parser):
+    def _parse_bundle(cls, data, pos):
         """Parse a bundle entry"""
 
-        def parse_chunklist(parser):
-            fields = cls._parse_field_table(parser, (
-                ('chunk_id', '<Q'),
-                ('compressed_size', '<L'),
-                ('uncompressed_size', '<L'),
-            ))
-            return fields['chunk_id'], fields['compressed_size'], fields['uncompressed_size']
-
-        fields = cls._parse_field_table(parser, (
-            ('bundle_id', '<Q'),
-            ('chunks_offset', 'offset'),
-        ))
-
-        bundle = PatcherBundle(fields['bundle_id'])
-        parser.seek(fields['chunks_offset'])
-        for (chunk_id, compressed_size, uncompressed_size) in cls._parse_table(parser, parse_chunklist):
-            bundle.add_chunk(chunk_id, compressed_size, uncompressed_size)
-
+        bundle_id_pos, chunks_pos = cls._field_positions(data, pos, 2)
+        bundle = PatcherBundle(unpack_from('<Q', data, bundle_id_pos)[0])
+        chunks_pos += unpack_from('<l', data, chunks_pos)[0]
+        field_positions = cls._field_positions
+        for chunk_pos in cls._table_entries(data, chunks_pos):
+            id_pos, size_pos, target_size_pos = field_positions(data, chunk_pos, 3)
+            bundle.add_chunk(unpack_from('<Q', data, id_pos)[0], unpack_from('<L', data, size_pos)[0], unpack_from('<L', data, target_size_pos)[0])
         return bundle
 
     @staticmethod
-    def _parse_flag(parser):
-        parser.skip(4)  # skip offset table offset
-        flag_id, offset, = parser.unpack('<xxxBl')
-        parser.skip(offset - 4)
-        return (flag_id, parser.unpack_string())
+    def _parse_flag(data, pos):
+        # skip offset table offset
+        flag_id, offset = unpack_from('<xxxBl', data, pos + 4)
+        pos += 8 + offset
+        n, = unpack_from('<L', data, pos)
+        return (flag_id, str(data[pos+4:pos+4+n], 'utf-8'))
 
     @classmethod
-    def _parse_file_entry(cls, parser):
+    def _parse_file_entry(cls, data, pos):
         """Parse a file entry
         (name, link, flag_ids, directory_id, filesize, chunk_ids)
         """
-        fields = cls._parse_field_table(parser, (
-            ('file_id', '<Q'),
-            ('directory_id', '<Q'),
-            ('file_size', '<L'),
-            ('name', 'str'),
-            ('flags', '<Q'),
-            None,
-            None,
-            ('chunks', 'offset'),
-            None,
-            ('link', 'str'),
-            None,
-            None,
-            None,
-        ))
-
-        flag_mask = fields['flags']
+        (_, directory_id_pos, file_size_pos, name_pos, flags_pos,
+         _, _, chunks_pos, _, link_pos, *_) = cls._field_positions(data, pos, 13)
+
+        flag_mask = cls._read_value(data, '<Q', flags_pos)
         if flag_mask:
             flag_ids = [i+1 for i in range(64) if flag_mask & (1 << i)]
         else:
             flag_ids = None
 
-        parser.seek(fields['chunks'])
-        chunk_count, = parser.unpack('<L')  # _ == 0
-        chunk_ids = list(parser.unpack(f'<{chunk_count}Q'))
+        chunks_pos += unpack_from('<l', data, chunks_pos)[0]
+        chunk_count, = unpack_from('<L', data, chunks_pos)
+        chunk_ids = list(unpack_from(f'<{chunk_count}Q', data, chunks_pos + 4))
 
-        return (fields['name'], fields['link'], flag_ids, fields['directory_id'], fields['file_size'], chunk_ids)
+        return (cls._read_string(data, name_pos), cls._read_string(data, link_pos), flag_ids,
+                cls._read_value(data, '<Q', directory_id_pos), cls._read_value(data, '<L', file_size_pos), chunk_ids)
 
     @classmethod
-    def _parse_directory(cls, parser):
+    def _parse_directory(cls, data, pos):
         """Parse a directory entry
         (name, directory_id, parent_id)
         """
-        fields = cls._parse_field_table(parser, (
-            ('directory_id', '<Q'),
-            ('parent_id', '<Q'),
-            ('name', 'str'),
-        ))
-        return (fields['name'], fields['directory_id'], fields['parent_id'])
+        directory_id_pos, parent_id_pos, name_pos = cls._field_positions(data, pos, 3)
+        return (cls._read_string(data, name_pos), cls._read_value(data, '<Q', directory_id_pos), cls._read_value(data, '<Q', parent_id_pos))
 
-    @staticmethod
-    def _parse_field_table(parser, fields):
-        entry_pos = parser.tell()
-        fields_pos = entry_pos - parser.unpack('<l')[0]
-        nfields = len(fields)
-        output = {}
-        parser.seek(fields_pos)
-        parser.skip(2) # vtable size
-        parser.skip(2) # object size
-        for _, field, offset in zip(range(nfields), fields, parser.unpack(f'<{nfields}H')):
-            if field is None:
-                continue
-            name, fmt = field
-            if offset == 0 or fmt is None:
-                value = None
+
+class PatcherManifestDiff:
+    """Differences of files between two manifests
+
+    Removed files are files of the old manifest, other files are files of the
+    new manifest.
+    """
+
+    def __init__(self, added, changed, removed, unchanged):
+        self.added: List[PatcherFile] = added
+        self.changed: List[PatcherFile] = changed
+        self.removed: List[PatcherFile] = removed
+        self.unchanged: List[PatcherFile] = unchanged
+
+    def __repr__(self):
+        return (f"<{self.__class__.__qualname__} added={len(self.added)} changed={len(self.changed)}"
+                f" removed={len(self.removed)} unchanged={len(self.unchanged)}>")
+
+
+class BundlePool:
+    """LRU pool of memory-mapped bundle files
+
+    Bundles are kept mapped to avoid to open and close them for each chunk.
+    The pool can be used from several threads.
+    """
+
+    def __init__(self, storage: 'PatcherStorage', size=32):
+        self.storage = storage
+        self.size = size
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+
+    def read(self, bundle_id, offset, size) -> bytes:
+        """Read raw data from a bundle"""
+        with self._lock:
+            m = self._maps.get(bundle_id)
+            if m is None:
+                with open(self.storage.bundle_data_path(bundle_id), "rb") as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[bundle_id] = m
+                if len(self._maps) > self.size:
+                    _, old = self._maps.popitem(last=False)
+                    old.close()
             else:
-                pos = entry_pos + offset
-                parser.seek(pos)
-                if fmt == 'offset':
-                    value = pos + parser.unpack('<l')[0]
-                elif fmt == 'str':
-                    value = parser.unpack('<l')[0]
-                    parser.seek(pos + value)
-                    value = parser.unpack_string()
-                else:
-                    value = parser.unpack(fmt)[0]
-            output[name] = value
-        return output
+                self._maps.move_to_end(bundle_id)
+            return m[offset:offset+size]
+
+    def discard(self, bundle_id):
+        """Close a bundle, if mapped"""
+        with self._lock:
+            m = self._maps.pop(bundle_id, None)
+            if m is not None:
+                m.close()
+
+    def close(self):
+        with self._lock:
+            for m in self._maps.values():
+                m.close()
+            self._maps.clear()
+
+
+class SparseBundleStore:
+    """Partially downloaded bundles
+
+    Data of partial bundles is written at its actual position in sparse files,
+    under `cdtb/bundles/`. Downloaded ranges are listed in a `.ranges` file
+    next to each bundle.
+    """
+
+    def __init__(self, storage: 'PatcherStorage'):
+        self.storage = storage
+        self._ranges = {}  # cached ranges, indexed by bundle ID
+        self._lock = threading.Lock()
+
+    def path(self, bundle_id):
+        return self.storage.fspath(f"cdtb/bundles/{bundle_id:016X}.bundle")
+
+    def ranges(self, bundle_id) -> List[Tuple[int, int]]:
+        """Return the sorted list of available `(start, end)` ranges of a bundle"""
+        ranges = self._ranges.get(bundle_id)
+        if ranges is None:
+            try:
+                with open(self.path(bundle_id) + ".ranges") as f:
+                    ranges = [tuple(r) for r in json.load(f)]
+            except FileNotFoundError:
+                ranges = []
+            self._ranges[bundle_id] = ranges
+        return ranges
+
+    def has_range(self, bundle_id, start, end) -> bool:
+        ranges = self.ranges(bundle_id)
+        i = bisect.bisect_right(ranges, (start, float('inf'))) - 1
+        return i >= 0 and ranges[i][1] >= end
+
+    def write(self, bundle: PatcherBundle, start, data):
+        """Write bundle data, starting at the given position"""
+        path = self.path(bundle.bundle_id)
+        end = start + len(data)
+        with self._lock:
+            if not os.path.isfile(path):
+                with write_file_or_remove(path) as f:
+                    f.truncate(bundle.size)
+            with open(path, "r+b") as f:
+                f.seek(start)
+                f.write(data)
+            self._ranges[bundle.bundle_id] = ranges = merge_ranges(self.ranges(bundle.bundle_id) + [(start, end)])
+            with write_file_or_remove(path + ".ranges", binary=False) as f:
+                json.dump(ranges, f)
+
+    def remove(self, bundle_id):
+        with self._lock:
+            self._ranges.pop(bundle_id, None)
+            for path in (self.path(bundle_id), self.path(bundle_id) + ".ranges"):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def merge_ranges(ranges: Iterable[Tuple[int, int]], gap=0) -> List[Tuple[int, int]]:
+    """Merge `(start, end)` ranges which overlap or are separated by at most `gap` bytes"""
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + gap:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class _ExtractedFile:
+    """File being extracted from its chunks
+
+    Chunks are written at their position in a temporary file, in any order,
+    possibly from several threads.
+    The file is renamed once all chunks have been written.
+    """
+
+    def __init__(self, file: PatcherFile, path):
+        self.file = file
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.remaining = len(file.chunks)
+        self.f = None
+        self.lock = threading.Lock()
+
+    def write_chunk(self, pos, data):
+        with self.lock:
+            if self.f is None:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.f = open(self.tmp_path, "wb")
+            self.f.seek(pos)
+            self.f.write(data)
+            self.remaining -= 1
+            if not self.remaining:
+                self.finish()
+
+    def finish(self):
+        if self.f is None:
+            # empty file
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.f = open(self.tmp_path, "wb")
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.f is not None:
+            self.f.close()
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+
+def _plan_extraction(files: Iterable[_ExtractedFile]):
+    """Group chunks to extract by bundle
+
+    Return a list of `(bundle_id, chunks)`, sorted by bundle ID.
+    Chunks are sorted by offset, as a list of `(chunk, writes)` where `writes`
+    is a list of `(extracted_file, position)`.
+    """
+
+    bundles = {}
+    for extracted in files:
+        pos = 0
+        for chunk in extracted.file.chunks:
+            bundle_chunks = bundles.setdefault(chunk.bundle.bundle_id, {})
+            bundle_chunks.setdefault(chunk.chunk_id, (chunk, []))[1].append((extracted, pos))
+            pos += chunk.target_size
+
+    return [(bundle_id, sorted(bundles[bundle_id].values(), key=lambda v: v[0].offset)) for bundle_id in sorted(bundles)]
+
+
+def _order_bundles(files_bundles: List[Tuple[PatcherFile, set]], priority=()) -> List[int]:
+    """Order bundles so that files can be extracted as early as possible
+
+    `files_bundles` is a list of `(file, bundle_ids)`.
+    Files whose name is in `priority` are handled first, then files needing
+    the fewest bundles not ordered yet.
+    Return bundle IDs in download order.
+    """
+
+    ordered = []
+    scheduled = set()
+    heap = [(file.name not in priority, len(bundle_ids), i) for i, (file, bundle_ids) in enumerate(files_bundles)]
+    heapq.heapify(heap)
+    while heap:
+        low_priority, count, i = heapq.heappop(heap)
+        bundle_ids = files_bundles[i][1] - scheduled
+        if len(bundle_ids) != count:
+            # some bundles have been ordered since, requeue the file
+            heapq.heappush(heap, (low_priority, len(bundle_ids), i))
+            continue
+        ordered += sorted(bundle_ids)
+        scheduled |= bundle_ids
+    return ordered
+
+
+def _is_process_running(pid):
+    if os.name == 'nt':
+        return True  # cannot be checked reliably, assume it is
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
 
 
 class PatcherStorage(Storage):
@@ -300,6 +640,16 @@ class PatcherStorage(Storage):
       region -- region from which use configuration
       use_extract_symlinks -- if false, disable use of symlinks for extracted files
       clientconfig_data -- file or URL to use as 'clientconfig.rpg.riotgames.com' data
+      extract_workers -- number of threads used to extract files (default: number of CPUs)
+      use_range_requests -- if true, download only needed chunks instead of whole bundles
+      download_workers -- maximum number of concurrent downloads
+
+    With `use_range_requests`, chunks are downloaded using HTTP range requests
+    and stored in partial bundles (see `SparseBundleStore`). This is notably
+    useful to download only some of the files (e.g. a single language).
+
+    Files can also be extracted while being streamed from the CDN, without
+    storing bundles at all (see `extract_files()`).
 
     """
 
@@ -310,11 +660,21 @@ class PatcherStorage(Storage):
     CLIENT_LIVE_REGION = 'EUW'
     GAME_LIVE_PLATFORM = 'EUW1'
 
+    # number of files extracted at once (files are kept open while being extracted)
+    EXTRACT_BATCH_SIZE = 256
+    # chunks separated by less than this amount of bytes are requested together
+    RANGE_MERGE_GAP = 64 * 1024
+
     def __init__(self, path, patchline=DEFAULT_PATCHLINE):
         super().__init__(path, self.URL_BASE)
         self.patchline = patchline
         self.use_extract_symlinks = True
         self.clientconfig_data = None
+        self.extract_workers = os.cpu_count() or 1
+        self.use_range_requests = False
+        self.bundles = BundlePool(self)
+        self.sparse_bundles = SparseBundleStore(self)
+        self.downloader = Downloader()
 
     @classmethod
     def from_conf_data(cls, conf):
@@ -323,6 +683,12 @@ class PatcherStorage(Storage):
             storage.use_extract_symlinks = False
         if 'clientconfig_data' in conf:
             storage.clientconfig_data = conf['clientconfig_data']
+        if 'extract_workers' in conf:
+            storage.extract_workers = int(conf['extract_workers'])
+        if conf.get('use_range_requests'):
+            storage.use_range_requests = True
+        if 'download_workers' in conf:
+            storage.downloader = Downloader(max_workers=int(conf['download_workers']))
         return storage
 
     def base_release_path(self):
@@ -409,8 +775,8 @@ class PatcherStorage(Storage):
         with open(path) as f:
             return int(f.read().strip())
 
-    def download_manifest(self, id_or_url):
-        """Download a manifest from its ID or full URL if needed, return its path in the storage"""
+    def manifest_path(self, id_or_url):
+        """Return the path of a manifest in the storage, from its ID or full URL"""
 
         if isinstance(id_or_url, str):
             id_or_url = id_or_url.replace(".secure.", ".")
@@ -423,48 +789,414 @@ class PatcherStorage(Storage):
         else:
             manif_id = id_or_url
 
-        path = f"channels/public/releases/{manif_id:016X}.manifest"
-        self.download(path, None)
-        return path
+        return f"channels/public/releases/{manif_id:016X}.manifest"
 
-    def download_bundle(self, bundle_id):
-        """Download a bundle from its ID, return its path in the storage"""
+    def download_manifest(self, id_or_url):
+        """Download a manifest from its ID or full URL if needed, return its path in the storage"""
 
-        path = f"channels/public/bundles/{bundle_id:016X}.bundle"
+        path = self.manifest_path(id_or_url)
         self.download(path, None)
         return path
 
+    @staticmethod
+    def bundle_path(bundle_id):
+        """Return the path of a bundle in the storage"""
+        return f"channels/public/bundles/{bundle_id:016X}.bundle"
+
+    def download_bundles(self, bundles: Iterable[PatcherBundle], callback: Optional[Callable[[PatcherBundle], None]] = None):
+        """Download bundles not already in the storage
+
+        Bundles are verified before being stored.
+        Downloads are started in the order of `bundles`. If set, `callback` is
+        called with each downloaded bundle, once stored.
+        """
+
+        to_download = []
+        bundles_by_path = {}
+        for bundle in bundles:
+            path = self.fspath(self.bundle_path(bundle.bundle_id))
+            if not os.path.isfile(path):
+                to_download.append((self.url + self.bundle_path(bundle.bundle_id), path, bundle.size, bundle.verify_file))
+                bundles_by_path[path] = bundle
+        def on_downloaded(path):
+            bundle = bundles_by_path[path]
+            # the partial bundle may be mapped, read the full one from now on
+            self.bundles.discard(bundle.bundle_id)
+            if callback is not None:
+                callback(bundle)
+
+        logger.debug(f"download {len(to_download)} bundles")
+        self.downloader.download_many(to_download, on_downloaded)
+
+    def bundle_data_path(self, bundle_id):
+        """Return the full path to bundle data, complete bundle if available, partial one otherwise"""
+        path = self.fspath(self.bundle_path(bundle_id))
+        if os.path.isfile(path):
+            return path
+        return self.sparse_bundles.path(bundle_id)
+
+    def fetch_chunks(self, chunks: Iterable[PatcherChunk]):
+        """Download chunks using HTTP range requests
+
+        Chunks from bundles already downloaded are skipped. Nearby chunks of a
+        bundle are downloaded using a single request.
+        """
+
+        bundles_chunks = {}
+        for chunk in chunks:
+            bundles_chunks.setdefault(chunk.bundle.bundle_id, {})[chunk.offset] = chunk
+
+        fetched_bundles = []
+        for bundle_id, bundle_chunks in bundles_chunks.items():
+            if os.path.isfile(self.fspath(self.bundle_path(bundle_id))):
+                continue
+            ranges = [(chunk.offset, chunk.offset + chunk.size) for chunk in bundle_chunks.values()
+                      if not self.sparse_bundles.has_range(bundle_id, chunk.offset, chunk.offset + chunk.size)]
+            if ranges:
+                bundle = next(iter(bundle_chunks.values())).bundle
+                fetched_bundles.append((bundle, merge_ranges(ranges, self.RANGE_MERGE_GAP)))
+
+        if fetched_bundles:
+            logger.debug(f"download {sum(len(ranges) for _, ranges in fetched_bundles)} chunk ranges from {len(fetched_bundles)} bundles")
+
+            def fetch(args):
+                with self.downloader.limiter:
+                    self.fetch_bundle_ranges(*args)
+
+            # ranges of a given bundle are fetched by a single thread
+            with ThreadPoolExecutor(min(self.downloader.max_workers, len(fetched_bundles))) as executor:
+                for _ in executor.map(fetch, fetched_bundles):
+                    pass
+
+    def fetch_bundle_ranges(self, bundle: PatcherBundle, ranges: List[Tuple[int, int]]):
+        """Download ranges of a bundle, store them as a partial bundle
+
+        If range requests are not supported, the whole bundle is downloaded
+        and verified instead.
+        """
+
+        url = self.url + self.bundle_path(bundle.bundle_id)
+        for start, end in ranges:
+            data = self.downloader.download_range(url, start, end)
+            if data is None:
+                logger.debug(f"range requests not supported, download {url}")
+                self.downloader.download(url, self.fspath(self.bundle_path(bundle.bundle_id)), bundle.size, bundle.verify_file)
+                self.bundles.discard(bundle.bundle_id)
+                return
+            self.sparse_bundles.write(bundle, start, data)
+
     def load_chunk(self, chunk: PatcherChunk):
         """Load chunk data from a bundle"""
-        path = f"channels/public/bundles/{chunk.bundle.bundle_id:016X}.bundle"
-        with open(self.fspath(path), "rb") as f:
-            f.seek(chunk.offset)
-            # assume chunk is compressed
-            return zstd_decompress(f.read(chunk.size))
+        # assume chunk is compressed
+        return zstd_decompress(self.bundles.read(chunk.bundle.bundle_id, chunk.offset, chunk.size))
+
+    def extracted_file_path(self, file: PatcherFile, output):
+        """Return the path to which file data is actually extracted"""
+        if self.use_extract_symlinks:
+            return self.fspath(f"cdtb/files/{file.hexdigest()}")
+        else:
+            return output
 
     def extract_file(self, file: PatcherFile, output):
         """Extract a file from its chunks, which must be available"""
+        self.extract_files([(file, output)])
 
-        if self.use_extract_symlinks:
-            real_output = self.fspath(f"cdtb/files/{file.hexdigest()}")
-        else:
-            real_output = output
+    def extract_files(self, files: Iterable[Tuple[PatcherFile, str]], stream=False):
+        """Extract files from their chunks, which must be available
 
-        if not os.path.isfile(real_output):
-            logger.debug(f"extract {file.name} to {real_output}")
-            with write_file_or_remove(real_output) as f:
-                for chunk in file.chunks:
-                    f.write(self.load_chunk(chunk))
+        `files` is a list of `(file, output)`.
+        Chunks of all files are read bundle by bundle, then written to their
+        file. Bundles are processed in parallel, by `extract_workers` threads.
+        Files with the same content are extracted only once.
+
+        If `stream` is true, chunks of bundles not in the storage are
+        downloaded and decompressed on the fly, without storing bundle data.
+        """
+
+        # group outputs by actual extracted file
+        outputs = {}
+        for file, output in files:
+            real_output = self.extracted_file_path(file, output)
+            outputs.setdefault(real_output, (file, []))[1].append(output)
+
+        to_extract = [_ExtractedFile(file, real_output) for real_output, (file, _) in outputs.items()
+                      if not os.path.isfile(real_output)]
+        if to_extract:
+            workers = max(self.extract_workers, self.downloader.max_workers) if stream else self.extract_workers
+            with ThreadPoolExecutor(min(workers, len(to_extract))) as executor:
+                for i in range(0, len(to_extract), self.EXTRACT_BATCH_SIZE):
+                    self._extract_batch(executor, to_extract[i:i+self.EXTRACT_BATCH_SIZE], stream)
 
         if self.use_extract_symlinks:
-            logger.debug(f"symlink {real_output} to {output}")
+            for real_output, (_, file_outputs) in outputs.items():
+                for output in file_outputs:
+                    self._symlink_extracted_file(real_output, output)
+
+    def _extract_batch(self, executor, extracted_files: List[_ExtractedFile], stream=False):
+        for extracted in extracted_files:
+            logger.debug(f"extract {extracted.file.name} to {extracted.path}")
+            if not extracted.remaining:
+                extracted.finish()
+
+        futures = []
+        for bundle_id, chunks in _plan_extraction(extracted_files):
+            if stream and not os.path.isfile(self.fspath(self.bundle_path(bundle_id))):
+                futures.append(executor.submit(self._stream_bundle_chunks, chunks))
+            else:
+                futures.append(executor.submit(self._extract_bundle_chunks, bundle_id, chunks))
+        done, not_done = wait_futures(futures, return_when=FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        wait_futures(not_done)
+        try:
+            for future in done:
+                future.result()
+        except:
+            for extracted in extracted_files:
+                extracted.abort()
+            raise
+
+    def _extract_bundle_chunks(self, bundle_id, chunks):
+        for chunk, writes in chunks:
+            data = zstd_decompress(self.bundles.read(bundle_id, chunk.offset, chunk.size))
+            for extracted, pos in writes:
+                extracted.write_chunk(pos, data)
+
+    def _stream_bundle_chunks(self, chunks):
+        """Download chunks of a bundle and write them directly to their files
+
+        Nearby chunks are downloaded using a single range request. Failed
+        requests are retried, starting at the first chunk not written yet.
+        """
+
+        downloader = self.downloader
+        bundle = chunks[0][0].bundle
+        url = self.url + self.bundle_path(bundle.bundle_id)
+        done = 0  # number of chunks already written
+        attempt = 0
+        while done < len(chunks):
+            ranges = merge_ranges(((chunk.offset, chunk.offset + chunk.size) for chunk, _ in chunks[done:]), self.RANGE_MERGE_GAP)
             try:
-                os.remove(output)
-            except OSError:
-                pass
-            output_dir = os.path.dirname(output)
-            os.makedirs(output_dir, exist_ok=True)
-            os.symlink(os.path.relpath(real_output, output_dir), output)
+                with downloader.limiter:
+                    for start, end in ranges:
+                        logger.debug(f"stream range {start}-{end} of {url}")
+                        headers = {"Range": f"bytes={start}-{end-1}"}
+                        with downloader.session.get(url, headers=headers, stream=True, timeout=downloader.timeout) as r:
+                            r.raise_for_status()
+                            reader = RequestStreamReader(r)
+                            if r.status_code == 206:
+                                reader.pos = start
+                            else:
+                                end = bundle.size  # ranges not supported, use the whole bundle
+                            while done < len(chunks) and chunks[done][0].offset < end:
+                                chunk, writes = chunks[done]
+                                reader.skip_to(chunk.offset)
+                                parts = []
+                                reader.copy(parts.append, chunk.size)
+                                downloader.limiter.record(chunk.size)
+                                data = zstd_decompress(b''.join(parts))
+                                if len(data) != chunk.target_size:
+                                    raise ValueError(f"unexpected size for chunk {chunk.chunk_id:016X} of {url}")
+                                for extracted, pos in writes:
+                                    extracted.write_chunk(pos, data)
+                                done += 1
+                        if done == len(chunks):
+                            break
+            except (requests.RequestException, StopIteration) as e:
+                response = getattr(e, 'response', None)
+                if attempt == downloader.retries or (response is not None and 400 <= response.status_code < 500):
+                    raise
+                downloader.limiter.failure()
+                delay = downloader.backoff * 2 ** attempt
+                logger.warning(f"streaming of {url} failed, retry in {delay:.0f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def collect_garbage(self, keep, grace_period=24*3600, dry_run=False):
+        """Remove old releases, and files not used by remaining ones
+
+        The `keep` latest releases of each patchline are kept, with manifests,
+        bundles and extracted files they reference. Other releases and files
+        are removed.
+        Files modified less than `grace_period` seconds ago are not removed.
+        Collection is refused while downloads are running (see
+        `download_lock()`); the grace period protects files used by other
+        processes (e.g. exports).
+
+        Return the number of removed files (or directories) and their size.
+        """
+
+        with self._gc_lock():
+            kept_releases = []
+            old_releases = []
+            base = self.fspath("cdtb/releases")
+            for patchline in sorted(os.listdir(base)) if os.path.isdir(base) else []:
+                if not os.path.isdir(os.path.join(base, patchline)):
+                    continue
+                storage = self if patchline == self.patchline else PatcherStorage(self.path, patchline)
+                releases = list(storage.iter_releases())
+                kept_releases += releases[:keep]
+                old_releases += releases[keep:]
+
+            manifest_ids = set()
+            bundle_ids = set()
+            file_names = set()
+            collect_shared = True
+            for release in kept_releases:
+                manifest_ids |= set(release.manifest_ids().values())
+                refs = release.references()
+                if refs is None:
+                    logger.warning(f"manifests of {release} are not available, don't remove shared files")
+                    collect_shared = False
+                else:
+                    bundle_ids |= refs[0]
+                    file_names |= refs[1]
+
+            removed = [0, 0]
+            min_mtime = time.time() - grace_period
+
+            def remove(path, is_dir=False):
+                if is_dir:
+                    size = sum(os.lstat(os.path.join(root, name)).st_size for root, _, names in os.walk(path) for name in names)
+                else:
+                    size = os.lstat(path).st_size
+                logger.info(f"{'would remove' if dry_run else 'remove'} {path}")
+                if not dry_run:
+                    if is_dir:
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+                removed[0] += 1
+                removed[1] += size
+
+            def remove_unused(directory, is_used):
+                directory = self.fspath(directory)
+                if not os.path.isdir(directory):
+                    return
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_file(follow_symlinks=False) and not is_used(entry.name) and entry.stat(follow_symlinks=False).st_mtime < min_mtime:
+                            remove(entry.path)
+
+            for release in old_releases:
+                remove(release.storage_dir, is_dir=True)
+
+            def is_used_manifest(name):
+                m = re.match(r"^([0-9A-F]{16})\.manifest(?:\.cache)?$", name)
+                return m is None or int(m.group(1), 16) in manifest_ids
+            remove_unused("channels/public/releases", is_used_manifest)
+
+            if collect_shared:
+                def is_used_bundle(name):
+                    m = re.match(r"^([0-9A-F]{16})\.bundle(?:\.ranges)?$", name)
+                    return m is not None and int(m.group(1), 16) in bundle_ids
+                remove_unused("channels/public/bundles", is_used_bundle)
+                remove_unused("cdtb/bundles", is_used_bundle)
+                remove_unused("cdtb/files", lambda name: name in file_names)
+                if not dry_run:
+                    self.bundles.close()
+                    self.sparse_bundles._ranges.clear()
+
+            return tuple(removed)
+
+    @contextmanager
+    def _gc_lock(self):
+        path = self.fspath("cdtb/storage-gc.lock")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            raise RuntimeError(f"storage garbage collection already running (remove {path} if not)")
+        try:
+            os.write(fd, f"{os.getpid()}\n".encode())
+            os.close(fd)
+            # check after taking the lock, downloads check it after registering
+            running = self._running_downloads()
+            if running:
+                raise RuntimeError(f"downloads are running (processes: {', '.join(map(str, sorted(running)))})")
+            yield
+        finally:
+            os.remove(path)
+
+    @contextmanager
+    def download_lock(self):
+        """Prevent storage garbage collection while downloading
+
+        Downloads can run concurrently. Raise a `RuntimeError` if a garbage
+        collection is running.
+        """
+        path = self.fspath(f"cdtb/downloads/{os.getpid()}-{threading.get_ident()}.lock")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(f"{os.getpid()}\n")
+        try:
+            if os.path.exists(self.fspath("cdtb/storage-gc.lock")):
+                raise RuntimeError("storage garbage collection is running, retry later")
+            yield
+        finally:
+            os.remove(path)
+
+    def _running_downloads(self):
+        """Return PIDs of processes downloading to the storage, remove stale locks"""
+        directory = self.fspath("cdtb/downloads")
+        pids = set()
+        if not os.path.isdir(directory):
+            return pids
+        for name in os.listdir(directory):
+            m = re.match(r"^(\d+)-\d+\.lock$", name)
+            if m is None:
+                continue
+            pid = int(m.group(1))
+            if _is_process_running(pid):
+                pids.add(pid)
+            else:
+                logger.debug(f"remove stale download lock: {name}")
+                try:
+                    os.remove(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+        return pids
+
+    def link_extracted_file(self, source, output):
+        """Link an extracted file, from another release, to a new output path
+
+        Symlinks to shared extracted files are duplicated. Other files are
+        hardlinked, or copied if hardlinks are not supported. Files of other
+        releases are never symlinked, since they may be removed.
+        """
+        if os.path.islink(source):
+            self._symlink_extracted_file(os.path.realpath(source), output)
+            return
+        logger.debug(f"link {source} to {output}")
+        try:
+            os.remove(output)
+        except OSError:
+            pass
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        try:
+            os.link(source, output)
+        except OSError:
+            tmp_path = f"{output}.{os.getpid()}.tmp"
+            try:
+                shutil.copyfile(source, tmp_path)
+                os.replace(tmp_path, output)
+            except:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+
+    @staticmethod
+    def _symlink_extracted_file(real_output, output):
+        logger.debug(f"symlink {real_output} to {output}")
+        try:
+            os.remove(output)
+        except OSError:
+            pass
+        output_dir = os.path.dirname(output)
+        os.makedirs(output_dir, exist_ok=True)
+        os.symlink(os.path.relpath(real_output, output_dir), output)
 
 
 class PatcherRelease:
@@ -478,6 +1210,7 @@ class PatcherRelease:
         self.storage_dir = f"{storage.base_release_path()}/{version}"
         with open(f"{self.storage_dir}/release.json") as f:
             self.data = json.load(f)
+        self._extracted_sizes = None
 
     def __str__(self):
         return f"patcher:v{self.version}"
@@ -485,6 +1218,73 @@ class PatcherRelease:
     def __repr__(self):
         return f"<{self.__class__.__qualname__} {self.version}>"
 
+    REFS_CACHE_VERSION = 1
+
+    def extracted_file_sizes(self) -> Dict[str, int]:
+        """Return the size of extracted files, indexed by file name
+
+        The `files/` directory is scanned once. The returned dict is then
+        updated by elements when they extract files.
+        """
+
+        if self._extracted_sizes is None:
+            sizes = {}
+            dirs = [(f"{self.storage_dir}/files", "")]
+            while dirs:
+                path, prefix = dirs.pop()
+                try:
+                    it = os.scandir(path)
+                except FileNotFoundError:
+                    continue
+                with it:
+                    for entry in it:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                dirs.append((entry.path, f"{prefix}{entry.name}/"))
+                            elif entry.is_file():
+                                sizes[f"{prefix}{entry.name}"] = entry.stat().st_size
+                        except OSError:
+                            pass  # removed while being scanned
+            self._extracted_sizes = sizes
+        return self._extracted_sizes
+
+    def manifest_ids(self):
+        """Return the manifest ID of each element"""
+        return {name: int(os.path.splitext(os.path.basename(self.storage.manifest_path(self.data[f"{name}_patch_url"])))[0], 16)
+                for name in self.available_elements()}
+
+    def references(self):
+        """Return IDs of bundles and names of shared extracted files used by the release
+
+        Return `(bundle_ids, file_names)`, or None if a manifest is not available.
+        References are cached in the release directory.
+        """
+
+        cache_path = f"{self.storage_dir}/refs.cache"
+        try:
+            with open(cache_path, "rb") as f:
+                version, bundle_ids, file_names = marshal.load(f)
+            if version == self.REFS_CACHE_VERSION:
+                return set(bundle_ids), set(file_names)
+        except FileNotFoundError:
+            pass
+        except (EOFError, ValueError, TypeError):
+            logger.warning(f"ignore invalid references cache: {cache_path}")
+
+        bundle_ids = set()
+        file_names = set()
+        for manifest_id in self.manifest_ids().values():
+            path = self.storage.fspath(self.storage.manifest_path(manifest_id))
+            if not os.path.isfile(path):
+                return None
+            manif = PatcherManifest(path)
+            bundle_ids.update(bundle.bundle_id for bundle in manif.bundles)
+            file_names.update(f.hexdigest() for f in manif.files.values() if not f.link)
+
+        with write_file_or_remove(cache_path) as f:
+            marshal.dump((self.REFS_CACHE_VERSION, list(bundle_ids), list(file_names)), f)
+        return bundle_ids, file_names
+
     def element(self, name) -> Optional['PatcherReleaseElement']:
         """Retrieve element with given name, None if not available"""
 
@@ -521,6 +1321,9 @@ class PatcherReleaseElement:
     Element of a release (game or client)
     """
 
+    # files to download and extract first (used to retrieve the patch version)
+    PRIORITY_FILES = ('content-metadata.json', 'system.yaml')
+
     def __init__(self, release: PatcherRelease, name):
         self.release = release
         self.name = name
@@ -542,36 +1345,170 @@ class PatcherReleaseElement:
     def __repr__(self):
         return f"<{self.__class__.__qualname__} {self.release.version} {self.name}>"
 
+    def _files_to_download(self, langs=True, skip_extracted=False) -> List[PatcherFile]:
+        files = [f for f in self.manif.filter_files(langs) if not f.link]
+        if skip_extracted:
+            files = [f for f in files if not self.is_extracted_file(f)]
+        return files
+
     def bundle_ids(self, langs=True, skip_extracted=False) -> set:
         """Return IDs of bundles used by the element as a set"""
 
-        files = [f for f in self.manif.filter_files(langs) if not f.link]
-        if skip_extracted:
-            files = (f for f in files if not self.is_extracted_file(f))
+        files = self._files_to_download(langs=langs, skip_extracted=skip_extracted)
         return {chunk.bundle.bundle_id for f in files for chunk in f.chunks}
 
+    def bundles(self, langs=True, skip_extracted=False) -> List[PatcherBundle]:
+        """Return bundles used by the element, sorted by ID"""
+
+        files = self._files_to_download(langs=langs, skip_extracted=skip_extracted)
+        bundles = {chunk.bundle.bundle_id: chunk.bundle for f in files for chunk in f.chunks}
+        return [bundles[bundle_id] for bundle_id in sorted(bundles)]
+
     def download_bundles(self, langs=True, skip_extracted=True):
-        """Download bundles from CDN"""
+        """Download bundles from CDN
 
-        logger.info(f"download bundles for {self}")
-        ThreadPool(8).map(self.release.storage.download_bundle, sorted(self.bundle_ids(langs=langs, skip_extracted=skip_extracted)), 1)
+        If the storage uses range requests, only needed chunks are downloaded.
+        """
 
-    def extract(self, langs=True, overwrite=False):
-        """Extract files to the storage"""
+        storage = self.release.storage
+        if storage.use_range_requests:
+            logger.info(f"download chunks for {self}")
+            files = self._files_to_download(langs=langs, skip_extracted=skip_extracted)
+            storage.fetch_chunks(chunk for f in files for chunk in f.chunks)
+        else:
+            logger.info(f"download bundles for {self}")
+            storage.download_bundles(self.bundles(langs=langs, skip_extracted=skip_extracted))
+
+    def extract(self, langs=True, overwrite=False, stream=False):
+        """Extract files to the storage
 
-        logger.info(f"extract files from {self}")
+        If `stream` is true, bundles are not needed: chunks are downloaded and
+        extracted on the fly, see `PatcherStorage.extract_files()`.
+        """
+
+        logger.info(f"{'stream' if stream else 'extract'} files from {self}")
         files = [f for f in self.manif.filter_files(langs) if not f.link]
-        for file in sorted(files, key=lambda f: f.name):
-            self.extract_file(file, overwrite=overwrite)
+        if not overwrite:
+            files = [f for f in files if not self.is_extracted_file(f)]
+        self.release.storage.extract_files(((file, self.extract_path(file)) for file in sorted(files, key=lambda f: f.name)), stream=stream)
+        self._set_extracted(files)
+
+    def download_and_extract(self, langs=True):
+        """Download bundles and extract files, extract files while downloading
+
+        Bundles are downloaded in an order allowing to extract files early,
+        starting with `PRIORITY_FILES`. Each file is extracted by a separate
+        thread as soon as all its bundles are available.
+
+        With range requests, chunks are downloaded, then files are extracted.
+        """
+
+        storage = self.release.storage
+        if storage.use_range_requests:
+            self.download_bundles(langs=langs)
+            self.extract(langs=langs)
+            return
+
+        logger.info(f"download bundles and extract files for {self}")
+        files_bundles = []
+        waiting = {}  # {bundle_id: [file_index]}
+        remaining = []  # number of missing bundles, per file
+        bundles = {}
+        for i, file in enumerate(self._files_to_download(langs=langs, skip_extracted=True)):
+            missing = set()
+            for chunk in file.chunks:
+                bundle_id = chunk.bundle.bundle_id
+                bundles[bundle_id] = chunk.bundle
+                if bundle_id not in missing and not os.path.isfile(storage.fspath(storage.bundle_path(bundle_id))):
+                    missing.add(bundle_id)
+                    waiting.setdefault(bundle_id, []).append(i)
+            files_bundles.append((file, missing))
+            remaining.append(len(missing))
+
+        ready = queue.Queue()
+        lock = threading.Lock()
+
+        def on_bundle_downloaded(bundle):
+            with lock:
+                for i in waiting.pop(bundle.bundle_id, ()):
+                    remaining[i] -= 1
+                    if not remaining[i]:
+                        ready.put(files_bundles[i][0])
+
+        def extract_ready_files():
+            error = None
+            done = False
+            while not done:
+                files = [ready.get()]
+                while len(files) < storage.EXTRACT_BATCH_SIZE:
+                    try:
+                        files.append(ready.get_nowait())
+                    except queue.Empty:
+                        break
+                done = any(f is None for f in files)
+                files = [f for f in files if f is not None]
+                if files and error is None:
+                    try:
+                        storage.extract_files((f, self.extract_path(f)) for f in files)
+                        self._set_extracted(files)
+                    except Exception as e:
+                        # keep consuming the queue, to not block downloads
+                        logger.error(f"failed to extract files from {self}: {e}")
+                        error = e
+            if error is not None:
+                raise error
+
+        with ThreadPoolExecutor(1) as executor:
+            extraction = executor.submit(extract_ready_files)
+            try:
+                for (file, _), count in zip(files_bundles, remaining):
+                    if not count:
+                        ready.put(file)
+                order = _order_bundles(files_bundles, self.PRIORITY_FILES)
+                storage.download_bundles((bundles[bundle_id] for bundle_id in order), callback=on_bundle_downloaded)
+            finally:
+                ready.put(None)
+            extraction.result()
+
+    def download_delta(self, previous: 'PatcherReleaseElement', langs=True, stream=False):
+        """Download and extract files, reuse files unchanged since a previous release
+
+        Unchanged files already extracted in `previous` are linked from it.
+        Other files are downloaded and extracted as usual (or streamed).
+        """
+
+        diff = previous.manif.diff(self.manif)
+        logger.info(f"download {self} from {previous}: {len(diff.added)} added files, {len(diff.changed)} changed files")
+        storage = self.release.storage
+        predicate = PatcherFile.langs_predicate(langs)
+        for file in diff.unchanged:
+            if file.link or not predicate(file) or self.is_extracted_file(file):
+                continue
+            previous_file = previous.manif.files[file.name]
+            if previous.is_extracted_file(previous_file):
+                storage.link_extracted_file(previous.extract_path(previous_file), self.extract_path(file))
+                self._set_extracted([file])
+
+        if stream:
+            self.extract(langs=langs, stream=True)
+        else:
+            self.download_and_extract(langs=langs)
 
     def extract_path(self, file: PatcherFile):
         """Return the path to which a file is extracted"""
         return f"{self.release.storage_dir}/files/{file.name}"
 
     def is_extracted_file(self, file: PatcherFile) -> bool:
-        """Return True if `file` is already extracted"""
-        output = self.extract_path(file)
-        return os.path.isfile(output) and os.path.getsize(output) == file.size
+        """Return True if `file` is already extracted
+
+        Extracted files are looked up in `PatcherRelease.extracted_file_sizes()`.
+        """
+        return self.release.extracted_file_sizes().get(file.name) == file.size
+
+    def _set_extracted(self, files: Iterable[PatcherFile]):
+        sizes = self.release.extracted_file_sizes()
+        for file in files:
+            sizes[file.name] = file.size
 
     def extract_file(self, file: PatcherFile, overwrite=False):
         """Extract a single file"""
@@ -580,6 +1517,7 @@ class PatcherReleaseElement:
             logger.debug(f"skip {file.name}: already extracted")
         else:
             self.release.storage.extract_file(file, self.extract_path(file))
+            self._set_extracted([file])
 
     def patch_version(self) -> Optional[PatchVersion]:
         """Return patch version or None if there is none
@@ -626,8 +1564,11 @@ class PatcherReleaseElement:
         file = self.manif.files[file_name]
         # download and extract file if needed
         if not self.is_extracted_file(file):
-            for bundle_id in {chunk.bundle.bundle_id for chunk in file.chunks}:
-                self.release.storage.download_bundle(bundle_id)
+            storage = self.release.storage
+            if storage.use_range_requests:
+                storage.fetch_chunks(file.chunks)
+            else:
+                storage.download_bundles({chunk.bundle.bundle_id: chunk.bundle for chunk in file.chunks}.values())
         self.extract_file(file)
 
         version = extractor(self.extract_path(file))
@@ -642,9 +1583,20 @@ class PatcherPatchElement(PatchElement):
         version = elem.patch_version()
         super().__init__(elem.name, version)
 
-    def download(self, langs=True):
-        self.elem.download_bundles(langs=langs)
-        self.elem.extract(langs=langs)
+    def download(self, langs=True, delta_from: Optional['PatcherPatchElement'] = None, stream=False):
+        """Download files of this element
+
+        If `delta_from` is set, files unchanged since this element are reused.
+        If `stream` is true, files are extracted on the fly, bundles are not
+        stored.
+        """
+        with self.elem.release.storage.download_lock():
+            if delta_from is not None:
+                self.elem.download_delta(delta_from.elem, langs=langs, stream=stream)
+            elif stream:
+                self.elem.extract(langs=langs, stream=True)
+            else:
+                self.elem.download_and_extract(langs=langs)
 
     def fspaths(self, langs=True):
         return (self.elem.extract_path(f) for f in self.elem.manif.filter_files(langs=langs))
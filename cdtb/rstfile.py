@@ -1,7 +1,16 @@
+import os
+import mmap
+import marshal
+import logging
 from base64 import b64encode
+from collections.abc import Mapping
+from typing import Dict
+import numpy as np
 from xxhash import xxh3_64_intdigest, xxh64_intdigest
-from .tools import BinaryParser
-from .hashes import HashFile, default_hash_dir
+from .tools import BinaryParser, write_file_or_remove
+from .hashes import HashFile, default_hash_dir, default_cache_dir
+
+logger = logging.getLogger(__name__)
 
 
 def get_hashfile(game_version=1415):
@@ -13,17 +22,177 @@ def get_hashfile(game_version=1415):
 def key_to_hash(key, bits=64, rsthash_version=1415):
     if isinstance(key, str):
         if rsthash_version >= 1415:
-            key = xxh3_64_intdigest(key.lower())
+            key = xxh3_64_intdigest(key.lower().encode())
         else:
-            key = xxh64_intdigest(key.lower())
+            key = xxh64_intdigest(key.lower().encode())
     return key & ((1 << bits) - 1)
 
 
 hashfile_rst_xxh64 = HashFile(default_hash_dir / "hashes.rst.xxh64.txt", hash_size=16)
 hashfile_rst_xxh3 = HashFile(default_hash_dir / "hashes.rst.xxh3.txt", hash_size=16)
 
+
+# {(hash file path, bits): (hash file stat, hashes)}
+_truncated_hashes_cache = {}
+# to update when the format of cache files changes
+_TRUNCATED_HASHES_CACHE_VERSION = 1
+
+def load_truncated_hashes(hashfile: HashFile, bits) -> Dict[int, str]:
+    """Return hashes of a hash file truncated to `bits`, as used in RST files
+
+    Truncated hashes are computed once, then cached in memory and in a cache
+    file under `default_cache_dir()`. Caches are updated if the hash file
+    changes. Failing to write the cache file is not an error.
+    """
+
+    path = str(hashfile.filename)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Hash file not found; try to run 'fetch-hashes' command: {path}")
+    stat_key = (_TRUNCATED_HASHES_CACHE_VERSION, st.st_size, st.st_mtime_ns, bits)
+
+    cached = _truncated_hashes_cache.get((path, bits))
+    if cached is not None and cached[0] == stat_key:
+        return cached[1]
+
+    # hash files with the same name may be used from different directories
+    cache_name = f"{os.path.basename(path)}.{xxh3_64_intdigest(os.path.abspath(path).encode()):016x}.{bits}bits.cache"
+    cache_path = os.path.join(default_cache_dir(), "rst", cache_name)
+    hashes = None
+    try:
+        with open(cache_path, 'rb') as f:
+            cache_key, cache_hashes = marshal.load(f)
+        if cache_key == stat_key:
+            hashes = cache_hashes
+    except OSError:
+        pass
+    except (EOFError, ValueError, TypeError):
+        logger.warning(f"ignore invalid truncated RST hashes cache: {cache_path}")
+
+    if hashes is None:
+        logger.debug(f"compute RST hashes truncated to {bits} bits")
+        full_hashes = hashfile.load()
+        keys = np.fromiter(full_hashes.keys(), dtype=np.uint64, count=len(full_hashes))
+        keys &= np.uint64((1 << bits) - 1)
+        hashes = dict(zip(keys.tolist(), full_hashes.values()))
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            with write_file_or_remove(tmp_path) as f:
+                marshal.dump((stat_key, hashes), f)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.debug(f"cannot write truncated RST hashes cache: {e}")
+
+    _truncated_hashes_cache[(path, bits)] = (stat_key, hashes)
+    return hashes
+
+class RstEntries(Mapping):
+    """Strings of an RST file, indexed by hash
+
+    Only string offsets are stored. Strings are decoded from the file data
+    when accessed.
+    """
+
+    def __init__(self, offsets, data, has_trenc=False):
+        self._offsets = offsets  # {hash: offset}
+        self._data = data
+        self._has_trenc = has_trenc
+
+    def __getitem__(self, h):
+        return decode_rst_string(self._data, self._offsets[h], self._has_trenc)
+
+    def __contains__(self, h):
+        return h in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+class SortedRstEntries(Mapping):
+    """Strings of an RST file, looked up in a sorted array of hashes
+
+    Sorting hashes is much faster than building a dict, but lookups are
+    slower. It is intended for files used for a few lookups.
+    Strings are decoded from `data` when accessed. `hashes` are the sorted
+    hashes, `offsets` the offsets of their string in `data`. Entries are
+    iterated in hash order.
+    """
+
+    def __init__(self, hashes, offsets, data, has_trenc=False):
+        # sort by hash, then by position, to find the last of duplicates
+        # position is stored in low bits of sort keys, it's faster than a stable sort
+        index_bits = max(len(hashes) - 1, 0).bit_length()
+        if len(hashes) and int(hashes.max()) >> (64 - index_bits) == 0:
+            keys = (hashes << np.uint64(index_bits)) | np.arange(len(hashes), dtype=np.uint64)
+            keys.sort()
+            order = keys & np.uint64((1 << index_bits) - 1)
+        else:
+            order = np.argsort(hashes, kind='stable')
+        hashes = hashes[order]
+        offsets = offsets[order]
+        # on duplicates, keep the last entry, like a dict
+        if len(hashes):
+            last = np.empty(len(hashes), dtype=bool)
+            np.not_equal(hashes[1:], hashes[:-1], out=last[:-1])
+            last[-1] = True
+            hashes = hashes[last]
+            offsets = offsets[last]
+        self.hashes = hashes
+        self.offsets = offsets
+        self.data = data
+        self.has_trenc = has_trenc
+
+    def _find(self, h):
+        """Return the index of a hash, None if not found"""
+        if not isinstance(h, int) or not 0 <= h < 1 << 64:
+            return None
+        i = int(np.searchsorted(self.hashes, np.uint64(h)))
+        if i < len(self.hashes) and self.hashes[i] == h:
+            return i
+        return None
+
+    def __getitem__(self, h):
+        i = self._find(h)
+        if i is None:
+            raise KeyError(h)
+        return decode_rst_string(self.data, int(self.offsets[i]), self.has_trenc)
+
+    def __contains__(self, h):
+        return self._find(h) is not None
+
+    def __iter__(self):
+        return iter(self.hashes.tolist())
+
+    def __len__(self):
+        return len(self.hashes)
+
+def decode_rst_string(data, offset, has_trenc=False):
+    """Decode an RST string from file data"""
+    # Files are sometimes messed-up (e.g. windows-1252 quote)
+    # Don't fail on UTF-8 decoding errors
+    if has_trenc and data[offset] == 0xFF:
+        size = int.from_bytes(data[offset+1:offset+3], 'little')
+        d = b64encode(data[offset+3:offset+3+size])
+    else:
+        end = data.find(b"\0", offset)
+        d = data[offset:end]
+    return d.decode('utf-8', 'replace')
+
+
 class RstFile:
-    def __init__(self, path_or_f=None, game_version=1502):
+    def __init__(self, path_or_f=None, game_version=1502, use_mmap=False):
+        """
+        Parse an RST file
+
+        If `use_mmap` is set, strings are read from a memory-mapped file and
+        `entries` is a `SortedRstEntries`. Loading is faster and uses less
+        memory, it is intended to lookup a small part of the strings.
+        The file object must have a `fileno()`.
+        """
         self.font_config = None
         self.entries = {}
         self.hash_bits = 40
@@ -33,9 +202,9 @@ class RstFile:
         if path_or_f is not None:
             if isinstance(path_or_f, str):
                 with open(path_or_f, "rb") as f:
-                    self.parse_rst(f)
+                    self.parse_rst(f, use_mmap)
             else:
-                self.parse_rst(path_or_f)
+                self.parse_rst(path_or_f, use_mmap)
 
     def __getitem__(self, key):
         try:
@@ -57,7 +226,7 @@ class RstFile:
         except KeyError:
             return default
 
-    def parse_rst(self, f):
+    def parse_rst(self, f, use_mmap=False):
         parser = BinaryParser(f)
 
         magic, version = parser.unpack("<3sB")
@@ -80,27 +249,20 @@ class RstFile:
             raise ValueError(f"unsupported RST version: {version}")
         self.version = version
 
-        hash_mask = (1 << self.hash_bits) - 1
         count, = parser.unpack("<L")
-        entries = []
-        for _ in range(count):
-            v, = parser.unpack("<Q")
-            entries.append((v >> self.hash_bits, v & hash_mask))
+        # each entry is an offset in string data followed by a hash
+        table = np.frombuffer(parser.raw(8 * count), dtype='<u8')
+        hashes = table & np.uint64((1 << self.hash_bits) - 1)
+        offsets = table >> np.uint64(self.hash_bits)
 
         has_trenc = False
         if version < 5:
             has_trenc = parser.unpack("<B")[0]
 
-        data = parser.f.read()
-
-        # Files are sometimes messed-up (e.g. windows-1252 quote)
-        # Don't fail on UTF-8 decoding errors
-        for i, h in entries:
-            if has_trenc and data[i] == 0xFF:
-                size = int.from_bytes(data[i+1:][:2], 'little')
-                d = b64encode(data[i+3:][:size])
-                self.entries[h] = d.decode('utf-8', 'replace')
-            else:
-                end = data.find(b"\0", i)
-                d = data[i:end]
-                self.entries[h] = d.decode('utf-8', 'replace')
+        if use_mmap:
+            # the mapping remains valid after the file is closed
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.entries = SortedRstEntries(hashes, offsets + np.uint64(f.tell()), data, has_trenc)
+        else:
+            data = f.read()
+            self.entries = RstEntries(dict(zip(hashes.tolist(), offsets.tolist())), data, has_trenc)
@@ -0,0 +1,203 @@
+import os
+import mmap
+import struct
+import logging
+from typing import Dict, Iterable, List, Optional
+import numpy as np
+from xxhash import xxh3_128
+
+from .hashes import default_cache_dir
+from .rstfile import RstFile, decode_rst_string, key_to_hash
+from .tools import write_file_or_remove
+
+logger = logging.getLogger(__name__)
+
+
+class RstStore:
+    """Strings of the RST files of several languages, merged in a single table
+
+    Entries are indexed by key hash. For each hash, the table stores the
+    offset of the string of each language in a shared data blob. Strings are
+    decoded when looked up.
+    All merged files must use the same hash format.
+
+    A store is built from RST files with `build()`, can be saved, then loaded
+    (memory-mapped) with `load()`.
+    """
+
+    MAGIC = b'CRSS'
+    VERSION = 1
+    MISSING = 0xFFFFFFFF  # offset of missing strings
+
+    def __init__(self, langs, hash_bits, game_version, trenc, hashes, offsets, data, data_start=0):
+        self.langs: List[str] = list(langs)
+        self.hash_bits = hash_bits
+        self.game_version = game_version
+        self.trenc = trenc  # per-language "trenc" flag, see `decode_rst_string()`
+        self.hashes = hashes  # sorted hashes
+        self.offsets = offsets  # offset of each string, as a `hashes × langs` array
+        self.data = data
+        self.data_start = data_start  # position of string data in `data`
+        self._lang_indexes = {lang: i for i, lang in enumerate(self.langs)}
+
+    @classmethod
+    def build(cls, paths: Dict[str, str], game_version=1502) -> 'RstStore':
+        """Merge RST files, given as `{lang: path}`"""
+
+        logger.debug(f"merge RST files of {len(paths)} languages")
+        tables = []
+        hash_bits = None
+        for lang, path in paths.items():
+            rst = RstFile(path, game_version, use_mmap=True)
+            if hash_bits is None:
+                hash_bits = rst.hash_bits
+            elif rst.hash_bits != hash_bits:
+                raise ValueError(f"hash size of '{lang}' strings mismatches other languages")
+            tables.append(rst.entries)
+
+        hashes = np.unique(np.concatenate([t.hashes for t in tables])) if tables else np.empty(0, dtype=np.uint64)
+        offsets = np.full((len(hashes), len(tables)), cls.MISSING, dtype=np.uint32)
+        chunks = []
+        data_size = 0
+        for i, table in enumerate(tables):
+            # copy string data, skip file headers
+            start = int(table.offsets.min()) if len(table.offsets) else 0
+            chunk = table.data[start:]
+            offsets[np.searchsorted(hashes, table.hashes), i] = table.offsets.astype(np.int64) - start + data_size
+            chunks.append(chunk)
+            data_size += len(chunk)
+        if data_size >= cls.MISSING:
+            raise ValueError("too much string data to be merged")
+
+        trenc = [table.has_trenc for table in tables]
+        return cls(paths.keys(), hash_bits, game_version, trenc, hashes, offsets, b''.join(chunks))
+
+    def save(self, path):
+        with write_file_or_remove(path) as f:
+            f.write(self.MAGIC)
+            f.write(struct.pack('<LLLLL', self.VERSION, self.hash_bits, self.game_version, len(self.hashes), len(self.langs)))
+            for lang, trenc in zip(self.langs, self.trenc):
+                encoded = lang.encode('ascii')
+                f.write(struct.pack('<B', len(encoded)) + encoded + struct.pack('<?', trenc))
+            f.write(b'\0' * (-f.tell() % 8))  # align arrays
+            f.write(self.hashes.astype('<u8').tobytes())
+            f.write(self.offsets.astype('<u4').tobytes())
+            f.write(self.data[self.data_start:])
+
+    @classmethod
+    def load(cls, path) -> 'RstStore':
+        """Load a saved store, memory-map its data"""
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:4] != cls.MAGIC:
+            raise ValueError("invalid RST store magic code")
+        version, hash_bits, game_version, nhashes, nlangs = struct.unpack_from('<LLLLL', data, 4)
+        if version != cls.VERSION:
+            raise ValueError(f"unsupported RST store version: {version}")
+        pos = 24
+        langs = []
+        trenc = []
+        for _ in range(nlangs):
+            n = data[pos]
+            langs.append(data[pos+1:pos+1+n].decode('ascii'))
+            trenc.append(data[pos+1+n] != 0)
+            pos += n + 2
+        pos += -pos % 8
+        hashes = np.frombuffer(data, dtype='<u8', count=nhashes, offset=pos)
+        pos += 8 * nhashes
+        offsets = np.frombuffer(data, dtype='<u4', count=nhashes * nlangs, offset=pos).reshape(nhashes, nlangs)
+        pos += 4 * nhashes * nlangs
+        return cls(langs, hash_bits, game_version, trenc, hashes, offsets, data, pos)
+
+    def _find(self, hashes):
+        """Return indexes of given hashes and a mask of found ones"""
+        indexes = np.searchsorted(self.hashes, hashes)
+        found = indexes < len(self.hashes)
+        found[found] = self.hashes[indexes[found]] == hashes[found]
+        return indexes, found
+
+    def lookup(self, key, lang) -> Optional[str]:
+        """Return the string of a key (string or hash) in a language, None if not found"""
+        return self.lookup_many([key], [lang])[lang][0]
+
+    def lookup_many(self, keys: Iterable, langs: Optional[Iterable[str]] = None) -> Dict[str, List[Optional[str]]]:
+        """Lookup several keys, for several languages (default: all)
+
+        Return a list of strings for each language, `None` for keys not found.
+        """
+        keys = list(keys)
+        langs = self.langs if langs is None else list(langs)
+        hashes = np.fromiter((key_to_hash(key, self.hash_bits, self.game_version) for key in keys), dtype=np.uint64, count=len(keys))
+        indexes, found = self._find(hashes)
+
+        data = self.data
+        start = self.data_start
+        ret = {}
+        for lang in langs:
+            i = self._lang_indexes[lang]
+            trenc = self.trenc[i]
+            offsets = np.full(len(keys), self.MISSING, dtype=np.uint32)
+            offsets[found] = self.offsets[indexes[found], i]
+            ret[lang] = [None if offset == self.MISSING else decode_rst_string(data, start + offset, trenc)
+                         for offset in offsets.tolist()]
+        return ret
+
+    def translations(self, keys: Iterable[str], langs: Optional[Iterable[str]] = None) -> Dict[str, Dict[str, str]]:
+        """Return translations of keys, as `{lang: {key: string}}`
+
+        Keys not found are not included.
+        """
+        keys = list(keys)
+        return {lang: {k: v for k, v in zip(keys, values) if v is not None}
+                for lang, values in self.lookup_many(keys, langs).items()}
+
+
+def load_rst_store(paths: Dict[str, str], game_version=1502) -> RstStore:
+    """Merge RST files, given as `{lang: path}`, reuse a cached store if any
+
+    Stores are cached under `default_cache_dir()`, by content of merged files.
+    Failing to write the cache file is not an error.
+    """
+
+    h = xxh3_128()
+    h.update(struct.pack('<LL', RstStore.VERSION, game_version))
+    for lang, path in paths.items():
+        h.update(lang.encode('ascii') + b'\0')
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        h.update(b'\0')
+    cache_path = os.path.join(default_cache_dir(), "rststore", f"{h.hexdigest()}.rststore")
+
+    try:
+        return RstStore.load(cache_path)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, struct.error):
+        logger.warning(f"ignore invalid RST store cache: {cache_path}")
+
+    store = RstStore.build(paths, game_version)
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        store.save(tmp_path)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logger.debug(f"cannot write RST store cache: {e}")
+    return store
+
+
+def collect_strings(data) -> set:
+    """Collect all strings from nested lists and dicts"""
+    strings = set()
+    def collect(v):
+        if isinstance(v, str):
+            strings.add(v)
+        elif isinstance(v, dict):
+            for x in v.values():
+                collect(x)
+        elif isinstance(v, (list, tuple)):
+            for x in v:
+                collect(x)
+    collect(data)
+    return strings
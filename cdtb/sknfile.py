@@ -1,10 +1,31 @@
+import io
+import json
+import struct
+import numpy as np
 from .tools import BinaryParser
 
 
 class SknFile:
+    """Parse a SKN mesh file
+
+    Vertex and index buffers are read as NumPy arrays, stored in `vertices`
+    and `indices`. Vertices are a structured array with the following fields:
+    `position`, `bone_indices`, `weight`, `normal`, `uv`, and, depending on
+    the vertex type, `color` and `tangent`.
+
+    Each entry of `entries` is a dict with the entry `name`, its `vertices`
+    and `indices`, as views of the file buffers, and its `start_vertex`.
+    Entry indices are not rebased, see `entry_faces()`.
+    """
+
     def __init__(self, file):
         if isinstance(file, str):
-            file = open(file, "rb")
+            with open(file, "rb") as f:
+                self._parse(f)
+        else:
+            self._parse(file)
+
+    def _parse(self, file):
         if file.read(4) != b"\x33\x22\x11\x00":
             raise ValueError("missing magic code")
 
@@ -14,13 +35,13 @@ class SknFile:
 
         if self.major == 0:
             index_count, vertex_count = f.unpack("<II")
-            indices = [(f.unpack("<H")[0] + 1) for i in range(index_count)]
-            vertices = [self.read_vertex(f) for i in range(vertex_count)]
-            self.entries = [{"name": "Unknown", "vertices": vertices, "indices": indices}]
+            self.indices = self.read_indices(f, index_count)
+            self.vertices = self.read_vertices(f, vertex_count)
+            self.entries = [{"name": "Unknown", "vertices": self.vertices, "indices": self.indices, "start_vertex": 0}]
             return
 
         count, = f.unpack("<I")
-        self.entries = [self.read_object(f) for i in range(count)]
+        objects = [self.read_object(f) for i in range(count)]
 
         if self.major == 4:
             self.unknown, = f.unpack("<I")
@@ -35,21 +56,18 @@ class SknFile:
             self.bounding_sphere_location = f.unpack("<fff")
             self.bounding_sphere_radius, = f.unpack("<f")
 
-        indices = [(f.unpack("<H")[0] + 1) for i in range(index_count)]
-        vertices = [self.read_vertex(f) for i in range(vertex_count)]
+        self.indices = self.read_indices(f, index_count)
+        self.vertices = self.read_vertices(f, vertex_count)
 
-        for entry in self.entries:
-            entry["vertices"] = vertices[entry["start_vertex"] : entry["start_vertex"] + entry["vertex_count"]]
-            entry["indices"] = [
-                x - (0 if x < entry["start_vertex"] else entry["start_vertex"])
-                for x in indices[entry["start_index"] : entry["start_index"] + entry["index_count"]]
-            ]
-
-            # remove redundant information
-            del entry["start_vertex"]
-            del entry["start_index"]
-            del entry["vertex_count"]
-            del entry["index_count"]
+        self.entries = []
+        for obj in objects:
+            start_vertex, start_index = obj["start_vertex"], obj["start_index"]
+            self.entries.append({
+                "name": obj["name"],
+                "vertices": self.vertices[start_vertex : start_vertex + obj["vertex_count"]],
+                "indices": self.indices[start_index : start_index + obj["index_count"]],
+                "start_vertex": start_vertex,
+            })
 
     def read_object(self, f):
         return {
@@ -60,26 +78,144 @@ class SknFile:
             "index_count": f.unpack("<I")[0],
         }
 
-    def read_vertex(self, f):
-        return {
-            "position": f.unpack("<fff"),
-            "bone_indices": f.unpack("<BBBB"),
-            "weight": f.unpack("<ffff"),
-            "normal": f.unpack("<fff"),
-            "uv": f.unpack("<ff"),
-            "color": f.unpack("<BBBB") if hasattr(self, "vertex_type") and self.vertex_type >= 1 else None,
-            "tangent": f.unpack("<ffff") if hasattr(self, "vertex_type") and self.vertex_type == 2 else None
+    def vertex_dtype(self):
+        """Return the NumPy dtype of vertices"""
+        fields = [
+            ("position", "<f4", 3),
+            ("bone_indices", "u1", 4),
+            ("weight", "<f4", 4),
+            ("normal", "<f4", 3),
+            ("uv", "<f4", 2),
+        ]
+        vertex_type = getattr(self, "vertex_type", 0)
+        if vertex_type >= 1:
+            fields.append(("color", "u1", 4))
+        if vertex_type == 2:
+            fields.append(("tangent", "<f4", 4))
+        return np.dtype(fields)
+
+    def read_indices(self, f, count):
+        return np.frombuffer(f.raw(2 * count), dtype="<u2", count=count)
+
+    def read_vertices(self, f, count):
+        dtype = self.vertex_dtype()
+        if getattr(self, "vertex_size", dtype.itemsize) != dtype.itemsize:
+            raise ValueError(f"unexpected vertex size for vertex type {self.vertex_type}: {self.vertex_size}")
+        return np.frombuffer(f.raw(dtype.itemsize * count), dtype=dtype, count=count)
+
+    @staticmethod
+    def entry_faces(entry):
+        """Return 1-based indices of entry vertices, as a `(faces, 3)` array"""
+        indices = entry["indices"].astype(np.int64) + 1
+        start = entry["start_vertex"]
+        if start:
+            indices = np.where(indices < start, indices, indices - start)
+        count = len(indices) // 3
+        return indices[:count * 3].reshape(count, 3)
+
+    def write_obj(self, entry, f, chunk_size=4096):
+        """Write an entry as an OBJ mesh to a text file object
+
+        Values are formatted by chunks of `chunk_size` vertices or faces.
+        """
+        vertices = entry["vertices"]
+        # interleave values, formatted as Python floats (exact float32 values)
+        values = np.empty((len(vertices), 8), dtype=np.float64)
+        values[:, 0:3] = vertices["position"]
+        values[:, 3:5] = vertices["uv"]
+        values[:, 5:8] = vertices["normal"]
+        vertex_fmt = "v %r %r %r\nvt %r %r\nvn %r %r %r\n"
+        for i in range(0, len(values), chunk_size):
+            chunk = values[i : i + chunk_size]
+            f.write((vertex_fmt * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+        faces = np.repeat(self.entry_faces(entry), 3, axis=1)
+        face_fmt = "f %d/%d/%d %d/%d/%d/ %d/%d/%d\n"
+        for i in range(0, len(faces), chunk_size):
+            chunk = faces[i : i + chunk_size]
+            f.write((face_fmt * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+    def write_glb(self, f):
+        """Write all entries as a binary glTF file, one mesh primitive per entry
+
+        Vertex data is written as is, in a single interleaved buffer view.
+        Primitives use positions, normals, UVs, bone indices and weights.
+        """
+        vertices = self.vertices
+        dtype = vertices.dtype
+        vertices_size = vertices.nbytes
+        buffer_views = [{"buffer": 0, "byteOffset": 0, "byteLength": vertices_size, "byteStride": dtype.itemsize, "target": 34962}]
+        accessors = []
+        primitives = []
+
+        index_arrays = []
+        index_offset = vertices_size + (-vertices_size % 4)
+        for entry in self.entries:
+            vertex_count = len(entry["vertices"])
+            if not vertex_count:
+                continue
+            base_offset = entry["start_vertex"] * dtype.itemsize
+            attributes = {}
+            for attribute, field, gltf_type, component_type in (
+                ("POSITION", "position", "VEC3", 5126),
+                ("NORMAL", "normal", "VEC3", 5126),
+                ("TEXCOORD_0", "uv", "VEC2", 5126),
+                ("JOINTS_0", "bone_indices", "VEC4", 5121),
+                ("WEIGHTS_0", "weight", "VEC4", 5126),
+            ):
+                accessor = {
+                    "bufferView": 0,
+                    "byteOffset": base_offset + dtype.fields[field][1],
+                    "componentType": component_type,
+                    "count": vertex_count,
+                    "type": gltf_type,
+                }
+                if attribute == "POSITION":
+                    positions = entry["vertices"]["position"]
+                    accessor["min"] = positions.min(axis=0).tolist()
+                    accessor["max"] = positions.max(axis=0).tolist()
+                attributes[attribute] = len(accessors)
+                accessors.append(accessor)
+
+            indices = self.entry_faces(entry).ravel() - 1
+            # 0xFFFF is reserved for primitive restart
+            indices = indices.astype("<u2" if vertex_count < 0xFFFF else "<u4")
+            buffer_views.append({"buffer": 0, "byteOffset": index_offset, "byteLength": indices.nbytes, "target": 34963})
+            accessors.append({
+                "bufferView": len(buffer_views) - 1,
+                "componentType": 5123 if indices.dtype.itemsize == 2 else 5125,
+                "count": len(indices),
+                "type": "SCALAR",
+            })
+            padding = -indices.nbytes % 4
+            index_arrays.append((indices, padding))
+            index_offset += indices.nbytes + padding
+            primitives.append({"attributes": attributes, "indices": len(accessors) - 1, "extras": {"name": entry["name"]}})
+
+        gltf = {
+            "asset": {"version": "2.0", "generator": "cdtb"},
+            "scene": 0,
+            "scenes": [{"nodes": [0]}],
+            "nodes": [{"mesh": 0}],
+            "meshes": [{"primitives": primitives}],
+            "buffers": [{"byteLength": index_offset}],
+            "bufferViews": buffer_views,
+            "accessors": accessors,
         }
+        json_data = json.dumps(gltf, separators=(",", ":")).encode("utf-8")
+        json_data += b" " * (-len(json_data) % 4)
+
+        f.write(struct.pack("<4sLL", b"glTF", 2, 12 + 8 + len(json_data) + 8 + index_offset))
+        f.write(struct.pack("<L4s", len(json_data), b"JSON"))
+        f.write(json_data)
+        f.write(struct.pack("<L4s", index_offset, b"BIN\0"))
+        f.write(vertices.data)
+        f.write(b"\0" * (-vertices_size % 4))
+        for indices, padding in index_arrays:
+            f.write(indices.data)
+            f.write(b"\0" * padding)
 
     def to_obj(self, entry) -> str:
-        content = ""
-        for vert in entry["vertices"]:
-            content += "v %s %s %s\n" % vert["position"]
-            content += "vt %s %s\n" % vert["uv"]
-            content += "vn %s %s %s\n" % vert["normal"]
-
-        for i in range(0, len(entry["indices"]), 3):
-            a, b, c = entry["indices"][i : i + 3]
-            content += "f {0}/{0}/{0} {1}/{1}/{1}/ {2}/{2}/{2}\n".format(a, b, c)
-
-        return content
+        f = io.StringIO()
+        self.write_obj(entry, f)
+        return f.getvalue()
@@ -249,10 +249,11 @@ class Storage(metaclass=StorageRegister):
             return
 
         logger.debug(f"download file: {path}")
-        r = self.request_get(urlpath)
-        r.raise_for_status()
-        with write_file_or_remove(fspath) as f:
-            f.write(r.content)
+        with self.request_get(urlpath, stream=True) as r:
+            r.raise_for_status()
+            with write_file_or_remove(fspath) as f:
+                for data in r.iter_content(RequestStreamReader.DOWNLOAD_CHUNK_SIZE):
+                    f.write(data)
 
     @contextmanager
     def stream(self, urlpath) -> RequestStreamReader:
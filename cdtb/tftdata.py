@@ -1,16 +1,22 @@
 import os
 import copy
 from .storage import PatchVersion
-from .binfile import BinFile, BinEmbedded
+from .binfile import BinEmbedded
+from .bincache import load_binfile
 from .rstfile import RstFile
+from .rststore import collect_strings
 from .tools import json_dump, stringtable_paths
 
 
 def load_translations(path, game_version=1502):
+    """Load translations from an RST file or a legacy text file
+
+    RST files are memory-mapped, only looked up strings are decoded.
+    """
     with open(path, "rb") as f:
         if f.read(3) == b"RST":
             f.seek(0)
-            return RstFile(f, game_version)
+            return RstFile(f, game_version, use_mmap=True)
         else:
             translations = {}
             for line in f:
@@ -22,6 +28,17 @@ def load_translations(path, game_version=1502):
                     translations[key] = val
             return translations
 
+def template_translations(template, langs, rst_store=None):
+    """Lookup all strings of a template in a `RstStore`, return them by language
+
+    Languages not in the store (or all of them, if there is no store) are
+    not returned.
+    """
+    if rst_store is None:
+        return {}
+    langs = [lang for lang in langs if lang in rst_store.langs]
+    return rst_store.translations(collect_strings(template), langs)
+
 def collect_effects(data):
     """Collect effects from item or trait data"""
 
@@ -41,7 +58,7 @@ class TftTransformer:
         """Parse bin data into template data"""
         map22_file = os.path.join(self.input_dir, "data", "maps", "shipping", "map22", "map22.bin")
 
-        map22 = BinFile(map22_file)
+        map22 = load_binfile(map22_file)
 
         character_names = self.parse_character_names(map22)
         traits = self.parse_traits(map22)
@@ -56,11 +73,14 @@ class TftTransformer:
             "items": items,
         }
 
-    def export(self, output, langs=None):
+    def export(self, output, langs=None, rst_store=None):
         """Export TFT data for given languages
 
         By default (`langs` is `None`), export all available languages.
         Otherwise, export for given `xx_yy` language codes.
+
+        If set, `rst_store` is a `RstStore` of TFT stringtables used for
+        translations.
         """
 
         stringtables = stringtable_paths(self.input_dir, "tft")
@@ -71,9 +91,12 @@ class TftTransformer:
         os.makedirs(output, exist_ok=True)
 
         template = self.build_template()
+        translations = template_translations(template, langs, rst_store)
         for lang in langs:
             instance = copy.deepcopy(template)
-            replacements = load_translations(stringtables[lang], self.game_version)
+            replacements = translations.get(lang)
+            if replacements is None:
+                replacements = load_translations(stringtables[lang], self.game_version)
 
             def replace_in_data(entry):
                 for key in ("name", "desc"):
@@ -261,7 +284,7 @@ class TftTransformer:
             if not os.path.exists(self_path):
                 continue
 
-            tft_bin = BinFile(self_path)
+            tft_bin = load_binfile(self_path)
             record = next((x for x in tft_bin.entries if x.type == "TFTCharacterRecord"), {})
             if "spellNames" not in record:
                 continue
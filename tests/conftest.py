@@ -1,3 +1,30 @@
 import os
 import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pytest
+from cdtb import binfile as cdtb_binfile
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Write cache files to a temporary directory"""
+    path = tmp_path / "cdtb-cache"
+    monkeypatch.setenv('CDTB_CACHE_DIR', str(path))
+    return path
+
+
+@pytest.fixture
+def bin_hashes(monkeypatch):
+    """Use empty hash lists for bin files, instead of hash files"""
+    for hashfile in (
+        cdtb_binfile.hashfile_binentries,
+        cdtb_binfile.hashfile_binhashes,
+        cdtb_binfile.hashfile_binfields,
+        cdtb_binfile.hashfile_bintypes,
+        cdtb_binfile.hashfile_binpaths,
+    ):
+        monkeypatch.setattr(hashfile, 'hashes', {})
+    # shared names may have been resolved with other hashes
+    for cls in (cdtb_binfile.BinFieldName, cdtb_binfile.BinTypeName):
+        monkeypatch.setattr(cls, '_instances', {})
@@ -0,0 +1,250 @@
+import os
+import copy
+import json
+import pickle
+import marshal
+import struct
+from io import BytesIO, StringIO
+import numpy as np
+import pytest
+from tools import binfile_data, binfield_data, string_field, u32_field
+from cdtb.binfile import BinFile, BinReader, BinType, LazyBinFile, compute_binhash, dump_value
+from cdtb.binindex import BinIndex, StaleBinIndexError
+from cdtb.bincache import BinFileCache
+from cdtb.bindiff import diff_bin_dirs, diff_bin_files
+
+
+def complex_fields():
+    """Return fields with nested values of all complex types"""
+    h = compute_binhash
+    struct_data = struct.pack('<LLH', h("SubType"), 0, 1) + u32_field("mValue", 3)
+    return [
+        binfield_data(h("mFloats"), BinType.CONTAINER, struct.pack('<BLL', BinType.VEC2_FLOAT, 0, 2) + struct.pack('<4f', 1, 2, 3, 4)),
+        binfield_data(h("mStruct"), BinType.STRUCT, struct_data),
+        binfield_data(h("mEmbedded"), BinType.EMBEDDED, struct_data),
+        binfield_data(h("mNullStruct"), BinType.STRUCT, struct.pack('<L', 0)),
+        binfield_data(h("mOption"), BinType.OPTION, struct.pack('<BBL', BinType.LINK, 1, h("Items/A"))),
+        binfield_data(h("mNone"), BinType.OPTION, struct.pack('<BB', BinType.U8, 0)),
+        binfield_data(h("mMap"), BinType.MAP, struct.pack('<BBLL', BinType.HASH, BinType.STRUCT, 0, 1) + struct.pack('<L', h("key")) + struct_data),
+        binfield_data(h("mPath"), BinType.PATH, struct.pack('<Q', 0x123456789abcdef)),
+        binfield_data(h("mMatrix"), BinType.MATRIX4X4, struct.pack('<16f', *range(16))),
+    ]
+
+TEST_ENTRIES = [
+    (compute_binhash("ItemData"), compute_binhash("Items/A"), [string_field("mName", "a"), u32_field("mId", 1)]),
+    (compute_binhash("TraitData"), compute_binhash("Traits/A"), [string_field("mName", "trait")]),
+    (compute_binhash("ItemData"), compute_binhash("Items/B"), [string_field("mName", "b"), u32_field("mId", 2)]),
+]
+
+
+def test_lazy_binfile(bin_hashes):
+    data = binfile_data(TEST_ENTRIES, linked=["linked.bin"])
+    binfile = BinFile(BytesIO(data))
+    lazy = LazyBinFile(BytesIO(data))
+
+    assert lazy.linked_files == ["linked.bin"]
+    assert [(h.type.h, h.path.h) for h in lazy.entry_headers] == [(t, p) for t, p, _ in TEST_ENTRIES]
+    # read entries in any order
+    for header, entry in reversed(list(zip(lazy.entry_headers, binfile.entries))):
+        assert lazy.read_entry(header).to_serializable() == entry.to_serializable()
+    assert lazy.read_patch_entries() is None
+
+
+def test_binfile_dump(bin_hashes):
+    h = compute_binhash
+    binfile = BinFile(BytesIO(binfile_data([(h("Type"), h("Entry"), complex_fields())])))
+    entry = binfile.entries[0]
+    f = StringIO()
+    dump_value(entry, f)
+    assert f.getvalue() == repr(entry) + "\n"
+    assert repr(entry["mOption"]) == f"<{{{h('mOption'):08x}}} OPTION(LINK) (\n  {{{h('Items/A'):08x}}}\n)>"
+    assert repr(entry["mStruct"]) == f"<{{{h('mStruct'):08x}}} STRUCT {{{h('SubType'):08x}}} [\n  <{{{h('mValue'):08x}}} U32 3>\n]>"
+
+
+def test_binfile_compact_nodes(bin_hashes):
+    binfile = BinFile(BytesIO(binfile_data(TEST_ENTRIES)))
+    items = [entry for entry in binfile.entries if entry.type == "ItemData"]
+    # field and type names are shared
+    assert items[0].type is items[1].type
+    assert items[0].fields[0].name is items[1].fields[0].name
+    for entry in binfile.entries:
+        assert not hasattr(entry, '__dict__')
+        for field in entry.fields:
+            assert not hasattr(field, '__dict__')
+            assert not hasattr(field.name, '__dict__')
+
+
+def test_binfile_pickle(bin_hashes):
+    h = compute_binhash
+    binfile = BinFile(BytesIO(binfile_data([(h("Type"), h("Entry"), complex_fields())])))
+    entry = binfile.entries[0]
+    for other in (pickle.loads(pickle.dumps(entry)), copy.deepcopy(entry)):
+        assert other.to_serializable() == entry.to_serializable()
+        assert other.type is entry.type
+        assert other.fields[0].name is entry.fields[0].name
+
+
+def test_binfile_numpy(bin_hashes):
+    h = compute_binhash
+    fields = complex_fields() + [
+        binfield_data(h("mIds"), BinType.CONTAINER, struct.pack('<BLL', BinType.U32, 0, 3) + struct.pack('<3L', 1, 2, 3)),
+        binfield_data(h("mEmpty"), BinType.CONTAINER2, struct.pack('<BLL', BinType.FLOAT, 0, 0)),
+        binfield_data(h("mMatrices"), BinType.CONTAINER, struct.pack('<BLL', BinType.MATRIX4X4, 0, 2) + struct.pack('<32f', *range(32))),
+        binfield_data(h("mNames"), BinType.CONTAINER, struct.pack('<BLL', BinType.STRING, 0, 1) + struct.pack('<H', 1) + b'a'),
+    ]
+    data = binfile_data([(h("Type"), h("Entry"), fields)])
+    binfile = BinFile(BytesIO(data))
+    np_binfile = BinFile(BytesIO(data), use_numpy=True)
+
+    entry = np_binfile.entries[0]
+    assert isinstance(entry.getv("mIds"), np.ndarray)
+    assert entry.getv("mIds").dtype == np.uint32
+    assert entry.getv("mFloats").shape == (2, 2)
+    assert entry.getv("mMatrices").shape == (2, 4, 4)
+    assert entry.getv("mEmpty").shape == (0,)
+    assert entry.getv("mNames") == ["a"]
+    # output is the same
+    assert json.dumps(np_binfile.to_serializable()) == json.dumps(binfile.to_serializable())
+    assert repr(entry) == repr(binfile.entries[0])
+
+
+def test_bin_index(tmpdir, bin_hashes):
+    root = str(tmpdir)
+    os.makedirs(os.path.join(root, "data/maps"))
+    with open(os.path.join(root, "data/maps/map.bin"), 'wb') as f:
+        f.write(binfile_data(TEST_ENTRIES))
+    with open(os.path.join(root, "other.bin"), 'wb') as f:
+        f.write(binfile_data(TEST_ENTRIES[1:2]))
+
+    index = BinIndex(root)
+    assert index.update() == 2
+    index_path = BinIndex.default_path(root)
+    index.save(index_path)
+
+    index = BinIndex.load(index_path, root)
+    assert index.update() == 0  # nothing changed
+
+    found = list(index.find(types=[compute_binhash("ItemData")]))
+    assert [(e.file, e.hpath) for e in found] == [
+        ("data/maps/map.bin", compute_binhash("Items/A")),
+        ("data/maps/map.bin", compute_binhash("Items/B")),
+    ]
+    assert [entry.getv("mId") for _, entry in index.read_entries(found)] == [1, 2]
+
+    found = list(index.find(paths=[compute_binhash("Traits/A")]))
+    assert sorted(e.file for e in found) == ["data/maps/map.bin", "other.bin"]
+
+    # stale and corrupt indexes
+    with open(os.path.join(root, "other.bin"), 'ab') as f:
+        f.write(b"\0")
+    with pytest.raises(StaleBinIndexError):
+        list(index.read_entries(found))
+    with open(index_path, 'r+b') as f:
+        f.truncate(20)
+    with pytest.raises(ValueError):
+        BinIndex.load(index_path, root)
+
+
+def test_bin_index_removed_file(tmpdir, bin_hashes, monkeypatch):
+    root = str(tmpdir)
+    with open(os.path.join(root, "map.bin"), 'wb') as f:
+        f.write(binfile_data(TEST_ENTRIES))
+    index = BinIndex(root)
+    # file removed between directory walk and scan
+    monkeypatch.setattr(BinIndex, 'walk_bin_files', lambda self: iter(["removed.bin", "map.bin"]))
+    assert index.update() == 1
+    assert list(index.files) == ["map.bin"]
+
+
+def test_bin_diff(tmpdir, bin_hashes):
+    h = compute_binhash
+    old_root = tmpdir.mkdir("old")
+    new_root = tmpdir.mkdir("new")
+    old_root.join("map.bin").write_binary(binfile_data(TEST_ENTRIES))
+    new_root.join("map.bin").write_binary(binfile_data([
+        TEST_ENTRIES[0],
+        (h("ItemData"), h("Items/B"), [string_field("mName", "b"), u32_field("mId", 3), u32_field("mCost", 10)]),
+        (h("ItemData"), h("Items/C"), [u32_field("mId", 4)]),
+    ]))
+    old_root.join("same.bin").write_binary(binfile_data(TEST_ENTRIES))
+    new_root.join("same.bin").write_binary(binfile_data(TEST_ENTRIES))
+    new_root.join("new.bin").write_binary(binfile_data(TEST_ENTRIES[:1]))
+
+    changes = [c.to_serializable() for c in diff_bin_dirs(str(old_root), str(new_root))]
+    def hs(name):
+        return f"{{{h(name):08x}}}"
+    assert changes == [
+        {"status": "removed", "file": "map.bin", "path": hs("Traits/A"), "type": hs("TraitData")},
+        {"status": "changed", "file": "map.bin", "path": hs("Items/B"), "type": hs("ItemData"), "changes": [
+            {"field": hs("mId"), "old": 2, "new": 3},
+            {"field": hs("mCost"), "new": 10},
+        ]},
+        {"status": "added", "file": "map.bin", "path": hs("Items/C"), "type": hs("ItemData"), "value": {
+            "__type": hs("ItemData"), hs("mId"): 4}},
+        {"status": "added", "file": "new.bin", "path": hs("Items/A"), "type": hs("ItemData"), "value": {
+            "__type": hs("ItemData"), hs("mName"): "a", hs("mId"): 1}},
+    ]
+
+
+def test_bin_diff_versions(tmpdir, bin_hashes):
+    h = compute_binhash
+    # link type is shifted by one before 10.8
+    def link_entry(link_type):
+        return (h("ItemData"), h("Items/A"), [binfield_data(h("mLink"), link_type, struct.pack('<L', h("Items/B")))])
+    old_path = tmpdir.join("old.bin")
+    new_path = tmpdir.join("new.bin")
+    old_path.write_binary(binfile_data([link_entry(BinType.LINK - 1)]))
+    new_path.write_binary(binfile_data([link_entry(BinType.LINK)]))
+
+    assert list(diff_bin_files(str(old_path), str(new_path), 1007, 1008)) == []
+    with pytest.raises(struct.error):
+        list(diff_bin_files(str(old_path), str(new_path), 1008, 1008))
+
+    old_root = tmpdir.mkdir("old")
+    new_root = tmpdir.mkdir("new")
+    old_root.join("map.bin").write_binary(old_path.read_binary())
+    new_root.join("map.bin").write_binary(new_path.read_binary())
+    assert list(diff_bin_dirs(str(old_root), str(new_root), 1007, 1008)) == []
+
+
+def test_bin_cache(tmpdir, bin_hashes):
+    data = binfile_data(TEST_ENTRIES + [(compute_binhash("Complex"), compute_binhash("Complex/A"), complex_fields())])
+    expected = BinFile(BytesIO(data)).to_serializable()
+    cache = BinFileCache(str(tmpdir))
+    path = cache.cache_path(data, BinReader.DEFAULT_BTYPE_VERSION)
+
+    assert cache.load(data).to_serializable() == expected
+    assert os.path.isfile(path)
+    # load from cache
+    binfile = cache.load(data)
+    assert binfile.to_serializable() == expected
+    assert binfile.entries[-1]["mOption"].value == "Items/A"
+
+    # add a new file, evict the oldest one
+    os.utime(path, (0, 0))
+    cache.max_size = os.path.getsize(path) + 1
+    cache.load(binfile_data(TEST_ENTRIES))
+    assert not os.path.exists(path)
+
+
+def test_bin_cache_errors(tmpdir, bin_hashes, monkeypatch):
+    data = binfile_data(TEST_ENTRIES)
+    expected = BinFile(BytesIO(data)).to_serializable()
+
+    # cache directory cannot be created
+    tmpdir.join("file").write("")
+    assert BinFileCache(str(tmpdir.join("file"))).load(data).to_serializable() == expected
+
+    # invalid cache files are cache misses
+    cache = BinFileCache(str(tmpdir.join("cache")))
+    path = cache.cache_path(data, BinReader.DEFAULT_BTYPE_VERSION)
+    os.makedirs(os.path.dirname(path))
+    for invalid in (b"invalid", marshal.dumps((1, 2))):
+        with open(path, 'wb') as f:
+            f.write(invalid)
+        assert cache.load(data).to_serializable() == expected
+        assert cache.load(data).to_serializable() == expected
+
+    # other Python versions use other cache files
+    monkeypatch.setattr(BinFileCache, 'MARSHAL_VERSION', "0.0.0")
+    assert cache.cache_path(data, BinReader.DEFAULT_BTYPE_VERSION) != path
@@ -1,5 +1,6 @@
 import os
 import pytest
+from tools import binfile_data, u32_field
 import cdtb
 from cdtb.storage import (
     Storage,
@@ -7,6 +8,7 @@ from cdtb.storage import (
     Patch,
     PatchElement,
 )
+from cdtb.binfile import compute_binhash
 import cdtb.__main__ as cdtb_main
 from cdtb.__main__ import create_parser
 
@@ -37,6 +39,7 @@ def runner(storage):
     ("7.24", '7.24', '7.23'),
     ("7.24 --previous 7.22", '7.24', '7.22'),
     ("7.24 --full", '7.24', None),
+    ("7.24 --columnar", '7.24', '7.23'),
 ])
 def test_cli_export_versions(runner, storage, monkeypatch, mocker, args, version, previous_version):
     def fake_patch(version):
@@ -56,7 +59,27 @@ def test_cli_export_versions(runner, storage, monkeypatch, mocker, args, version
 
     patch = fake_patch(version)
     previous_patch = None if previous_version is None else fake_patch(previous_version)
-    mock.assert_called_once_with(os.path.join('export', '7.24'), patch, previous_patch, symlinks=False)
+    mock.assert_called_once_with(os.path.join('export', '7.24'), patch, previous_patch, symlinks=False, processes=1, skn_glb=False, columnar="--columnar" in args)
 
     mock_instance.process.assert_called_once_with(overwrite=True)
 
+
+def test_cli_bin_query_invalid_index(runner, tmpdir, capsys):
+    os.makedirs(os.path.join(tmpdir, "cdragon"))
+    with open(os.path.join(tmpdir, "cdragon", "bins.index"), 'wb') as f:
+        f.write(b"CBIX\1\0")
+    with pytest.raises(SystemExit):
+        runner(["bin-query", str(tmpdir)])
+    assert "rebuild it with 'bin-index'" in capsys.readouterr().err
+
+
+def test_cli_bin_query_stale_index(runner, tmpdir, capsys, bin_hashes):
+    path = os.path.join(tmpdir, "map.bin")
+    with open(path, 'wb') as f:
+        f.write(binfile_data([(compute_binhash("ItemData"), compute_binhash("Items/A"), [u32_field("mId", 1)])]))
+    runner(["bin-index", str(tmpdir)])
+    with open(path, 'ab') as f:
+        f.write(b"\0")
+    with pytest.raises(SystemExit):
+        runner(["bin-query", str(tmpdir)])
+    assert "update it with 'bin-index'" in capsys.readouterr().err
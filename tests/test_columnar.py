@@ -0,0 +1,83 @@
+import os
+import struct
+from io import BytesIO
+import numpy as np
+import pytest
+from tools import binfile_data, binfield_data, string_field, u32_field
+from cdtb.binfile import BinFile, BinType, compute_binhash
+from cdtb.columnar import entries_to_columns, write_columns, export_columnar_data
+
+
+def h(s):
+    return compute_binhash(s)
+
+def hs(s):
+    return f"{{{h(s):08x}}}"
+
+def item_entries():
+    struct_data = struct.pack('<LLH', h("SubType"), 0, 1) + u32_field("mValue", 3)
+    return [
+        (h("TftItemData"), h("Items/A"), [
+            string_field("mName", "a"),
+            u32_field("mId", 1),
+            binfield_data(h("mStruct"), BinType.STRUCT, struct_data),
+        ]),
+        (h("TftItemData"), h("Items/B"), [
+            string_field("mName", "b"),
+            binfield_data(h("mIds"), BinType.CONTAINER, struct.pack('<BLL', BinType.U32, 0, 2) + struct.pack('<2L', 1, 2)),
+        ]),
+        (h("TftTraitData"), h("Traits/A"), [string_field("mName", "trait")]),
+    ]
+
+
+def test_entries_to_columns(bin_hashes):
+    binfile = BinFile(BytesIO(binfile_data(item_entries())))
+    columns = entries_to_columns(e for e in binfile.entries if e.type == "TftItemData")
+    assert columns == {
+        "__path": [hs("Items/A"), hs("Items/B")],
+        "__type": [hs("TftItemData"), hs("TftItemData")],
+        hs("mName"): ["a", "b"],
+        hs("mId"): [1, None],
+        f"{hs('mStruct')}.{hs('mValue')}": [3, None],
+        f"{hs('mStruct')}.__type": [hs("SubType"), None],
+        hs("mIds"): [None, [1, 2]],
+    }
+
+
+def test_write_columns_npz(tmpdir):
+    columns = {"a": [1, None], "b": ["x", "y"], "c": [[1], None]}
+    path = write_columns(columns, os.path.join(tmpdir, "table"), 'npz')
+    assert path == os.path.join(tmpdir, "table.npz")
+    data = np.load(path)
+    assert data["a"].tolist() == [1, 0]
+    assert data["a:valid"].tolist() == [True, False]
+    assert data["b"].tolist() == ["x", "y"]
+    assert data["c"].tolist() == ["[1]", ""]
+
+
+@pytest.mark.parametrize("fmt", ["parquet", "arrow"])
+def test_write_columns_arrow(tmpdir, fmt):
+    pyarrow = pytest.importorskip("pyarrow")
+    if fmt == 'parquet':
+        pytest.importorskip("pyarrow.parquet")
+    columns = {"a": [1, None], "b": [1.5, 2], "c": [[1], None]}
+    path = write_columns(columns, os.path.join(tmpdir, "table"), fmt)
+    if fmt == 'parquet':
+        table = pyarrow.parquet.read_table(path)
+    else:
+        table = pyarrow.ipc.open_file(path).read_all()
+    assert table.to_pydict() == {"a": [1, None], "b": [1.5, 2.0], "c": ["[1]", None]}
+
+
+def test_export_columnar_data(tmpdir, bin_hashes):
+    input_dir = os.path.join(tmpdir, "game")
+    map22 = os.path.join(input_dir, "data/maps/shipping/map22/map22.bin")
+    os.makedirs(os.path.dirname(map22))
+    with open(map22, 'wb') as f:
+        f.write(binfile_data(item_entries()))
+
+    output = os.path.join(tmpdir, "columnar")
+    written = export_columnar_data(input_dir, output, fmt='npz')
+    assert written == [os.path.join(output, name) for name in ("tft/items.npz", "tft/traits.npz", "tft/shop.npz")]
+    assert np.load(written[1])["__path"].tolist() == [hs("Traits/A")]
+    assert len(np.load(written[2])["__path"]) == 0
@@ -1,5 +1,14 @@
+import os
+import re
+import json
+import struct
+import multiprocessing
+from io import BytesIO
 import pytest
+from tools import binfile_data, binfield_data
+from test_sknfile import sample_skn_data
 import cdtb.export as cdtb_export
+from cdtb.binfile import BinType, compute_binhash
 
 
 # use an intermediate argvalues variable to avoid large pytest backtraces
@@ -19,3 +28,45 @@ def test_reduce_common_paths(paths1, paths2, excludes, expected):
     got = cdtb_export.reduce_common_paths(paths1, paths2, excludes)
     assert got == expected
 
+
+def _test_bin_data():
+    fields = [
+        binfield_data(compute_binhash("mName"), BinType.STRING, struct.pack('<H', 4) + b"test"),
+        binfield_data(compute_binhash("mValue"), BinType.U32, struct.pack('<L', 42)),
+    ]
+    return binfile_data([(compute_binhash("TestType"), 0x12345678, fields)])
+
+def test_bin_converter(tmpdir, bin_hashes):
+    data = _test_bin_data()
+    converter = cdtb_export.BinConverter(re.compile(r'\.bin$'))
+    converter.convert(BytesIO(data), str(tmpdir), "data/test.bin")
+
+    with open(os.path.join(tmpdir, "data/test.bin"), 'rb') as f:
+        assert f.read() == data
+    with open(os.path.join(tmpdir, "data/test.bin.json")) as f:
+        assert json.load(f) == {"{12345678}": {"{19efbfdb}": "test", "{24f2ec89}": 42, "__type": "{9c72e46d}"}}
+
+def test_skn_converter(tmpdir):
+    converter = cdtb_export.SknConverter(glb=True)
+    assert list(converter.converted_paths("data/test.skn")) == ["data/test.skn", "data/test", "data/test.glb"]
+    converter.convert(BytesIO(sample_skn_data()), str(tmpdir), "data/test.skn")
+
+    assert sorted(os.listdir(os.path.join(tmpdir, "data/test"))) == ["first.obj", "second.obj"]
+    with open(os.path.join(tmpdir, "data/test.glb"), 'rb') as f:
+        assert f.read(4) == b"glTF"
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason="worker processes don't inherit test hashes")
+def test_exporter_process_pool(tmpdir, bin_hashes):
+    source_path = os.path.join(tmpdir, "test.bin")
+    with open(source_path, 'wb') as f:
+        f.write(_test_bin_data())
+
+    output = os.path.join(tmpdir, "export")
+    exporter = cdtb_export.Exporter(output, processes=2)
+    exporter.converters = [cdtb_export.BinConverter(re.compile(r'\.bin$'))]
+    for i in range(20):
+        exporter.add_path(source_path, f"game/test{i}.bin")
+    exporter.export()
+
+    for i in range(20):
+        assert os.path.isfile(os.path.join(output, f"game/test{i}.bin.json"))
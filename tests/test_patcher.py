@@ -0,0 +1,716 @@
+import os
+import re
+import json
+import struct
+import threading
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pyzstd
+import pytest
+from cdtb.downloader import Downloader
+from cdtb.patcher import (
+    PatcherStorage,
+    PatcherRelease,
+    PatcherBundle,
+    PatcherFile,
+    PatcherManifest,
+    merge_ranges,
+)
+from cdtb.storage import PatchVersion
+
+
+def chunk_id(data):
+    return hash(data) & 0xFFFFFFFFFFFFFFFF
+
+def write_bundles(storage, bundles):
+    """Write bundles from a list of chunk data lists, return chunks indexed by data"""
+    chunks = {}
+    for i, chunks_data in enumerate(bundles):
+        bundle = PatcherBundle(0x1000 + i)
+        content = b''
+        for data in chunks_data:
+            compressed = pyzstd.compress(data)
+            bundle.add_chunk(chunk_id(data), len(compressed), len(data))
+            chunks[data] = bundle.chunks[-1]
+            content += compressed
+        path = storage.fspath(storage.bundle_path(bundle.bundle_id))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+    return chunks
+
+def make_file(name, chunks, *chunks_data):
+    return PatcherFile(name, sum(len(data) for data in chunks_data), None, None, [chunks[data] for data in chunks_data])
+
+def make_manifest(files):
+    manif = PatcherManifest()
+    manif.files = {file.name: file for file in files}
+    manif.chunks = {chunk.chunk_id: chunk for file in files for chunk in file.chunks}
+    manif.bundles = list({chunk.bundle.bundle_id: chunk.bundle for chunk in manif.chunks.values()}.values())
+    return manif
+
+def make_release_element(storage, files, version=1000, name='game'):
+    base = storage.base_release_path()
+    os.makedirs(f"{base}/{version}", exist_ok=True)
+    with open(f"{base}/{version}/release.json", 'w') as f:
+        json.dump({f"{name}_patch_url": f"{storage.url}channels/public/releases/{version:016X}.manifest"}, f)
+    elem = PatcherRelease(storage, version).element(name)
+    elem._manif = make_manifest(files)
+    return elem
+
+
+class CdnRequestHandler(BaseHTTPRequestHandler):
+    """Serve files of a directory, support single range requests"""
+
+    def do_GET(self):
+        server = self.server
+        path = os.path.join(server.root, self.path.lstrip('/'))
+        range_header = self.headers.get('Range')
+        server.requests.append((self.path, range_header))
+        if server.failures:
+            server.failures -= 1
+            self.send_error(500)
+            return
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        m = re.fullmatch(r'bytes=(\d+)-(\d+)', range_header or '')
+        if m and server.support_ranges:
+            start, end = int(m.group(1)), int(m.group(2)) + 1
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end-1}/{len(data)}')
+            data = data[start:end]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def cdn_server(tmpdir):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CdnRequestHandler)
+    server.root = os.path.join(tmpdir, "cdn")
+    server.requests = []
+    server.support_ranges = True
+    server.failures = 0  # number of requests to fail
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _object_blob(fields):
+    """Build a table entry from a list of `(fmt, value)`, `None` for missing fields
+
+    `fmt` is a struct format, `str`, or `offset` (`value` is then the pointed data).
+    Return `(blob, entry_position)`.
+    """
+    vtable_size = 4 + 2 * len(fields)
+    entry_pos = vtable_size + (-vtable_size % 4)
+    slots = b''
+    pointers = []  # (slot position, data)
+    field_offsets = []
+    for field in fields:
+        if field is None:
+            field_offsets.append(0)
+            continue
+        fmt, value = field
+        field_offsets.append(4 + len(slots))
+        if fmt == 'str':
+            pointers.append((entry_pos + 4 + len(slots), struct.pack('<L', len(value)) + value.encode()))
+            slots += b'\0\0\0\0'
+        elif fmt == 'offset':
+            pointers.append((entry_pos + 4 + len(slots), value))
+            slots += b'\0\0\0\0'
+        else:
+            slots += struct.pack(fmt, value)
+    blob = bytearray(struct.pack(f'<HH{len(fields)}H', vtable_size, 4 + len(slots), *field_offsets))
+    blob += b'\0' * (entry_pos - len(blob))
+    blob += struct.pack('<l', entry_pos) + slots
+    for pos, data in pointers:
+        struct.pack_into('<l', blob, pos, len(blob) - pos)
+        blob += data
+    return bytes(blob), entry_pos
+
+def _table_blob(entries):
+    """Build a table from a list of `(blob, entry_position)`"""
+    blob = struct.pack('<l', len(entries))
+    data = b''
+    for i, (entry_blob, entry_pos) in enumerate(entries):
+        ptr_pos = 4 + 4 * i
+        blob += struct.pack('<l', 4 + 4 * len(entries) + len(data) + entry_pos - ptr_pos)
+        data += entry_blob
+    return blob + data
+
+def rman_data(manifest_id, bundles, flags, directories, files):
+    """Build an RMAN file
+
+    `bundles` is a list of `(bundle_id, [(chunk_id, size, target_size), ...])`.
+    `flags` is a list of `(flag_id, name)`.
+    `directories` is a list of `(directory_id, parent_id, name)`.
+    `files` is a list of `(file_id, directory_id, size, name, flag_mask, chunk_ids, link)`.
+    """
+    tables = [
+        _table_blob([_object_blob([('<Q', bundle_id), ('offset', _table_blob([
+            _object_blob([('<Q', chunk_id), ('<L', size), ('<L', target_size)]) for chunk_id, size, target_size in chunks
+        ]))]) for bundle_id, chunks in bundles]),
+        _table_blob([(b'\0' * 7 + struct.pack('<Bl', flag_id, 4) + struct.pack('<L', len(name)) + name.encode(), 0) for flag_id, name in flags]),
+        _table_blob([_object_blob([
+            ('<Q', file_id), ('<Q', dir_id) if dir_id else None, ('<L', size), ('str', name), ('<Q', flag_mask) if flag_mask else None,
+            None, None, ('offset', struct.pack(f'<L{len(chunk_ids)}Q', len(chunk_ids), *chunk_ids)), None, ('str', link), None, None, None,
+        ]) for file_id, dir_id, size, name, flag_mask, chunk_ids, link in files]),
+        _table_blob([_object_blob([('<Q', dir_id), ('<Q', parent_id) if parent_id else None, ('str', name)]) for dir_id, parent_id, name in directories]),
+        _table_blob([]),
+        _table_blob([]),
+    ]
+    body = struct.pack('<l', 0)
+    offsets = []
+    pos = 4 + 4 * 6
+    for i, table in enumerate(tables):
+        offsets.append(pos - (4 + 4 * i))
+        pos += len(table)
+    body += struct.pack('<6l', *offsets) + b''.join(tables)
+    compressed = pyzstd.compress(body)
+    return b'RMAN' + struct.pack('<BBHLLQL', 2, 0, 1 << 9, 28, len(compressed), manifest_id, len(body)) + compressed
+
+def sample_rman_data(manifest_id=0x1234):
+    return rman_data(
+        manifest_id,
+        [(0x1000, [(0x11, 10, 20), (0x12, 5, 8)]), (0x1001, [(0x21, 7, 7)])],
+        [(1, "en_US"), (2, "fr_FR")],
+        [(0x100, None, "root"), (0x101, 0x100, "sub")],
+        [
+            (1, 0x101, 28, "a.txt", 0, [0x11, 0x12], ''),
+            (2, None, 7, "b.txt", 0b10, [0x21], ''),
+            (3, 0x100, 0, "link", 0b11, [], 'a.txt'),
+        ],
+    )
+
+
+@pytest.fixture
+def storage(tmpdir):
+    return PatcherStorage(str(tmpdir))
+
+@pytest.fixture
+def sample_files(storage):
+    chunks = write_bundles(storage, [[b"a1", b"b1", b"a2"], [b"b2", b"a3"]])
+    return [
+        make_file("a.txt", chunks, b"a1", b"a2", b"a3"),
+        make_file("b.txt", chunks, b"b1", b"b2", b"b1"),
+        make_file("dir/copy.txt", chunks, b"a1", b"a2", b"a3"),
+        make_file("empty.txt", chunks),
+    ]
+
+
+@pytest.mark.parametrize("use_extract_symlinks", [True, False])
+@pytest.mark.parametrize("workers", [1, 4])
+def test_extract_files(tmpdir, storage, sample_files, use_extract_symlinks, workers):
+    storage.use_extract_symlinks = use_extract_symlinks
+    storage.extract_workers = workers
+    output = os.path.join(tmpdir, "output")
+    storage.extract_files((file, os.path.join(output, file.name)) for file in sample_files)
+
+    for name, content in [("a.txt", b"a1a2a3"), ("b.txt", b"b1b2b1"), ("dir/copy.txt", b"a1a2a3"), ("empty.txt", b"")]:
+        path = os.path.join(output, name)
+        assert os.path.islink(path) == use_extract_symlinks
+        with open(path, 'rb') as f:
+            assert f.read() == content
+    if use_extract_symlinks:
+        # identical files are extracted once
+        assert len(os.listdir(storage.fspath("cdtb/files"))) == 3
+    assert not any(name.endswith(".tmp") for _, _, names in os.walk(tmpdir) for name in names)
+
+
+def test_extract_files_error(tmpdir, storage, sample_files):
+    storage.extract_workers = 2
+    os.remove(storage.fspath(storage.bundle_path(0x1001)))
+    with pytest.raises(FileNotFoundError):
+        storage.extract_files((file, os.path.join(tmpdir, "output", file.name)) for file in sample_files)
+    # only files whose chunks are all available may have been extracted
+    assert not any(name.endswith(".tmp") for _, _, names in os.walk(tmpdir) for name in names)
+    assert set(os.listdir(storage.fspath("cdtb/files"))) <= {sample_files[3].hexdigest()}
+
+
+def test_bundle_pool(storage, sample_files):
+    storage.bundles.size = 1
+    for file in sample_files:
+        assert b''.join(storage.load_chunk(chunk) for chunk in file.chunks) == b''.join(
+            pyzstd.decompress(storage.bundles.read(chunk.bundle.bundle_id, chunk.offset, chunk.size)) for chunk in file.chunks)
+    assert len(storage.bundles._maps) == 1
+    storage.bundles.close()
+    assert not storage.bundles._maps
+
+
+def test_release_element_extract(storage, sample_files):
+    elem = make_release_element(storage, sample_files)
+    elem.extract()
+    for file in sample_files:
+        assert elem.is_extracted_file(file)
+
+
+def test_extracted_file_sizes(storage, sample_files, monkeypatch):
+    a, b, copy, empty = sample_files
+    elem = make_release_element(storage, sample_files)
+    elem.extract_file(a)
+    elem.extract_file(copy)
+    with open(elem.extract_path(b), 'wb') as f:
+        f.write(b"truncated")
+
+    # new release instance: files are scanned
+    release = PatcherRelease(storage, elem.release.version)
+    assert release.extracted_file_sizes() == {"a.txt": a.size, "b.txt": 9, "dir/copy.txt": copy.size}
+    other = release.element(elem.name)
+    other._manif = elem.manif
+    assert [other.is_extracted_file(f) for f in sample_files] == [True, False, True, False]
+
+    # files extracted by elements are tracked, without scanning again
+    monkeypatch.setattr(os, 'scandir', None)
+    other.extract()
+    assert all(other.is_extracted_file(f) for f in sample_files)
+
+
+def test_merge_ranges():
+    assert merge_ranges([(10, 20), (0, 5), (18, 25), (30, 40)]) == [(0, 5), (10, 25), (30, 40)]
+    assert merge_ranges([(10, 20), (0, 5), (30, 40)], gap=5) == [(0, 20), (30, 40)]
+
+
+def read_cdn_chunk(cdn_server, chunk):
+    with open(os.path.join(cdn_server.root, PatcherStorage.bundle_path(chunk.bundle.bundle_id)), 'rb') as f:
+        f.seek(chunk.offset)
+        return f.read(chunk.size)
+
+@pytest.fixture
+def cdn_storage(tmpdir, cdn_server):
+    storage = PatcherStorage(os.path.join(tmpdir, "storage"))
+    storage.url = cdn_server.url
+    storage.extract_workers = 2
+    return storage
+
+@pytest.fixture
+def cdn_files(cdn_server):
+    # chunks are big enough to not be merged
+    big = [bytes([i]) * PatcherStorage.RANGE_MERGE_GAP * 2 for i in range(3)]
+    chunks = write_bundles(PatcherStorage(cdn_server.root), [[b"a1", os.urandom(PatcherStorage.RANGE_MERGE_GAP * 2), b"a2", b"b1"], big])
+    return [
+        make_file("a.txt", chunks, b"a1", b"a2"),
+        make_file("b.txt", chunks, b"b1", big[1]),
+        make_file("c.txt", chunks, big[0]),
+    ]
+
+
+@pytest.mark.parametrize("support_ranges", [True, False])
+def test_fetch_chunks(cdn_server, cdn_storage, cdn_files, support_ranges):
+    cdn_server.support_ranges = support_ranges
+    a, b, c = cdn_files
+    cdn_storage.fetch_chunks(a.chunks + b.chunks)
+    if support_ranges:
+        # `a1`, then `a2` and `b1` merged in a single request, then `big[1]`
+        assert sorted(r for _, r in cdn_server.requests) == sorted([
+            f"bytes={a.chunks[0].offset}-{a.chunks[0].offset + a.chunks[0].size - 1}",
+            f"bytes={a.chunks[1].offset}-{b.chunks[0].offset + b.chunks[0].size - 1}",
+            f"bytes={b.chunks[1].offset}-{b.chunks[1].offset + b.chunks[1].size - 1}",
+        ])
+        assert not os.path.exists(cdn_storage.fspath(cdn_storage.bundle_path(0x1000)))
+    else:
+        assert os.path.isfile(cdn_storage.fspath(cdn_storage.bundle_path(0x1000)))
+        assert os.path.isfile(cdn_storage.fspath(cdn_storage.bundle_path(0x1001)))
+
+    for file, content in [(a, b"a1a2"), (b, b"b1" + b.chunks[1].target_size * b"\x01")]:
+        assert b''.join(cdn_storage.load_chunk(chunk) for chunk in file.chunks) == content
+
+    # available chunks are not downloaded again
+    nrequests = len(cdn_server.requests)
+    cdn_storage.fetch_chunks(a.chunks + b.chunks)
+    assert len(cdn_server.requests) == nrequests
+    other_storage = PatcherStorage(cdn_storage.path)
+    other_storage.url = cdn_storage.url
+    other_storage.fetch_chunks(a.chunks + b.chunks)
+    assert len(cdn_server.requests) == nrequests
+    if support_ranges:
+        cdn_storage.fetch_chunks(c.chunks)
+        assert len(cdn_server.requests) == nrequests + 1
+
+
+@pytest.mark.parametrize("support_ranges", [True, False])
+def test_fetch_chunks_retry(cdn_server, cdn_storage, cdn_files, support_ranges):
+    cdn_server.support_ranges = support_ranges
+    cdn_server.failures = 2
+    cdn_storage.downloader = Downloader(backoff=0)
+    a, b, c = cdn_files
+    cdn_storage.fetch_chunks(a.chunks + b.chunks)
+    for file, content in [(a, b"a1a2"), (b, b"b1" + b.chunks[1].target_size * b"\x01")]:
+        assert b''.join(cdn_storage.load_chunk(chunk) for chunk in file.chunks) == content
+    if not support_ranges:
+        # whole bundles are downloaded once each, and verified
+        assert sorted(p for p, r in cdn_server.requests if r is None) == [
+            "/channels/public/bundles/0000000000001000.bundle",
+            "/channels/public/bundles/0000000000001001.bundle",
+        ]
+
+
+def test_download_element_with_range_requests(cdn_server, cdn_storage, cdn_files):
+    cdn_storage.use_range_requests = True
+    elem = make_release_element(cdn_storage, cdn_files)
+    elem.download_bundles()
+    elem.extract()
+    assert all(elem.is_extracted_file(file) for file in cdn_files)
+    assert all(r is not None for _, r in cdn_server.requests)
+
+
+@pytest.mark.parametrize("use_range_requests", [True, False])
+def test_retrieve_patch_version(cdn_server, cdn_storage, use_range_requests):
+    chunks = write_bundles(PatcherStorage(cdn_server.root), [[b"a1"], [b'{"version": "14.3.1"}', b"b1"]])
+    files = [make_file("a.txt", chunks, b"a1"), make_file("content-metadata.json", chunks, b'{"version": "14.3.1"}')]
+    cdn_storage.use_range_requests = use_range_requests
+    elem = make_release_element(cdn_storage, files)
+    assert elem._retrieve_patch_version() == PatchVersion("14.3")
+    # only the bundle of the metadata file is requested
+    assert [p for p, _ in cdn_server.requests] == ["/channels/public/bundles/0000000000001001.bundle"]
+    if use_range_requests:
+        assert all(r is not None for _, r in cdn_server.requests)
+    else:
+        assert os.path.isfile(cdn_storage.fspath(cdn_storage.bundle_path(0x1001)))
+
+
+def test_download_after_partial_bundle(cdn_server, cdn_storage, cdn_files):
+    # as when retrieving the patch version before downloading the element
+    a, b, c = cdn_files
+    elem = make_release_element(cdn_storage, cdn_files)
+    cdn_storage.fetch_chunks(a.chunks)
+    elem.extract_file(a)
+    elem.download_and_extract()
+    with open(elem.extract_path(b), 'rb') as f:
+        assert f.read() == b"b1" + b.chunks[1].target_size * b"\x01"
+
+
+@pytest.mark.parametrize("support_ranges", [True, False])
+def test_stream_extract(cdn_server, cdn_storage, cdn_files, support_ranges):
+    cdn_server.support_ranges = support_ranges
+    cdn_server.failures = 1
+    cdn_storage.downloader = Downloader(backoff=0)
+    elem = make_release_element(cdn_storage, cdn_files)
+    elem.extract(stream=True)
+    for file in cdn_files:
+        with open(elem.extract_path(file), 'rb') as f:
+            assert f.read() == b''.join(pyzstd.decompress(read_cdn_chunk(cdn_server, chunk)) for chunk in file.chunks)
+    # bundle data is never stored
+    assert not os.path.exists(cdn_storage.fspath("channels/public/bundles"))
+    assert not os.path.exists(cdn_storage.fspath("cdtb/bundles"))
+    if support_ranges:
+        assert all(r is not None for _, r in cdn_server.requests)
+    else:
+        # failed request, then a single request per bundle
+        assert len(cdn_server.requests) == 3
+
+
+def test_download_and_extract(cdn_server, cdn_storage, monkeypatch):
+    chunks = write_bundles(PatcherStorage(cdn_server.root), [[b"a1", b"a2"], [b"b1"], [b"meta"]])
+    files = [
+        make_file("a.txt", chunks, b"a1", b"b1"),
+        make_file("b.txt", chunks, b"b1"),
+        make_file("content-metadata.json", chunks, b"meta"),
+        make_file("c.txt", chunks, b"a2"),
+    ]
+    cdn_storage.downloader = Downloader(max_workers=1)
+    elem = make_release_element(cdn_storage, files)
+
+    metadata_extracted = threading.Event()
+    extract_files = cdn_storage.extract_files
+    def extract_files_wrapper(files):
+        files = list(files)
+        for file, _ in files:
+            assert all(os.path.isfile(cdn_storage.fspath(cdn_storage.bundle_path(c.bundle.bundle_id))) for c in file.chunks)
+        extract_files(files)
+        if any(file.name == "content-metadata.json" for file, _ in files):
+            metadata_extracted.set()
+    monkeypatch.setattr(cdn_storage, 'extract_files', extract_files_wrapper)
+
+    download = cdn_storage.downloader.download
+    def download_wrapper(url, *args):
+        if not url.endswith("/0000000000001002.bundle"):
+            # metadata is extracted while other bundles are downloaded
+            assert metadata_extracted.wait(5)
+        download(url, *args)
+    monkeypatch.setattr(cdn_storage.downloader, 'download', download_wrapper)
+
+    elem.download_and_extract()
+    # priority file first, then files needing the fewest bundles
+    assert [p for p, _ in cdn_server.requests] == [f"/channels/public/bundles/{i:016X}.bundle" for i in (0x1002, 0x1001, 0x1000)]
+    for file, content in zip(files, [b"a1b1", b"b1", b"meta", b"a2"]):
+        with open(elem.extract_path(file), 'rb') as f:
+            assert f.read() == content
+
+
+def test_downloader_resume(tmpdir, cdn_server):
+    os.makedirs(cdn_server.root)
+    with open(os.path.join(cdn_server.root, "file"), 'wb') as f:
+        f.write(b"0123456789")
+    path = os.path.join(tmpdir, "output/file")
+    os.makedirs(os.path.dirname(path))
+    with open(path + ".part", 'wb') as f:
+        f.write(b"0123")
+
+    Downloader().download(cdn_server.url + "file", path, size=10)
+    assert cdn_server.requests == [("/file", "bytes=4-")]
+    with open(path, 'rb') as f:
+        assert f.read() == b"0123456789"
+    assert not os.path.exists(path + ".part")
+
+
+def test_downloader_retry(tmpdir, cdn_server):
+    os.makedirs(cdn_server.root)
+    with open(os.path.join(cdn_server.root, "file"), 'wb') as f:
+        f.write(b"data")
+    cdn_server.failures = 2
+    downloader = Downloader(max_workers=4, backoff=0)
+    downloader.download_many([(cdn_server.url + "file", os.path.join(tmpdir, "file"), None, None)])
+    assert len(cdn_server.requests) == 3
+    assert downloader.limiter.limit == 1  # decreased after failures
+
+    # not found files are not retried
+    with pytest.raises(Exception):
+        downloader.download(cdn_server.url + "missing", os.path.join(tmpdir, "missing"))
+    assert len(cdn_server.requests) == 4
+
+
+def test_download_bundles(cdn_server, cdn_storage, cdn_files):
+    elem = make_release_element(cdn_storage, cdn_files)
+    elem.download_bundles()
+    assert sorted(p for p, _ in cdn_server.requests) == ["/channels/public/bundles/0000000000001000.bundle", "/channels/public/bundles/0000000000001001.bundle"]
+    elem.extract()
+    assert all(elem.is_extracted_file(file) for file in cdn_files)
+
+
+def test_download_bundles_invalid(cdn_server, cdn_storage, cdn_files):
+    cdn_storage.downloader.backoff = 0
+    cdn_storage.downloader.retries = 1
+    bundle = cdn_files[0].chunks[0].bundle
+    with open(os.path.join(cdn_server.root, cdn_storage.bundle_path(bundle.bundle_id)), 'r+b') as f:
+        f.seek(bundle.chunks[1].offset)
+        f.write(b"XXXX")
+    with pytest.raises(ValueError):
+        cdn_storage.download_bundles([bundle])
+    assert len(cdn_server.requests) == 2
+    assert not os.path.exists(cdn_storage.fspath(cdn_storage.bundle_path(bundle.bundle_id)))
+    assert not os.path.exists(cdn_storage.fspath(cdn_storage.bundle_path(bundle.bundle_id)) + ".part")
+
+
+def manifest_content(manif):
+    return (
+        [(b.bundle_id, [(c.chunk_id, c.offset, c.size, c.target_size) for c in b.chunks]) for b in manif.bundles],
+        manif.flags,
+        [(f.name, f.size, f.link, f.flags, [c.chunk_id for c in f.chunks]) for f in manif.files.values()],
+    )
+
+def test_manifest_parse():
+    manif = PatcherManifest(BytesIO(sample_rman_data()))
+    assert manif.manifest_id == 0x1234
+    assert manifest_content(manif) == (
+        [(0x1000, [(0x11, 0, 10, 20), (0x12, 10, 5, 8)]), (0x1001, [(0x21, 0, 7, 7)])],
+        {1: "en_US", 2: "fr_FR"},
+        [
+            ("root/sub/a.txt", 28, '', None, [0x11, 0x12]),
+            ("b.txt", 7, '', ["fr_FR"], [0x21]),
+            ("root/link", 0, 'a.txt', ["en_US", "fr_FR"], []),
+        ],
+    )
+    assert manif.chunks[0x12].bundle is manif.bundles[0]
+
+
+def test_manifest_cache(tmpdir, monkeypatch):
+    path = os.path.join(tmpdir, "0000000000001234.manifest")
+    with open(path, 'wb') as f:
+        f.write(sample_rman_data())
+    expected = manifest_content(PatcherManifest(path))
+    assert os.path.isfile(path + ".cache")
+
+    # load from the cache, without parsing the manifest
+    with monkeypatch.context() as m:
+        m.setattr(PatcherManifest, 'parse_body', None)
+        manif = PatcherManifest(path)
+    assert manifest_content(manif) == expected
+    assert manif.files["b.txt"].chunks[0] is manif.chunks[0x21]
+
+    # cache of another manifest is not used
+    with open(path, 'wb') as f:
+        f.write(sample_rman_data(0x5678))
+    manif = PatcherManifest(path)
+    assert manif.manifest_id == 0x5678
+    assert manifest_content(manif) == expected
+
+    # invalid cache is ignored
+    with open(path + ".cache", 'wb') as f:
+        f.write(b"invalid")
+    assert manifest_content(PatcherManifest(path)) == expected
+
+
+def test_manifest_cache_empty_bundles(tmpdir):
+    path = os.path.join(tmpdir, "0000000000001234.manifest")
+    with open(path, 'wb') as f:
+        f.write(rman_data(
+            0x1234,
+            [(0x1000, []), (0x1001, [(0x11, 10, 20), (0x12, 5, 8)]), (0x1002, []), (0x1003, [(0x21, 7, 7), (0x22, 3, 3)])],
+            [], [],
+            [(1, None, 38, "a.txt", 0, [0x11, 0x12, 0x22], '')],
+        ))
+    expected = manifest_content(PatcherManifest(path, use_cache=False))
+    assert expected[0][3] == (0x1003, [(0x21, 0, 7, 7), (0x22, 7, 3, 3)])
+    PatcherManifest(path)  # write the cache
+    assert os.path.isfile(path + ".cache")
+    assert manifest_content(PatcherManifest(path)) == expected
+
+
+def test_manifest_diff():
+    bundle = PatcherBundle(0x1000)
+    for i in range(4):
+        bundle.add_chunk(i, 1, 1)
+    def manifest(*files):
+        return make_manifest([PatcherFile(name, len(ids), None, None, [bundle.chunks[i] for i in ids]) for name, ids in files])
+
+    old = manifest(("same", [0, 1]), ("changed", [2]), ("removed", [3]))
+    new = manifest(("same", [0, 1]), ("changed", [2, 3]), ("added", [1]))
+    diff = old.diff(new)
+    assert [f.name for f in diff.added] == ["added"]
+    assert [f.name for f in diff.changed] == ["changed"]
+    assert [f.name for f in diff.removed] == ["removed"]
+    assert [f.name for f in diff.unchanged] == ["same"]
+    assert diff.changed[0] is new.files["changed"]
+
+
+@pytest.mark.parametrize("use_extract_symlinks", [True, False])
+def test_download_delta(cdn_server, cdn_storage, use_extract_symlinks):
+    cdn_storage.use_extract_symlinks = use_extract_symlinks
+    chunks = write_bundles(PatcherStorage(cdn_server.root), [[b"a1", b"a2", b"b1"], [b"b2", b"c1"]])
+    old_elem = make_release_element(cdn_storage, [
+        make_file("a.txt", chunks, b"a1", b"a2"),
+        make_file("b.txt", chunks, b"b1"),
+    ], version=1000)
+    new_elem = make_release_element(cdn_storage, [
+        make_file("a.txt", chunks, b"a1", b"a2"),
+        make_file("b.txt", chunks, b"b2"),
+        make_file("c.txt", chunks, b"c1"),
+    ], version=2000)
+    old_elem.download_bundles()
+    old_elem.extract()
+    # drop bundles, to check they are not needed for unchanged files
+    os.remove(cdn_storage.fspath(cdn_storage.bundle_path(0x1000)))
+    cdn_server.requests.clear()
+
+    new_elem.download_delta(old_elem)
+    assert [p for p, _ in cdn_server.requests] == ["/channels/public/bundles/0000000000001001.bundle"]
+    for file, content in [("a.txt", b"a1a2"), ("b.txt", b"b2"), ("c.txt", b"c1")]:
+        with open(new_elem.extract_path(new_elem.manif.files[file]), 'rb') as f:
+            assert f.read() == content
+    old_path = old_elem.extract_path(old_elem.manif.files["a.txt"])
+    new_path = new_elem.extract_path(new_elem.manif.files["a.txt"])
+    assert os.path.samefile(old_path, new_path)
+    assert os.path.islink(new_path) == use_extract_symlinks
+
+
+def write_manifest(storage, manifest_id, files):
+    manif = make_manifest(files)
+    data = rman_data(
+        manifest_id,
+        [(b.bundle_id, [(c.chunk_id, c.size, c.target_size) for c in b.chunks]) for b in manif.bundles],
+        [],
+        [],
+        [(i + 1, None, f.size, f.name, 0, [c.chunk_id for c in f.chunks], '') for i, f in enumerate(files)],
+    )
+    path = storage.fspath(storage.manifest_path(manifest_id))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def set_old_mtimes(root):
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            os.utime(os.path.join(dirpath, name), (0, 0), follow_symlinks=False)
+
+def test_collect_garbage(storage):
+    chunks = write_bundles(storage, [[b"a1", b"a2"], [b"b1"], [b"c1"]])
+    releases = {}
+    for version, files in [
+        (1000, [make_file("a.txt", chunks, b"a1", b"a2")]),
+        (2000, [make_file("a.txt", chunks, b"a1", b"a2"), make_file("b.txt", chunks, b"b1")]),
+        (3000, [make_file("b.txt", chunks, b"b1"), make_file("c.txt", chunks, b"c1")]),
+    ]:
+        write_manifest(storage, version, files)
+        elem = make_release_element(storage, files, version=version)
+        elem.extract()
+        releases[version] = (elem, files)
+    set_old_mtimes(storage.path)
+
+    def storage_files():
+        return {os.path.relpath(os.path.join(root, name), storage.path) for root, _, names in os.walk(storage.path) for name in names}
+    files_before = storage_files()
+    assert storage.collect_garbage(2, dry_run=True)[0] == 2
+    assert files_before <= storage_files()  # only caches are added
+
+    count, size = storage.collect_garbage(2)
+    assert count == 2  # release and its manifest
+    assert not os.path.exists(os.path.dirname(releases[1000][0].extract_path(releases[1000][1][0])))
+    remaining = storage_files()
+    assert "channels/public/releases/00000000000003E8.manifest" not in remaining
+    assert storage.bundle_path(0x1000) in remaining  # used by release 2000
+    assert f"cdtb/files/{releases[1000][1][0].hexdigest()}" in remaining
+    assert not os.path.exists(storage.fspath("cdtb/storage-gc.lock"))
+    assert os.path.isfile(os.path.join(releases[2000][0].release.storage_dir, "refs.cache"))
+
+    set_old_mtimes(storage.path)
+    with open(storage.fspath(storage.bundle_path(0x1005)), 'wb') as f:
+        f.write(b"recent")
+    count, size = storage.collect_garbage(1, grace_period=3600)
+    assert count == 5  # release, manifest and its cache, bundle, extracted file
+    remaining = storage_files()
+    assert storage.bundle_path(0x1000) not in remaining
+    assert storage.bundle_path(0x1005) in remaining  # recent
+    assert f"cdtb/files/{releases[1000][1][0].hexdigest()}" not in remaining
+    with open(releases[3000][0].extract_path(releases[3000][1][0]), 'rb') as f:
+        assert f.read() == b"b1"
+
+
+def test_collect_garbage_lock(storage):
+    os.makedirs(storage.fspath("cdtb"))
+    with open(storage.fspath("cdtb/storage-gc.lock"), 'w'):
+        pass
+    with pytest.raises(RuntimeError):
+        storage.collect_garbage(1)
+    with pytest.raises(RuntimeError):
+        with storage.download_lock():
+            pass
+    os.remove(storage.fspath("cdtb/storage-gc.lock"))
+
+    with storage.download_lock():
+        with pytest.raises(RuntimeError):
+            storage.collect_garbage(1)
+    # locks of dead processes are ignored
+    with open(storage.fspath("cdtb/downloads/999999999-1.lock"), 'w'):
+        pass
+    assert storage.collect_garbage(1) == (0, 0)
+    assert not os.listdir(storage.fspath("cdtb/downloads"))
+
+
+@pytest.mark.parametrize("use_extract_symlinks", [True, False])
+def test_collect_garbage_after_delta(cdn_server, cdn_storage, monkeypatch, use_extract_symlinks):
+    cdn_storage.use_extract_symlinks = use_extract_symlinks
+    def no_link(src, dst):
+        raise OSError("hardlinks not supported")
+    monkeypatch.setattr(os, 'link', no_link)
+    chunks = write_bundles(PatcherStorage(cdn_server.root), [[b"a1", b"b1"], [b"b2"]])
+    old_elem = make_release_element(cdn_storage, [make_file("a.txt", chunks, b"a1"), make_file("b.txt", chunks, b"b1")], version=1000)
+    new_elem = make_release_element(cdn_storage, [make_file("a.txt", chunks, b"a1"), make_file("b.txt", chunks, b"b2")], version=2000)
+    old_elem.download_and_extract()
+    new_elem.download_delta(old_elem)
+
+    cdn_storage.collect_garbage(1, grace_period=0)
+    assert not os.path.exists(old_elem.release.storage_dir)
+    for file, content in [("a.txt", b"a1"), ("b.txt", b"b2")]:
+        with open(new_elem.extract_path(new_elem.manif.files[file]), 'rb') as f:
+            assert f.read() == content
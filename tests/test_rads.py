@@ -123,7 +123,7 @@ def test_project_versions_package_files(storage, monkeypatch):
     project_version = RadsProjectVersion(RadsProject(storage, 'name'), RV('1.2.3.4'))
 
     @count_calls
-    def request_get(path):
+    def request_get(path, **kwargs):
         assert path == "projects/name/releases/1.2.3.4/packages/files/packagemanifest"
         data = '\r\n'.join([
             'PKG1',
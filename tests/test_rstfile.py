@@ -0,0 +1,138 @@
+import os
+import struct
+import pytest
+from io import BytesIO
+import cdtb.rstfile as cdtb_rstfile
+from cdtb.rstfile import RstFile, key_to_hash, load_truncated_hashes
+from cdtb.rststore import RstStore, load_rst_store
+from cdtb.hashes import HashFile
+
+
+def rst_data(version, strings, hash_bits=38, trenc=False):
+    """Build RST file data from a list of `(key, raw_string)`"""
+    table = []
+    data = b''
+    for key, s in strings:
+        table.append(len(data) << hash_bits | key_to_hash(key, hash_bits))
+        data += s
+    header = b'RST' + bytes([version]) + struct.pack(f'<L{len(table)}Q', len(table), *table)
+    if version < 5:
+        header += bytes([trenc])
+    return header + data
+
+
+def test_rstfile():
+    data = rst_data(5, [("a", b"first\0"), ("b", b"second\xe9\0"), ("c", b"\0")])
+    rst = RstFile(BytesIO(data))
+    assert rst.hash_bits == 38
+    assert len(rst.entries) == 3
+    assert rst["a"] == "first"
+    assert rst["b"] == "second�"
+    assert "c" in rst
+    assert "d" not in rst
+    assert rst.get("d") is None
+    assert list(rst.entries.values()) == ["first", "second�", ""]
+
+
+def test_rstfile_trenc():
+    data = rst_data(3, [("a", b"\xff\x02\x00\x01\x02"), ("b", b"text\0")], hash_bits=40, trenc=True)
+    rst = RstFile(BytesIO(data))
+    assert rst["a"] == "AQI="
+    assert rst["b"] == "text"
+
+
+def test_rstfile_mmap(tmpdir):
+    strings = [("a", b"first\0"), ("b", b"second\0"), ("a", b"third\0"), ("c", b"\xff\x01\x00\x01")]
+    path = tmpdir.join("test.stringtable")
+    path.write_binary(rst_data(4, strings, trenc=True))
+    rst = RstFile(str(path))
+    mapped_rst = RstFile(str(path), use_mmap=True)
+
+    assert dict(mapped_rst.entries) == dict(rst.entries)
+    assert mapped_rst["a"] == "third"
+    assert mapped_rst["c"] == "AQ=="
+    assert "d" not in mapped_rst
+    assert mapped_rst.get("d") is None
+    with pytest.raises(KeyError):
+        mapped_rst["d"]
+
+
+def test_load_truncated_hashes(tmpdir, monkeypatch):
+    path = tmpdir.join("hashes.rst.txt")
+    path.write("0123456789abcdef key1\nfedcba9876543210 key2\n")
+    hashfile = HashFile(str(path))
+    monkeypatch.setattr(cdtb_rstfile, '_truncated_hashes_cache', {})
+
+    expected = {0x6789abcdef: "key1", 0x9876543210: "key2"}
+    assert load_truncated_hashes(hashfile, 40) == expected
+    cache_files = os.listdir(os.path.join(os.environ["CDTB_CACHE_DIR"], "rst"))
+    assert len(cache_files) == 1
+    assert cache_files[0].startswith("hashes.rst.txt.") and cache_files[0].endswith(".40bits.cache")
+    assert not [p for p in tmpdir.listdir() if p.basename.startswith("hashes.rst.txt.")]  # nothing written next to hash files
+
+    # load from the cache file, without reading the hash file
+    monkeypatch.setattr(cdtb_rstfile, '_truncated_hashes_cache', {})
+    monkeypatch.setattr(HashFile, 'load', None)
+    assert load_truncated_hashes(hashfile, 40) == expected
+
+
+def test_load_truncated_hashes_readonly_cache(tmpdir, monkeypatch):
+    path = tmpdir.join("hashes.rst.txt")
+    path.write("0123456789abcdef key1\n")
+    monkeypatch.setattr(cdtb_rstfile, '_truncated_hashes_cache', {})
+    # cache directory cannot be created
+    tmpdir.join("cache").write("")
+    monkeypatch.setenv("CDTB_CACHE_DIR", str(tmpdir.join("cache")))
+    assert load_truncated_hashes(HashFile(str(path)), 40) == {0x6789abcdef: "key1"}
+
+
+def test_rst_store(tmpdir):
+    paths = {}
+    for lang, strings, trenc in [
+        ("en_us", [("a", b"A\0"), ("b", b"B\0")], False),
+        ("fr_fr", [("b", b"\xff\x01\x00\x01"), ("c", b"C fr\0")], True),
+    ]:
+        path = tmpdir.join(f"{lang}.stringtable")
+        path.write_binary(rst_data(4, strings, trenc=trenc))
+        paths[lang] = str(path)
+
+    store = RstStore.build(paths)
+    assert store.langs == ["en_us", "fr_fr"]
+    store.save(str(tmpdir.join("strings.rststore")))
+    for store in (store, RstStore.load(str(tmpdir.join("strings.rststore")))):
+        assert store.lookup("a", "en_us") == "A"
+        assert store.lookup("a", "fr_fr") is None
+        assert store.lookup_many(["c", "b", "d"]) == {
+            "en_us": [None, "B", None],
+            "fr_fr": ["C fr", "AQ==", None],
+        }
+        assert store.translations(["a", "c"], ["fr_fr"]) == {"fr_fr": {"c": "C fr"}}
+
+
+def test_load_rst_store(tmpdir, cache_dir, monkeypatch):
+    paths = {}
+    for lang, strings in [("en_us", [("a", b"A\0")]), ("fr_fr", [("a", b"A fr\0")])]:
+        path = tmpdir.join(f"{lang}.stringtable")
+        path.write_binary(rst_data(4, strings))
+        paths[lang] = str(path)
+
+    store = load_rst_store(paths)
+    cache_files = os.listdir(cache_dir / "rststore")
+    assert len(cache_files) == 1
+
+    # cached store is reused
+    with monkeypatch.context() as m:
+        m.setattr(RstStore, 'build', None)
+        store = load_rst_store(paths)
+    assert store.lookup_many(["a"]) == {"en_us": ["A"], "fr_fr": ["A fr"]}
+
+    # new store for modified files
+    tmpdir.join("fr_fr.stringtable").write_binary(rst_data(4, [("a", b"B fr\0")]))
+    store = load_rst_store(paths)
+    assert store.lookup("a", "fr_fr") == "B fr"
+    assert len(os.listdir(cache_dir / "rststore")) == 2
+
+    # invalid cache files are ignored
+    for name in os.listdir(cache_dir / "rststore"):
+        (cache_dir / "rststore" / name).write_bytes(b"invalid")
+    assert load_rst_store(paths).lookup("a", "fr_fr") == "B fr"
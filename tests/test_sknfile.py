@@ -0,0 +1,126 @@
+import json
+import struct
+from io import BytesIO, StringIO
+import numpy as np
+import pytest
+from cdtb.sknfile import SknFile
+
+
+def skn_data(objects, indices, vertices, vertex_type=1):
+    """Build version 4 SKN file data
+
+    `objects` is a list of `(name, start_vertex, vertex_count, start_index, index_count)`.
+    `vertices` is a list of `(position, normal, uv)`.
+    """
+    vertex_size = 52 + 4 * (vertex_type >= 1) + 16 * (vertex_type == 2)
+    data = b"\x33\x22\x11\x00" + struct.pack("<HHI", 4, 1, len(objects))
+    for name, *counts in objects:
+        data += struct.pack("<64s4I", name.encode(), *counts)
+    data += struct.pack("<IIIII", 0, len(indices), len(vertices), vertex_size, vertex_type)
+    data += struct.pack("<10f", *range(10))
+    data += struct.pack(f"<{len(indices)}H", *indices)
+    parts = [data]
+    for i, (position, normal, uv) in enumerate(vertices):
+        parts.append(struct.pack("<3f4B4f3f2f", *position, i % 256, 0, 0, 0, 1, 0, 0, 0, *normal, *uv))
+        if vertex_type >= 1:
+            parts.append(b"\xff" * 4)
+        if vertex_type == 2:
+            parts.append(struct.pack("<4f", 0, 0, 1, 1))
+    return b"".join(parts)
+
+def sample_skn_data(vertex_type=1):
+    vertices = [((i, 0.1 * i, -i), (0, 1, 0), (0.5, 0.25 * i)) for i in range(5)]
+    return skn_data([("first", 0, 3, 0, 3), ("second", 3, 2, 3, 6)], [0, 1, 2, 0, 3, 4, 4, 3, 1], vertices, vertex_type)
+
+
+@pytest.mark.parametrize("vertex_type", [0, 1, 2])
+def test_sknfile(vertex_type):
+    skn = SknFile(BytesIO(sample_skn_data(vertex_type)))
+    assert skn.vertex_type == vertex_type
+    assert len(skn.vertices) == 5
+    assert skn.vertices["bone_indices"][:, 0].tolist() == [0, 1, 2, 3, 4]
+    assert ("color" in skn.vertices.dtype.names) == (vertex_type >= 1)
+    assert ("tangent" in skn.vertices.dtype.names) == (vertex_type == 2)
+
+    first, second = skn.entries
+    assert first["name"] == "first"
+    assert second["name"] == "second"
+    assert np.shares_memory(second["vertices"], skn.vertices)
+    assert second["vertices"]["position"].tolist() == skn.vertices["position"][3:].tolist()
+    assert SknFile.entry_faces(first).tolist() == [[1, 2, 3]]
+    assert SknFile.entry_faces(second).tolist() == [[1, 1, 2], [2, 1, 2]]
+
+
+def test_sknfile_to_obj():
+    skn = SknFile(BytesIO(sample_skn_data()))
+    obj = skn.to_obj(skn.entries[1])
+    assert obj == (
+        "v 3.0 0.30000001192092896 -3.0\n"
+        "vt 0.5 0.75\n"
+        "vn 0.0 1.0 0.0\n"
+        "v 4.0 0.4000000059604645 -4.0\n"
+        "vt 0.5 1.0\n"
+        "vn 0.0 1.0 0.0\n"
+        "f 1/1/1 1/1/1/ 2/2/2\n"
+        "f 2/2/2 1/1/1/ 2/2/2\n"
+    )
+
+
+def test_sknfile_write_obj():
+    skn = SknFile(BytesIO(sample_skn_data()))
+    entry = skn.entries[1]
+    f = StringIO()
+    skn.write_obj(entry, f, chunk_size=1)
+    assert f.getvalue() == skn.to_obj(entry)
+
+
+def test_sknfile_write_glb():
+    skn = SknFile(BytesIO(sample_skn_data(2)))
+    f = BytesIO()
+    skn.write_glb(f)
+    data = f.getvalue()
+
+    magic, version, length = struct.unpack_from("<4sLL", data)
+    assert (magic, version, length) == (b"glTF", 2, len(data))
+    json_length, json_type = struct.unpack_from("<L4s", data, 12)
+    assert json_type == b"JSON"
+    gltf = json.loads(data[20 : 20 + json_length])
+    bin_length, bin_type = struct.unpack_from("<L4s", data, 20 + json_length)
+    assert bin_type == b"BIN\0"
+    buffer = data[28 + json_length : 28 + json_length + bin_length]
+    assert gltf["buffers"] == [{"byteLength": len(buffer)}]
+
+    primitives = gltf["meshes"][0]["primitives"]
+    assert [p["extras"]["name"] for p in primitives] == ["first", "second"]
+    assert buffer[:skn.vertices.nbytes] == skn.vertices.tobytes()
+
+    def read_accessor(index, dtype, ncomponents):
+        accessor = gltf["accessors"][index]
+        view = gltf["bufferViews"][accessor["bufferView"]]
+        stride = view.get("byteStride", np.dtype(dtype).itemsize * ncomponents)
+        offset = view["byteOffset"] + accessor.get("byteOffset", 0)
+        return [
+            list(struct.unpack_from(f"<{ncomponents}{dtype}", buffer, offset + i * stride))
+            for i in range(accessor["count"])
+        ]
+
+    second = primitives[1]
+    assert read_accessor(second["attributes"]["POSITION"], "f", 3) == skn.entries[1]["vertices"]["position"].tolist()
+    assert read_accessor(second["attributes"]["TEXCOORD_0"], "f", 2) == [[0.5, 0.75], [0.5, 1.0]]
+    assert read_accessor(second["attributes"]["JOINTS_0"], "B", 4) == [[3, 0, 0, 0], [4, 0, 0, 0]]
+    assert read_accessor(second["indices"], "H", 1) == [[0], [0], [1], [1], [0], [1]]
+    assert gltf["accessors"][second["attributes"]["POSITION"]]["min"] == [3.0, 0.30000001192092896, -4.0]
+
+
+@pytest.mark.parametrize("vertex_count, component_type", [(0xFFFE, 5123), (0xFFFF, 5125)])
+def test_sknfile_write_glb_index_type(vertex_count, component_type):
+    vertices = [((0, 0, 0), (0, 1, 0), (0, 0))] * vertex_count
+    indices = [0, 1, vertex_count - 1]
+    skn = SknFile(BytesIO(skn_data([("mesh", 0, vertex_count, 0, 3)], indices, vertices)))
+    f = BytesIO()
+    skn.write_glb(f)
+    data = f.getvalue()
+    json_length, = struct.unpack_from("<L", data, 12)
+    gltf = json.loads(data[20 : 20 + json_length])
+    primitive = gltf["meshes"][0]["primitives"][0]
+    assert gltf["accessors"][primitive["indices"]]["componentType"] == component_type
@@ -1,4 +1,7 @@
+import struct
+from io import BytesIO
 import requests
+from cdtb.binfile import BinType, compute_binhash
 
 def count_calls(f):
     """Decorator to count calls to a function"""
@@ -12,5 +15,34 @@ def mock_response(content=None, status_code=200):
     r = requests.Response()
     r.status_code = status_code
     r._content = content
+    r.raw = BytesIO(content or b'')  # for streamed responses
     return r
 
+
+def binfield_data(hname, btype, data):
+    """Build bin field data from its name hash, type and raw value data"""
+    return struct.pack('<LB', hname, btype) + data
+
+def string_field(name, s):
+    return binfield_data(compute_binhash(name), BinType.STRING, struct.pack('<H', len(s)) + s.encode())
+
+def u32_field(name, v):
+    return binfield_data(compute_binhash(name), BinType.U32, struct.pack('<L', v))
+
+def binfile_data(entries, linked=None):
+    """Build bin file data from a list of `(htype, hpath, fields)` entries
+
+    `fields` is a list of raw fields, as built by `binfield_data()`.
+    """
+    data = b'PROP'
+    if linked is None:
+        data += struct.pack('<L', 1)
+    else:
+        data += struct.pack('<LL', 2, len(linked))
+        data += b''.join(struct.pack('<H', len(s)) + s.encode() for s in linked)
+    data += struct.pack('<L', len(entries))
+    data += b''.join(struct.pack('<L', htype) for htype, _, _ in entries)
+    for _, hpath, fields in entries:
+        entry_data = struct.pack('<LH', hpath, len(fields)) + b''.join(fields)
+        data += struct.pack('<L', len(entry_data)) + entry_data
+    return data